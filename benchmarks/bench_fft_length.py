@@ -0,0 +1,89 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+"""
+Micro-benchmark of the FFT-friendly padding policy (timeseries.fast_length).
+
+The template lengths are those of CBC templates (Newtonian chirp time from
+the low frequency cutoff) of a bank of random masses, aligned on the largest
+timescale of the grid. The FFTs and convolutions (scipy.signal.fftconvolve,
+as in timeseries.upfirdn) of segments of these lengths are timed with and
+without padding of the segments to the next FFT-friendly length (see
+pipeline.pad_stage()).
+"""
+
+import argparse
+import timeit
+import numpy
+
+from wavegraph import timeseries, tfcluster
+
+SOLAR_MASS_TIME = 4.925491025543576e-06 # G M_sun / c^3 [s]
+
+def chirp_time(mass1, mass2, low_freq_cutoff):
+    """ Newtonian chirp time [s] from low_freq_cutoff to coalescence """
+    mchirp = (mass1 * mass2)**0.6 / (mass1 + mass2)**0.2
+    return 5. / 256. * (numpy.pi * low_freq_cutoff)**(-8. / 3.) \
+        * (mchirp * SOLAR_MASS_TIME)**(-5. / 3.)
+
+def template_lengths(num_templates, min_mass, max_mass, low_freq_cutoff, grid,
+                     seed=0):
+    """ Lengths of the templates of a random bank, aligned on the grid """
+    rng = numpy.random.RandomState(seed)
+    masses = rng.uniform(min_mass, max_mass, size=(num_templates, 2))
+    durations = chirp_time(masses[:, 0], masses[:, 1], low_freq_cutoff)
+    step = 2**int(grid.timescales_exp[-1])
+    return (numpy.ceil(durations * grid.sampling_freq / step) * step).astype(int)
+
+def time_lengths(lengths, function, repeat):
+    """ Best total time of function(length) over the lengths """
+    return min(timeit.timeit(lambda: [function(n) for n in lengths], number=1) \
+               for _ in range(repeat))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--analysis-sample-rate', type=float, default=1024.)
+    parser.add_argument('--min-scale', type=int, default=3)
+    parser.add_argument('--max-scale', type=int, default=7)
+    parser.add_argument('--low-freq-cutoff', type=float, default=32.)
+    parser.add_argument('--min-mass', type=float, default=1.)
+    parser.add_argument('--max-mass', type=float, default=10.)
+    parser.add_argument('--num-templates', type=int, default=200)
+    parser.add_argument('--filter-length', type=int, default=301)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    grid = tfcluster.CoherentWaveBurstGrid(args.analysis_sample_rate,
+                                           args.min_scale, args.max_scale)
+    lengths = template_lengths(args.num_templates, args.min_mass, args.max_mass,
+                               args.low_freq_cutoff, grid)
+    padded = numpy.array([timeseries.grid_fast_length(n, grid) for n in lengths])
+
+    rng = numpy.random.RandomState(1)
+    data = rng.randn(int(padded.max()))
+    fir = rng.randn(args.filter_length)
+
+    print("{} templates, {} to {} samples, mean padding {:.1f}%".format(
+        len(lengths), lengths.min(), lengths.max(),
+        100. * numpy.mean(padded / lengths.astype(float) - 1.)))
+
+    # FFTs of the segments, with and without padding of the segments
+    raw = time_lengths(lengths, lambda n: numpy.fft.rfft(data[:n]), args.repeat)
+    fast = time_lengths(padded, lambda n: numpy.fft.rfft(data[:n]), args.repeat)
+    print("rfft of segments: raw lengths {:.4f} s, padded lengths {:.4f} s, " \
+          "speed-up {:.2f}".format(raw, fast, raw / fast))
+
+    # Filtering of the segments (as in timeseries.upfirdn), with and
+    # without padding of the segments. scipy.signal.fftconvolve already
+    # pads the convolution to a fast length: this is the baseline
+    from scipy import signal
+
+    raw = time_lengths(lengths, lambda n: signal.fftconvolve(fir, data[:n]),
+                       args.repeat)
+    fast = time_lengths(padded, lambda n: signal.fftconvolve(fir, data[:n]),
+                        args.repeat)
+    print("FIR filtering (fftconvolve): raw lengths {:.4f} s, padded lengths " \
+          "{:.4f} s, speed-up {:.2f}".format(raw, fast, raw / fast))
+
+if __name__ == '__main__':
+    main()
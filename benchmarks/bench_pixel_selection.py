@@ -0,0 +1,91 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+"""
+Micro-benchmark of the pixel selection on the planes of a grid: selection
+of each full plane with sparse_energy_map(), against the coarse-to-fine
+selection of watutils.coarse_to_fine_energy_maps(), where the pixels of each
+plane are only searched around the pixels selected on the coarser plane.
+
+The energy maps are synthetic maps of a long, narrow-band signal (slowly
+drifting line of frequency) over a weak background, with the shapes of the
+WDM planes of the grid (no WDM transform is computed).
+"""
+
+import argparse
+import timeit
+import numpy
+
+from wavegraph import watutils, tfcluster
+
+def line_energy_maps(grid, duration, start_freq, drift, background, seed=0):
+    """
+    Return synthetic energy maps of a slowly drifting line, one per scale
+    of the grid.
+
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    duration   [float] -- duration of the signal [s]
+    start_freq [float] -- initial frequency of the line [Hz]
+    drift      [float] -- frequency drift [Hz/s]
+    background [float] -- mean energy of the background pixels, relative
+                          to the mean energy per unit time of the line
+    """
+    rng = numpy.random.RandomState(seed)
+    num_samples = int(duration * grid.sampling_freq)
+    tfmaps = []
+    for exponent in grid.timescales_exp:
+        num_layers = 2**int(exponent)
+        num_times = num_samples // num_layers
+        freq_step = grid.sampling_freq / (2. * num_layers)
+        times = (numpy.arange(num_times) + 0.5) * num_layers / grid.sampling_freq
+        line = (start_freq + drift * times) / freq_step
+        freqs = numpy.arange(num_layers + 1)[:, None]
+        tfmap = numpy.exp(-0.5 * (freqs - line)**2)
+        tfmap *= num_layers / numpy.sum(tfmap, axis=0)
+        tfmap += background * num_layers / (num_layers + 1.) \
+                 * rng.exponential(size=tfmap.shape)
+        tfmaps.append(tfmap)
+    return tfmaps
+
+def best_time(function, repeat):
+    """ Best time of function() """
+    return min(timeit.timeit(function, number=1) for _ in range(repeat))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--analysis-sample-rate', type=float, default=2048.)
+    parser.add_argument('--min-scale', type=int, default=3)
+    parser.add_argument('--max-scale', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=1024.)
+    parser.add_argument('--start-freq', type=float, default=100.)
+    parser.add_argument('--drift', type=float, default=0.1)
+    parser.add_argument('--background', type=float, default=1e-4)
+    parser.add_argument('--energy-fraction', type=float, default=0.9)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    grid = tfcluster.CoherentWaveBurstGrid(args.analysis_sample_rate,
+                                           args.min_scale, args.max_scale)
+    tfmaps = line_energy_maps(grid, args.duration, args.start_freq, args.drift,
+                              args.background)
+    print("{} planes, {} pixels".format(len(tfmaps),
+                                        sum(tfmap.size for tfmap in tfmaps)))
+
+    full = lambda: [watutils.sparse_energy_map(tfmap, args.energy_fraction) \
+                    for tfmap in tfmaps]
+    coarse_to_fine = lambda: watutils.coarse_to_fine_energy_maps(
+        tfmaps, args.energy_fraction)
+
+    for (tfmap, reference, sparse_map) in zip(tfmaps, full(), coarse_to_fine()):
+        print("shape {}: {} pixels (full search), {} pixels (coarse to fine), " \
+              "energy fraction {:.3f}".format(
+                  tfmap.shape, reference.keys.size, sparse_map.keys.size,
+                  numpy.sum(sparse_map.energies) / numpy.sum(tfmap)))
+
+    reference = best_time(full, args.repeat)
+    duration = best_time(coarse_to_fine, args.repeat)
+    print("sparse_energy_map on every plane: {:.4f} s, coarse to fine: {:.4f} s, " \
+          "speed-up {:.2f}".format(reference, duration, reference / duration))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+"""
+Startup benchmark: time of the import of each wavegraph module, and of the
+--help of command line tools, each in a fresh Python process.
+
+For each module, the heavy dependencies loaded by its import (ROOT, LAL,
+h5py, scipy...) are listed, so that a module that should not need them
+(e.g. graph or tfcluster for the tools handling clusters and graphs) can be
+spotted.
+
+The wavegraph modules import each other as top-level modules (e.g. "import
+watutils"): the wavegraph directory is put on the Python path of the
+processes, and the modules are imported from it.
+"""
+
+import os
+import sys
+import json
+import shlex
+import shutil
+import timeit
+import argparse
+import subprocess
+
+MODULES = ['profiling', 'timeseries', 'tfcluster', 'graph', 'cache', 'pipeline',
+           'executor', 'cbc', 'overlap', 'solvers', 'pursuit', 'watutils']
+
+HEAVY_MODULES = ['ROOT', 'lal', 'lalsimulation', 'h5py', 'scipy', 'scipy.signal',
+                 'scipy.sparse', 'yaml', 'matplotlib']
+
+# Command line tools of wavegraph, timed if they are installed
+TOOLS = ['wgsignals', 'wgclusters', 'wgclusters_pipe', 'wggraph']
+
+# Directory of the wavegraph modules
+MODULE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          os.pardir, 'wavegraph')
+
+# Modules that must not load ROOT nor LAL
+LIGHT_MODULES = ['profiling', 'timeseries', 'tfcluster', 'graph', 'cache',
+                 'pipeline', 'executor', 'cbc']
+
+IMPORT_CODE = """
+import sys, timeit, json
+start = timeit.default_timer()
+import {module}
+duration = timeit.default_timer() - start
+print(json.dumps({{'time': duration,
+                   'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+def environment(path):
+    """ Return the environment of the processes, with path first on the Python path """
+    env = dict(os.environ)
+    if path:
+        paths = [path, env['PYTHONPATH']] if env.get('PYTHONPATH') else [path]
+        env['PYTHONPATH'] = os.pathsep.join(paths)
+    return env
+
+def import_time(module, repeat, env=None):
+    """
+    Return the best import time of a module in a fresh process, and the
+    heavy modules it loads.
+    """
+    code = IMPORT_CODE.format(module=module, heavy=HEAVY_MODULES)
+    best = None
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, '-c', code], env=env)
+        result = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        if best is None or result['time'] < best['time']:
+            best = result
+    return best
+
+def command_time(command, repeat, env=None):
+    """
+    Return the best wall time of a command (including the interpreter
+    startup), or None if the command fails or is not found.
+    """
+    with open(os.devnull, 'w') as devnull:
+        try:
+            if subprocess.call(command, stdout=devnull, stderr=devnull, env=env):
+                return None
+        except OSError:
+            return None
+        return min(timeit.timeit(lambda: subprocess.call(command, stdout=devnull,
+                                                         stderr=devnull, env=env),
+                                 number=1) for _ in range(repeat))
+
+def default_commands():
+    """ Return the --help command lines of the executor and of the installed tools """
+    commands = [' '.join([sys.executable, '-m', 'executor', '--help'])]
+    for tool in TOOLS:
+        if shutil.which(tool):
+            commands.append('{} --help'.format(tool))
+        else:
+            print("{}: not installed, not timed".format(tool))
+    return commands
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--path', default=MODULE_DIR,
+                        help='directory put on the Python path of the processes '
+                        '(default: the wavegraph modules of this tree)')
+    parser.add_argument('--package', default='',
+                        help='package of the modules (empty if the modules '
+                        'are directly on the Python path)')
+    parser.add_argument('--modules', nargs='*', default=MODULES)
+    parser.add_argument('--commands', nargs='*', default=None,
+                        help='command lines to time, e.g. "wggraph --help" '
+                        '(default: --help of the executor and of the installed '
+                        'tools)')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output-file', default=None,
+                        help='JSON file of the results')
+    args = parser.parse_args()
+
+    env = environment(os.path.abspath(args.path) if args.path else None)
+    results = {'python': sys.version.split()[0], 'imports': {}, 'commands': {}}
+
+    baseline = command_time([sys.executable, '-c', 'pass'], args.repeat)
+    results['interpreter'] = baseline
+    print("Python interpreter startup: {:.3f} s".format(baseline))
+
+    for module in args.modules:
+        name = '{}.{}'.format(args.package, module) if args.package else module
+        try:
+            result = import_time(name, args.repeat, env)
+        except subprocess.CalledProcessError:
+            print("{:>12}: import failed".format(module))
+            results['imports'][module] = {'error': 'import failed'}
+            continue
+        results['imports'][module] = result
+        heavy = [m for m in result['loaded'] if m.split('.')[0] in ('ROOT', 'lal',
+                                                                    'lalsimulation')]
+        print("{:>12}: {:.3f} s, loads {}{}".format(
+            module, result['time'], ', '.join(result['loaded']) or 'nothing heavy',
+            ' -- WARNING: should not load {}'.format(', '.join(heavy)) \
+            if heavy and module in LIGHT_MODULES else ''))
+
+    commands = default_commands() if args.commands is None else args.commands
+    for command in commands:
+        duration = command_time(shlex.split(command), args.repeat, env)
+        results['commands'][command] = duration
+        if duration is None:
+            print("{}: failed".format(command))
+        else:
+            print("{}: {:.3f} s".format(command, duration))
+
+    if args.output_file:
+        with open(args.output_file, 'w') as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+"""
+Benchmark suite of the wavegraph stages on synthetic, reproducible workloads
+(random GridPoint clusters, chirps and sine-Gaussian bursts).
+
+Each benchmark is timed (best of several runs) and its peak memory is
+measured. The results are written to a JSON file, which can be compared
+with the results of a previous commit with --compare.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import timeit
+import logging
+import argparse
+import platform
+import tempfile
+import subprocess
+import numpy
+
+from wavegraph import timeseries, tfcluster
+
+LOGGING_FMT = "%(levelname)s -- %(filename)s:line %(lineno)s in %(funcName)s(): %(message)s"
+
+# Synthetic workloads
+
+def random_clusters(grid, num_clusters, cluster_size, seed=0):
+    """
+    Return random clusters: random walks on the grid, increasing in time,
+    with a slowly varying frequency (chirp-like tracks).
+    """
+    rng = numpy.random.RandomState(seed)
+    num_scales = len(grid.timescales_exp)
+    clusters = []
+    for n in range(num_clusters):
+        scale_index = rng.randint(num_scales, size=cluster_size)
+        # Time and frequency indices at the largest scale, projected
+        # onto the scale of each pixel
+        times = numpy.cumsum(rng.randint(0, 2, size=cluster_size))
+        freqs = numpy.clip(8 + numpy.cumsum(rng.randint(-1, 3, size=cluster_size)),
+                           0, 2**int(grid.timescales_exp[-1]))
+        factor = 2**(num_scales - 1 - scale_index)
+        points = [tfcluster.GridPoint(int(s), int(t * f), int(m // f)) \
+                  for (s, t, m, f) in zip(scale_index, times, freqs, factor)]
+        # Remove duplicated pixels, keeping the order
+        seen = set()
+        points = [p for p in points if not (p in seen or seen.add(p))]
+        clusters.append(tfcluster.Cluster(points, rng.rand(len(points)),
+                                          'cluster #{}'.format(n)))
+    return clusters
+
+def chirp(sampling_freq, duration, low_freq, high_freq):
+    """ Return a power-law chirp ending at high_freq, tapered at both ends """
+    t = numpy.arange(int(duration * sampling_freq)) / sampling_freq
+    tau = duration - t + 1. / sampling_freq
+    # Newtonian-like frequency evolution f ~ tau^(-3/8)
+    freq = low_freq * (tau / duration)**(-3. / 8.)
+    freq = numpy.minimum(freq, high_freq)
+    phase = 2 * numpy.pi * numpy.cumsum(freq) / sampling_freq
+    taper = numpy.minimum(1., numpy.minimum(t, duration - t) * low_freq / 4.)
+    return timeseries.Timeseries(taper * numpy.sin(phase), sampling_freq, 0.,
+                                 'chirp {}-{} Hz'.format(low_freq, high_freq))
+
+def burst(sampling_freq, duration, central_freq, quality):
+    """ Return a sine-Gaussian burst centred in a segment """
+    t = numpy.arange(int(duration * sampling_freq)) / sampling_freq - duration / 2.
+    width = quality / (numpy.sqrt(2.) * numpy.pi * central_freq)
+    data = numpy.exp(-t**2 / width**2) * numpy.sin(2 * numpy.pi * central_freq * t)
+    return timeseries.Timeseries(data, sampling_freq, 0.,
+                                 'sine-Gaussian f={} Hz Q={}'.format(central_freq,
+                                                                     quality))
+
+# Measurements
+
+def peak_memory(function):
+    """
+    Return the peak memory [bytes] allocated while running function,
+    measured with tracemalloc (Python allocations) if available, or from
+    the increase of the maximum resident set size otherwise.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        import resource
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        function()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return (after - before) * 1024
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def measure(function, repeat):
+    """ Return the best wall time of function over repeat runs, and its peak memory """
+    best = min(timeit.timeit(function, number=1) for _ in range(repeat))
+    return {'time': best, 'peak_memory': peak_memory(function)}
+
+# Benchmarks: each one returns the function to measure and its parameters
+
+def bench_graph(args, grid, workdir):
+    from wavegraph import graph
+    clusters = random_clusters(grid, args.num_clusters, args.cluster_size)
+    return lambda: graph.Graph(clusters), \
+        {'num_clusters': args.num_clusters, 'cluster_size': args.cluster_size}
+
+def bench_topological_sort(args, grid, workdir):
+    from wavegraph import graph
+    g = graph.Graph(random_clusters(grid, args.num_clusters, args.cluster_size))
+    return g._topological_sorting, {'num_nodes': len(g.sorted_list)}
+
+def bench_write_graph(args, grid, workdir):
+    from wavegraph import graph
+    g = graph.Graph(random_clusters(grid, args.num_clusters, args.cluster_size))
+    filename = os.path.join(workdir, 'graph.txt')
+    return lambda: graph.write_graph(filename, g, 'benchmark', grid), \
+        {'num_nodes': len(g.sorted_list)}
+
+def bench_write_clusters(args, grid, workdir):
+    clusters = random_clusters(grid, args.num_clusters, args.cluster_size)
+    filename = os.path.join(workdir, 'clusters_write.hdf5')
+    return lambda: tfcluster.write_clusters(filename, clusters, 'benchmark',
+                                            'benchmark'), \
+        {'num_clusters': args.num_clusters, 'cluster_size': args.cluster_size}
+
+def bench_read_clusters(args, grid, workdir):
+    clusters = random_clusters(grid, args.num_clusters, args.cluster_size)
+    filename = os.path.join(workdir, 'clusters_read.hdf5')
+    tfcluster.write_clusters(filename, clusters, 'benchmark', 'benchmark')
+    return lambda: tfcluster.read_clusters(filename), \
+        {'num_clusters': args.num_clusters, 'cluster_size': args.cluster_size}
+
+def bench_shift_clusters(args, grid, workdir):
+    clusters = random_clusters(grid, args.num_clusters, args.cluster_size)
+    return lambda: tfcluster.shift_clusters_to_zero_index(clusters, grid), \
+        {'num_clusters': args.num_clusters, 'cluster_size': args.cluster_size}
+
+def bench_resample(args, grid, workdir):
+    signal = chirp(2 * args.sampling_freq, args.duration, args.low_freq,
+                   args.sampling_freq / 2.)
+    return lambda: timeseries.resample(signal.data, 1, 2), \
+        {'num_samples': len(signal.data), 'factor': '1/2'}
+
+def bench_wdm_transform_chirp(args, grid, workdir):
+    from wavegraph import watutils
+    signal = chirp(args.sampling_freq, args.duration, args.low_freq,
+                   args.sampling_freq / 4.)
+    watutils.initialize_WDM_types(grid)
+    return lambda: watutils.wdm_transform(signal.data, grid), \
+        {'num_samples': len(signal.data),
+         'scales': [int(s) for s in grid.timescales_exp]}
+
+def bench_wdm_transform_burst(args, grid, workdir):
+    from wavegraph import watutils
+    signal = burst(args.sampling_freq, args.duration, args.sampling_freq / 8., 9.)
+    watutils.initialize_WDM_types(grid)
+    return lambda: watutils.wdm_transform(signal.data, grid), \
+        {'num_samples': len(signal.data),
+         'scales': [int(s) for s in grid.timescales_exp]}
+
+BENCHMARKS = [('graph_construction', bench_graph),
+              ('topological_sort', bench_topological_sort),
+              ('write_graph', bench_write_graph),
+              ('write_clusters', bench_write_clusters),
+              ('read_clusters', bench_read_clusters),
+              ('shift_clusters_to_zero_index', bench_shift_clusters),
+              ('resample', bench_resample),
+              ('wdm_transform_chirp', bench_wdm_transform_chirp),
+              ('wdm_transform_burst', bench_wdm_transform_burst)]
+
+def git_describe():
+    """ Return the git description of the current commit """
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"]) \
+                         .decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(results, filename):
+    """ Log the time and memory ratios with respect to previous results """
+    with open(filename) as file:
+        previous = dict((r['name'], r) for r in json.load(file)['results'])
+    for result in results:
+        before = previous.get(result['name'])
+        if before is None or 'time' not in before or 'time' not in result:
+            continue
+        logging.info('{:>30}: time x{:.2f}, peak memory x{:.2f}'.format(
+            result['name'], result['time'] / before['time'],
+            float(result['peak_memory']) / max(before['peak_memory'], 1)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output-file', default='benchmarks.json')
+    parser.add_argument('--compare', default=None,
+                        help='JSON file of previous results')
+    parser.add_argument('--benchmarks', nargs='*', default=None,
+                        help='names of the benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--num-clusters', type=int, default=500)
+    parser.add_argument('--cluster-size', type=int, default=50)
+    parser.add_argument('--sampling-freq', type=float, default=1024.)
+    parser.add_argument('--duration', type=float, default=16.)
+    parser.add_argument('--low-freq', type=float, default=32.)
+    parser.add_argument('--min-scale', type=int, default=3)
+    parser.add_argument('--max-scale', type=int, default=7)
+    parser.add_argument('--log', default='info', help='logging level')
+    args = parser.parse_args()
+
+    logging.basicConfig(format=LOGGING_FMT, level=getattr(logging, args.log.upper()))
+
+    grid = tfcluster.CoherentWaveBurstGrid(args.sampling_freq, args.min_scale,
+                                           args.max_scale)
+    workdir = tempfile.mkdtemp(prefix='wavegraph_bench_')
+
+    results = []
+    try:
+        for (name, benchmark) in BENCHMARKS:
+            if args.benchmarks and name not in args.benchmarks:
+                continue
+            try:
+                function, params = benchmark(args, grid, workdir)
+            except (ImportError, SyntaxError) as error:
+                # Optional dependencies (e.g. ROOT) may be missing
+                logging.warning('{}: skipped ({})'.format(name, error))
+                results.append({'name': name, 'skipped': str(error)})
+                continue
+            except Exception as error:
+                # A failing set-up only fails its benchmark
+                logging.error('{}: set-up failed ({!r})'.format(name, error))
+                results.append({'name': name, 'error': repr(error)})
+                continue
+            result = {'name': name, 'params': params}
+            try:
+                result.update(measure(function, args.repeat))
+            except Exception as error:
+                logging.error('{}: failed ({!r})'.format(name, error))
+                results.append({'name': name, 'params': params, 'error': repr(error)})
+                continue
+            logging.info('{:>30}: {:.4f} s, peak memory {:.1f} MB'.format(
+                name, result['time'], result['peak_memory'] / 2.**20))
+            results.append(result)
+    finally:
+        shutil.rmtree(workdir)
+
+    with open(args.output_file, 'w') as file:
+        json.dump({'git': git_describe(),
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                   'python': sys.version.split()[0],
+                   'platform': platform.platform(),
+                   'config': vars(args),
+                   'results': results}, file, indent=2)
+    logging.info('Wrote {} results in {}'.format(len(results), args.output_file))
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+# The wavegraph modules import each other as top-level modules (e.g.
+# "import watutils"), so their directory is put on the path of the tests.
+# The tests do not need ROOT: the Wilson atoms are replaced by Gaussian
+# wave packets with the same interface as watutils.WILSON_ATOMS.
+
+import os
+import sys
+import numpy
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'wavegraph'))
+
+import tfcluster
+
+class GaussianAtoms(object):
+    """
+    Atom dictionary of Gaussian wave packets, with the interface of
+    watutils.WilsonAtomDictionary (prototype() and atom()).
+    """
+    wat_type = None
+    inu = 6
+    precision = 10
+
+    def prototype(self, scale, freq_index, parity, dual):
+        num_layers = 2**scale
+        length = 16 * num_layers + 1 + 2 * (freq_index % 2)
+        t = numpy.arange(length) - length // 2
+        window = numpy.exp(-0.5 * (t / (2. * num_layers))**2)
+        phase = 0.5 * numpy.pi * ((parity + freq_index) % 2 + dual)
+        return window * numpy.cos(numpy.pi * freq_index * t / num_layers + phase)
+
+    def atom(self, scale, time_index, freq_index, dual):
+        samples = self.prototype(scale, freq_index, time_index % 2, dual)
+        return 2**scale * time_index - samples.size // 2, samples
+
+def dense_atom(atoms, grid, num_samples, scale_index, part, freq_index, time_index):
+    """ Samples of an atom on a circular segment of num_samples samples """
+    offset, samples = atoms.atom(grid.timescales_exp[scale_index], time_index,
+                                 freq_index, part)
+    out = numpy.zeros(num_samples)
+    numpy.add.at(out, numpy.arange(offset, offset + samples.size) % num_samples,
+                 samples)
+    return out
+
+@pytest.fixture
+def atoms():
+    return GaussianAtoms()
+
+@pytest.fixture
+def grid():
+    return tfcluster.CoherentWaveBurstGrid(256., 2, 4)
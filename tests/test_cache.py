@@ -0,0 +1,100 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+import os
+import time
+import numpy
+import pytest
+
+import cache
+from timeseries import Timeseries
+
+@pytest.fixture
+def stage_cache(tmp_path):
+    return cache.StageCache(str(tmp_path / 'cache'), max_size=300)
+
+def artifact(tmp_path, name, size=100):
+    filename = str(tmp_path / name)
+    with open(filename, 'wb') as file:
+        file.write(os.urandom(size))
+    return filename
+
+def test_stage_key():
+    key = cache.stage_key('clusters', ['a', 'b'], {'x': 1, 'y': 2})
+    assert key == cache.stage_key('clusters', ['a', 'b'], {'y': 2, 'x': 1})
+    assert key != cache.stage_key('clusters', ['b', 'a'], {'x': 1, 'y': 2})
+    assert key != cache.stage_key('clusters', ['a', 'b'], {'x': 1, 'y': 3})
+    assert key != cache.stage_key('graph', ['a', 'b'], {'x': 1, 'y': 2})
+
+def test_timeseries_hash():
+    signal = Timeseries(numpy.arange(8.), 256., 0., 'template')
+    same = Timeseries(numpy.arange(8.), 256., 0., 'template')
+    other = Timeseries(numpy.arange(8.), 512., 0., 'template')
+    assert cache.timeseries_hash([signal]) == cache.timeseries_hash([same])
+    assert cache.timeseries_hash([signal]) != cache.timeseries_hash([other])
+
+def test_lru_eviction(stage_cache, tmp_path):
+    paths = [stage_cache.store('{:02d}'.format(n) * 32, artifact(tmp_path, str(n)))
+             for n in range(3)]
+
+    # Last uses: artifact 1, 2, then 0
+    start = time.time() - 1000
+    for (n, path) in enumerate(paths):
+        os.utime(path, (start + 10 * n, start + 10 * n))
+    assert stage_cache.lookup('stage', '00' * 32) == paths[0]
+
+    # Beyond the maximum size, the least recently used artifact is evicted
+    stage_cache.store('03' * 32, artifact(tmp_path, '3'))
+    assert not os.path.isfile(paths[1])
+    assert os.path.isfile(paths[0]) and os.path.isfile(paths[2])
+    assert stage_cache.report()['size'] == 300
+
+def test_run(stage_cache, tmp_path):
+    source = artifact(tmp_path, 'input')
+    output = str(tmp_path / 'output.dat')
+    calls = []
+
+    def compute(filename):
+        calls.append(filename)
+        with open(filename, 'w') as file:
+            file.write('result')
+
+    assert not stage_cache.run('stage', [source], 'params', output, compute)
+    os.remove(output)
+    assert stage_cache.run('stage', [source], 'params', output, compute)
+    with open(output) as file:
+        assert file.read() == 'result'
+    assert len(calls) == 1
+
+def test_memoize(stage_cache):
+    calls = []
+
+    def compute():
+        calls.append(None)
+        return {'clusters': [1, 2, 3]}
+
+    first = stage_cache.memoize('clusters', ['hash'], {'alpha': 1}, compute)
+    second = stage_cache.memoize('clusters', ['hash'], {'alpha': 1}, compute)
+    assert first == second == {'clusters': [1, 2, 3]}
+    assert len(calls) == 1
+
+    # New parameters or inputs are recomputed
+    stage_cache.memoize('clusters', ['hash'], {'alpha': 2}, compute)
+    stage_cache.memoize('clusters', ['other'], {'alpha': 1}, compute)
+    assert len(calls) == 3
+    assert stage_cache.report()['stages'] == {'clusters': {'hits': 1, 'misses': 3}}
+
+def test_cached_stage(stage_cache):
+    import pipeline
+
+    calls = []
+
+    def double(items):
+        for item in items:
+            calls.append(item)
+            yield 2 * item
+
+    stage = pipeline.cached_stage(stage_cache, 'double', double, 'params')
+    assert list(stage([1, 2, 3])) == [2, 4, 6]
+    assert list(stage([1, 2, 3])) == [2, 4, 6]
+    assert calls == [1, 2, 3]
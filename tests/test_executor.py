@@ -0,0 +1,90 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+import os
+import sys
+import json
+
+import executor
+
+# Job appending its argument to a file, and failing for the argument 'fail'
+JOB = """
+import sys
+with open(sys.argv[1], 'a') as file:
+    file.write(sys.argv[2] + '\\n')
+sys.exit(1 if sys.argv[2] == 'fail' else 0)
+"""
+
+def runs(filename):
+    """ Arguments of the jobs run so far """
+    if not os.path.isfile(filename):
+        return []
+    with open(filename) as file:
+        return sorted(file.read().split())
+
+def records(filename):
+    with open(filename) as file:
+        return [json.loads(line) for line in file]
+
+def make_executor(tmp_path, **kwargs):
+    script = tmp_path / 'job.py'
+    script.write_text(JOB)
+    return executor.LocalExecutor([sys.executable, str(script)], 2,
+                                  str(tmp_path / 'jobs.manifest'), **kwargs)
+
+def test_read_argument_file(tmp_path):
+    filename = tmp_path / 'jobs.args'
+    filename.write_text('# comment\n--a 1\n\n  --b 2  \n')
+    assert executor.read_argument_file(str(filename)) == ['--a 1', '--b 2']
+
+def test_run_and_resume(tmp_path):
+    output = str(tmp_path / 'runs')
+    jobs = ['{} {}'.format(output, name) for name in ('a', 'b', 'c')]
+    local = make_executor(tmp_path)
+
+    assert local.run(jobs[:2]) == []
+    assert runs(output) == ['a', 'b']
+
+    # Only the new job runs
+    assert local.run(jobs) == []
+    assert runs(output) == ['a', 'b', 'c']
+    assert all(record['status'] == 'done' for record in records(local.manifest))
+
+def test_resume_ignores_truncated_record(tmp_path):
+    output = str(tmp_path / 'runs')
+    local = make_executor(tmp_path)
+    local.run(['{} a'.format(output)])
+    with open(local.manifest, 'a') as manifest:
+        manifest.write('{"job": "trunc')
+    assert executor.read_manifest(local.manifest) \
+        == set([executor.job_id(local.command, '{} a'.format(output))])
+
+def test_retries(tmp_path):
+    output = str(tmp_path / 'runs')
+    local = make_executor(tmp_path, max_retries=2)
+    failing = '{} fail'.format(output)
+    assert local.run([failing, '{} a'.format(output)]) == [failing]
+    assert runs(output) == ['a', 'fail', 'fail', 'fail']
+    assert [record['attempt'] for record in records(local.manifest)
+            if record['status'] == 'failed'] == [0, 1, 2]
+
+def test_command_not_found(tmp_path):
+    local = executor.LocalExecutor([str(tmp_path / 'missing')], 1,
+                                   str(tmp_path / 'jobs.manifest'), max_retries=0)
+    assert local.run(['a']) == ['a']
+    (record,) = records(local.manifest)
+    assert record['status'] == 'failed'
+    assert record['returncode'] is None
+    assert 'error' in record
+
+def test_job_id_depends_on_command():
+    assert executor.job_id(['wgclusters'], '--a 1') \
+        != executor.job_id(['wggraph'], '--a 1')
+    assert executor.job_id(['wgclusters'], '--a 1') \
+        == executor.job_id(['wgclusters'], '--a 1')
+
+def test_log_dir(tmp_path):
+    log_dir = tmp_path / 'logs'
+    local = make_executor(tmp_path, log_dir=str(log_dir))
+    local.run(['{} a'.format(tmp_path / 'runs')])
+    assert sorted(path.suffix for path in log_dir.iterdir()) == ['.err', '.out']
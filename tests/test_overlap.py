@@ -0,0 +1,89 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+import numpy
+import pytest
+
+import overlap
+from conftest import GaussianAtoms, dense_atom
+
+NUM_SAMPLES = 512
+
+@pytest.fixture
+def table(grid, atoms):
+    return overlap.OverlapTable.build(grid, atoms, tol=1e-9)
+
+def test_overlap_matches_dense_inner_products(table, grid, atoms):
+    rng = numpy.random.RandomState(0)
+    for _ in range(200):
+        scale_a, scale_b = rng.randint(len(grid.timescales_exp), size=2)
+        layers_a, layers_b = table.num_layers[scale_a], table.num_layers[scale_b]
+        freq_a, freq_b = rng.randint(layers_a + 1), rng.randint(layers_b + 1)
+        part_a, part_b = rng.randint(2, size=2)
+        time_a = rng.randint(10, NUM_SAMPLES // layers_a - 10)
+        time_b = layers_a * time_a // layers_b + rng.randint(-3, 4)
+
+        # Only the atoms of overlapping frequency bands are tabulated (the
+        # Wilson atoms are band-limited, the Gaussian atoms are not)
+        if abs(freq_a / float(layers_a) - freq_b / float(layers_b)) \
+           > 1. / layers_a + 1. / layers_b:
+            continue
+
+        expected = numpy.dot(
+            dense_atom(atoms, grid, NUM_SAMPLES, scale_a, part_a, freq_a, time_a),
+            dense_atom(atoms, grid, NUM_SAMPLES, scale_b, part_b, freq_b, time_b))
+        value = table.overlap((scale_a, part_a, freq_a, time_a),
+                              (scale_b, part_b, freq_b, time_b))
+        assert value == pytest.approx(expected, abs=1e-6)
+
+def test_neighbours(table, grid, atoms):
+    num_times = [NUM_SAMPLES // 2**int(s) for s in grid.timescales_exp]
+    atom = dense_atom(atoms, grid, NUM_SAMPLES, 1, 0, 3, 20)
+    neighbours = table.neighbours(1, 0, 3, 20, num_times)
+    assert len(neighbours[-1]) > 0
+    for (scale, part, freq, time, value) in zip(*neighbours):
+        expected = numpy.dot(atom, dense_atom(atoms, grid, NUM_SAMPLES,
+                                              scale, part, freq, time))
+        assert value == pytest.approx(expected, abs=1e-6)
+
+def test_save_load_round_trip(table, tmp_path):
+    filename = str(tmp_path / 'overlap.npz')
+    table.save(filename)
+    loaded = overlap.OverlapTable.load(filename)
+
+    assert loaded.params == table.params
+    assert loaded.tol == table.tol
+    for name in ('scales', 'row_base', 'indptr', 'parts', 'freqs', 'parities',
+                 'lags', 'values'):
+        numpy.testing.assert_array_equal(getattr(loaded, name),
+                                         getattr(table, name))
+    assert loaded.overlap((0, 0, 2, 5), (1, 1, 1, 2)) \
+        == table.overlap((0, 0, 2, 5), (1, 1, 1, 2))
+
+def test_get_overlap_table_disk_cache(grid, atoms, tmp_path, monkeypatch):
+    monkeypatch.setattr(overlap, '_OVERLAP_TABLES', {})
+    table = overlap.get_overlap_table(grid, atoms, 1e-9, str(tmp_path))
+    assert overlap.get_overlap_table(grid, atoms, 1e-9, str(tmp_path)) is table
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # A new process reloads the table from the disk cache
+    monkeypatch.setattr(overlap, '_OVERLAP_TABLES', {})
+    monkeypatch.setattr(overlap.OverlapTable, 'build', None)
+    loaded = overlap.get_overlap_table(grid, atoms, 1e-9, str(tmp_path))
+    numpy.testing.assert_array_equal(loaded.values, table.values)
+
+class NarrowGaussianAtoms(GaussianAtoms):
+    """ Other atoms with the same parameters as GaussianAtoms """
+    def prototype(self, scale, freq_index, parity, dual):
+        samples = GaussianAtoms.prototype(self, scale, freq_index, parity, dual)
+        t = numpy.arange(samples.size) - samples.size // 2
+        return samples * numpy.exp(-0.5 * (t / 2.**scale)**2)
+
+def test_get_overlap_table_keyed_on_atom_type(grid, atoms, tmp_path, monkeypatch):
+    monkeypatch.setattr(overlap, '_OVERLAP_TABLES', {})
+    table = overlap.get_overlap_table(grid, atoms, 1e-9, str(tmp_path))
+    other = overlap.get_overlap_table(grid, NarrowGaussianAtoms(), 1e-9, str(tmp_path))
+    assert other is not table
+    assert len(list(tmp_path.iterdir())) == 2
+    assert other.overlap((1, 0, 3, 20), (1, 0, 3, 20)) \
+        != pytest.approx(table.overlap((1, 0, 3, 20), (1, 0, 3, 20)))
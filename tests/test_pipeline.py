@@ -0,0 +1,148 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+import numpy
+import pytest
+
+import cache
+import pipeline
+import tfcluster
+from timeseries import Timeseries
+from tfcluster import Cluster, GridPoint
+
+SAMPLING_FREQ = 256.
+
+def double(items):
+    for item in items:
+        yield 2 * item
+
+def increment(items):
+    for item in items:
+        yield item + 1
+
+def test_pipeline_run_with_taps():
+    seen = []
+    written = []
+    collector = pipeline.Collector(written.append)
+    chain = pipeline.Pipeline([('double', double), ('increment', increment)])
+    chain.tap('double', seen.append).tap('double', collector)
+
+    results = chain.run(iter([1, 2, 3]))
+    # Nothing is computed before the results are consumed
+    assert seen == [] and written == []
+    assert list(results) == [3, 5, 7]
+    assert seen == [2, 4, 6]
+    # The collector passes the items to its writer once the stage is exhausted
+    assert collector.items == [2, 4, 6]
+    assert written == [[2, 4, 6]]
+
+def test_pipeline_errors():
+    chain = pipeline.Pipeline([('double', double)])
+    with pytest.raises(ValueError):
+        chain.add('double', increment)
+    with pytest.raises(ValueError):
+        chain.tap('increment', print)
+
+def test_collector_without_writer():
+    collector = pipeline.Collector()
+    collector(1)
+    collector.close()
+    assert collector.items == [1]
+
+def test_segment_stage_alignment(grid):
+    step = 2**int(grid.timescales_exp[-1])
+    duration = 4 * step / SAMPLING_FREQ
+    signal = Timeseries(numpy.arange(1., 11.), SAMPLING_FREQ, 1., 'template')
+
+    (right,) = pipeline.segment_stage(grid, duration)([signal])
+    assert len(right.data) == 4 * step
+    numpy.testing.assert_array_equal(right.data[-10:], signal.data)
+    assert not right.data[:-10].any()
+    assert (right.sampling_freq, right.t0, right.metadata) == \
+        (SAMPLING_FREQ, 1., 'template')
+
+    (left,) = pipeline.segment_stage(grid, duration, 'left')([signal])
+    numpy.testing.assert_array_equal(left.data[:10], signal.data)
+    assert not left.data[10:].any()
+
+def test_segment_stage_truncation(grid):
+    step = 2**int(grid.timescales_exp[-1])
+    duration = step / SAMPLING_FREQ
+    signal = Timeseries(numpy.arange(3. * step), SAMPLING_FREQ)
+
+    # Longer signals are truncated on the side opposite to the alignment
+    (right,) = pipeline.segment_stage(grid, duration)([signal])
+    numpy.testing.assert_array_equal(right.data, signal.data[-step:])
+    (left,) = pipeline.segment_stage(grid, duration, 'left')([signal])
+    numpy.testing.assert_array_equal(left.data, signal.data[:step])
+
+def test_segment_stage_errors(grid):
+    step = 2**int(grid.timescales_exp[-1])
+    with pytest.raises(ValueError):
+        pipeline.segment_stage(grid, step / SAMPLING_FREQ, 'center')
+    with pytest.raises(ValueError):
+        pipeline.segment_stage(grid, (step + 1) / SAMPLING_FREQ)
+
+def test_resample_stage():
+    signals = [Timeseries(numpy.sin(numpy.arange(512) / 10.), 2 * SAMPLING_FREQ),
+               Timeseries(numpy.ones(256), SAMPLING_FREQ)]
+    resampled = list(pipeline.resample_stage(SAMPLING_FREQ)(signals))
+    assert [len(s.data) for s in resampled] == [256, 256]
+    assert all(s.sampling_freq == SAMPLING_FREQ for s in resampled)
+    # Signals at the right sampling frequency are passed as is
+    assert resampled[1] is signals[1]
+
+class FakeTemplate(object):
+    """ CBC template with the interface of cbc.CompactBinaryCoalescence """
+    def __init__(self, length):
+        self.length = length
+
+    def waveform(self, approximant, freq_min, samp_freq):
+        return numpy.ones(self.length), numpy.zeros(self.length)
+
+    def __str__(self):
+        return 'template of length {}'.format(self.length)
+
+def test_template_stage():
+    signals = list(pipeline.template_stage('TaylorT4', 20., SAMPLING_FREQ)(
+        [FakeTemplate(10), FakeTemplate(30)]))
+    assert [len(s.data) for s in signals] == [10, 30]
+    assert [s.metadata for s in signals] == ['template of length 10',
+                                             'template of length 30']
+    assert all(s.sampling_freq == SAMPLING_FREQ for s in signals)
+
+def test_ordering_stage_batches(grid):
+    rng = numpy.random.RandomState(0)
+    clusters = [Cluster([GridPoint(int(rng.randint(3)), int(rng.randint(20)),
+                                   int(rng.randint(9))) for _ in range(8)],
+                        rng.randn(8).tolist(), 'cluster {}'.format(n))
+                for n in range(7)]
+    expected = tfcluster.sort_clusters(clusters, ['time', '-value'], grid)
+    for batch_size in (1, 3, 100):
+        stage = pipeline.ordering_stage(['time', '-value'], grid, batch_size)
+        for (result, reference) in zip(stage(iter(clusters)), expected):
+            assert list(result.grid_points) == list(reference.grid_points)
+            assert list(result.values) == list(reference.values)
+            assert result.metadata == reference.metadata
+
+def test_cached_stage_in_pipeline(tmp_path):
+    stage_cache = cache.StageCache(str(tmp_path / 'cache'))
+    calls = []
+
+    def square(items):
+        for item in items:
+            calls.append(item)
+            yield item**2
+
+    def run(source):
+        chain = pipeline.Pipeline([
+            ('square', pipeline.cached_stage(stage_cache, 'square', square, 'v1')),
+            ('increment', increment)])
+        return list(chain.run(source))
+
+    assert run([1, 2]) == [2, 5]
+    assert run([1, 2]) == [2, 5]
+    assert calls == [1, 2]
+    # New inputs are computed
+    assert run([3]) == [10]
+    assert calls == [1, 2, 3]
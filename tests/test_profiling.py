@@ -0,0 +1,99 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+import os
+import json
+import pytest
+
+import profiling
+
+@pytest.fixture
+def metrics_file(tmp_path):
+    filename = str(tmp_path / 'metrics.jsonl')
+    profiling.enable(filename)
+    yield filename
+    profiling.disable()
+
+def records(filename):
+    with open(filename) as file:
+        return [json.loads(line) for line in file]
+
+@profiling.timed('stage')
+def stage(n):
+    profiling.annotate(template='template {}'.format(n))
+    profiling.count('items', n)
+    with profiling.timer('inner', size=n):
+        profiling.count('inner_items')
+    return n
+
+def test_json_lines(metrics_file):
+    assert stage(3) == 3
+    inner, outer, counters = records(metrics_file)
+
+    assert inner['stage'] == 'inner'
+    assert inner['parent'] == 'stage'
+    assert inner['size'] == 3
+    assert inner['inner_items'] == 1
+
+    assert outer['stage'] == 'stage'
+    assert outer['template'] == 'template 3'
+    assert outer['items'] == 3
+    assert outer['wall_time'] >= inner['wall_time'] >= 0
+    assert outer['pid'] == os.getpid()
+
+    # Counter totals written when the outermost timer exits
+    assert counters['stage'] == 'counters'
+    assert (counters['items'], counters['inner_items']) == (3, 1)
+
+def test_counter_totals_per_task(metrics_file):
+    stage(1)
+    stage(2)
+    profiling.count('items', 10)
+    profiling.disable()
+    totals = [record for record in records(metrics_file)
+              if record['stage'] == 'counters']
+    assert sum(record['items'] for record in totals) == 13
+    assert sum(record.get('inner_items', 0) for record in totals) == 2
+
+def test_error_field(metrics_file):
+    with pytest.raises(KeyError):
+        with profiling.timer('failing'):
+            raise KeyError('missing')
+    (record,) = records(metrics_file)
+    assert record['error'] == 'KeyError'
+
+def test_summarize(metrics_file):
+    for n in range(3):
+        stage(n)
+    with open(metrics_file, 'a') as file:
+        # Truncated record
+        file.write('{"stage": "stage", "wall')
+    summary = profiling.summarize(metrics_file)
+    assert summary['stage']['calls'] == 3
+    assert summary['inner']['calls'] == 3
+    assert summary['stage']['max'] <= summary['stage']['total']
+
+def test_disabled(tmp_path):
+    assert not profiling.enabled()
+    assert stage(2) == 2
+    profiling.annotate(ignored=True)
+    profiling.count('ignored')
+    assert not os.listdir(str(tmp_path))
+
+    # Null timers do not share their fields
+    with profiling.timer('disabled') as first:
+        first.fields['key'] = 1
+    assert profiling.timer('disabled').fields == {}
+
+def test_reserved_field_names(metrics_file):
+    with profiling.timer('stage', pid=0):
+        profiling.annotate(wall_time=-1., stage='other', size=3)
+    with profiling.timer('counting'):
+        profiling.count('stage')
+    record, counting, counters = records(metrics_file)
+    assert record['stage'] == 'stage'
+    assert record['wall_time'] >= 0
+    assert record['pid'] == os.getpid()
+    assert record['size'] == 3
+    assert counting['stage'] == 'counting'
+    assert counters['stage'] == 'counters'
@@ -0,0 +1,109 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+import numpy
+import pytest
+
+import overlap
+import pursuit
+import tfcluster
+from conftest import dense_atom
+
+NUM_SAMPLES = 1024
+
+@pytest.fixture
+def layout(grid):
+    return tfcluster.CoefficientLayout(grid, NUM_SAMPLES)
+
+@pytest.fixture
+def table(grid, atoms):
+    return overlap.OverlapTable.build(grid, atoms, tol=1e-12)
+
+@pytest.fixture
+def dictionary(layout, grid, atoms):
+    """ Dense (atom x sample) dictionary, in the layout order """
+    return numpy.array([dense_atom(atoms, grid, NUM_SAMPLES,
+                                   *layout.unravel_index(index))
+                        for index in range(layout.size)])
+
+@pytest.fixture
+def signal(dictionary):
+    """ Sparse combination of atoms with a little noise """
+    rng = numpy.random.RandomState(1)
+    atoms = rng.randint(len(dictionary), size=6)
+    return numpy.dot(rng.randn(6), dictionary[atoms]) \
+        + 0.01 * rng.randn(NUM_SAMPLES)
+
+def test_queue_top_after_updates():
+    rng = numpy.random.RandomState(0)
+    priorities = rng.randn(37)
+    queue = pursuit.IndexedMaxQueue(priorities)
+    assert queue.top() == (numpy.argmax(priorities), priorities.max())
+
+    for _ in range(50):
+        keys = rng.choice(37, size=5, replace=False)
+        priorities[keys] = rng.randn(5)
+        queue.update(keys, priorities[keys])
+        key, priority = queue.top()
+        assert key == numpy.argmax(priorities)
+        assert priority == priorities.max()
+
+def test_queue_single_key():
+    queue = pursuit.IndexedMaxQueue([3.])
+    assert queue.top() == (0, 3.)
+    queue.update([0], [-1.])
+    assert queue.top() == (0, -1.)
+
+def test_atom_norms(layout, table, dictionary):
+    numpy.testing.assert_allclose(pursuit.atom_norms(layout, table),
+                                  numpy.sum(dictionary**2, axis=1), atol=1e-10)
+
+def test_matching_pursuit_matches_dense_pursuit(layout, table, dictionary, signal):
+    engine = pursuit.MatchingPursuit(layout, table)
+    energy = numpy.dot(signal, signal)
+    coeffs, residual, num_iter = engine.decompose(numpy.dot(dictionary, signal),
+                                                  energy, 0.01)
+
+    # Matching pursuit with the correlations of the residual recomputed
+    # at each iteration
+    norms = numpy.sum(dictionary**2, axis=1)
+    expected = numpy.zeros(layout.size)
+    remainder = signal.copy()
+    for _ in range(num_iter):
+        correlations = numpy.dot(dictionary, remainder)
+        index = numpy.argmax(correlations**2 / norms)
+        coefficient = correlations[index] / norms[index]
+        expected[index] += coefficient
+        remainder -= coefficient * dictionary[index]
+
+    numpy.testing.assert_allclose(coeffs, expected, atol=1e-4)
+    true_residual = signal - numpy.dot(coeffs, dictionary)
+    assert residual == pytest.approx(numpy.dot(true_residual, true_residual),
+                                     rel=1e-2)
+    assert residual <= 0.01 * energy
+
+def test_orthogonal_matching_pursuit_is_least_squares(layout, table, dictionary,
+                                                      signal):
+    engine = pursuit.OrthogonalMatchingPursuit(layout, table)
+    energy = numpy.dot(signal, signal)
+    coeffs, residual, num_iter = engine.decompose(numpy.dot(dictionary, signal),
+                                                  energy, 0.01)
+
+    # The coefficients of the selected atoms are the least-squares fit
+    selected = numpy.flatnonzero(coeffs)
+    assert 0 < selected.size <= num_iter
+    expected = numpy.linalg.lstsq(dictionary[selected].T, signal, rcond=None)[0]
+    numpy.testing.assert_allclose(coeffs[selected], expected, atol=1e-4)
+
+    true_residual = signal - numpy.dot(coeffs, dictionary)
+    assert residual == pytest.approx(numpy.dot(true_residual, true_residual),
+                                     rel=1e-2)
+    assert residual <= 0.01 * energy
+
+def test_orthogonal_matching_pursuit_max_iter(layout, table, dictionary, signal):
+    engine = pursuit.OrthogonalMatchingPursuit(layout, table)
+    coeffs, _, num_iter = engine.decompose(numpy.dot(dictionary, signal),
+                                           numpy.dot(signal, signal), 1e-6,
+                                           max_iter=20)
+    assert num_iter == 20
+    assert numpy.count_nonzero(coeffs) <= 20
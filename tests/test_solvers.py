@@ -0,0 +1,171 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+import collections
+import numpy
+import pytest
+
+import solvers
+import tfcluster
+
+Layout = collections.namedtuple('Layout', 'size num_samples')
+
+class DenseOperator(object):
+    """ Operator of a dense (sample x coefficient) matrix, with the
+    interface of watutils.WDMOperator """
+    def __init__(self, matrix, layout=None):
+        self.matrix = matrix
+        self.layout = layout or Layout(matrix.shape[1], matrix.shape[0])
+
+    def key(self):
+        return ('dense', id(self))
+
+    def analysis(self, signal, out=None):
+        result = numpy.dot(signal, self.matrix)
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+    def synthesis(self, coeffs, out=None):
+        result = numpy.dot(coeffs, self.matrix.T)
+        if out is None:
+            return result
+        out[...] = result
+        return out
+
+@pytest.fixture
+def operator():
+    return DenseOperator(numpy.random.RandomState(0).randn(40, 80) / numpy.sqrt(40))
+
+@pytest.fixture
+def signal(operator):
+    rng = numpy.random.RandomState(1)
+    coeffs = numpy.zeros(operator.layout.size)
+    coeffs[rng.choice(operator.layout.size, size=5, replace=False)] = rng.randn(5)
+    return operator.synthesis(coeffs) + 0.01 * rng.randn(operator.layout.num_samples)
+
+def test_soft_threshold():
+    coeffs = numpy.array([-3., -1., -0.5, 0., 0.5, 1., 3.])
+    expected = numpy.array([-2., 0., 0., 0., 0., 0., 2.])
+    numpy.testing.assert_array_equal(solvers.soft_threshold(coeffs, 1.), expected)
+
+    # In place
+    out = solvers.soft_threshold(coeffs, 1., out=coeffs)
+    assert out is coeffs
+    numpy.testing.assert_array_equal(coeffs, expected)
+
+def test_lipschitz_constant(operator):
+    assert solvers.lipschitz_constant(operator) \
+        == pytest.approx(numpy.linalg.norm(operator.matrix, 2)**2, rel=2e-3)
+    assert solvers.lipschitz_constant(operator) \
+        >= numpy.linalg.norm(operator.matrix, 2)**2
+
+@pytest.mark.parametrize('solver', ['fista', 'ista'])
+def test_solve_reaches_lasso_optimum(operator, signal, solver):
+    penalty = 0.05
+    coeffs, num_iter = solvers.ProximalBPDN(operator).solve(
+        signal, penalty, solver=solver, cv_threshold=1e-10, max_iter=100000)
+    assert num_iter < 100000
+
+    # Optimality conditions of min 1/2 ||y - A x||^2 + penalty ||x||_1
+    correlations = operator.analysis(signal - operator.synthesis(coeffs))
+    support = coeffs != 0
+    assert support.any()
+    numpy.testing.assert_allclose(correlations[support],
+                                  penalty * numpy.sign(coeffs[support]), atol=1e-5)
+    assert numpy.all(numpy.abs(correlations[~support]) <= penalty + 1e-5)
+
+def test_fista_faster_than_ista(operator, signal):
+    solver = solvers.ProximalBPDN(operator)
+    _, fista_iter = solver.solve(signal, 0.01, solver='fista', cv_threshold=1e-8)
+    _, ista_iter = solver.solve(signal, 0.01, solver='ista', cv_threshold=1e-8)
+    assert fista_iter < ista_iter
+
+def test_warm_start(operator, signal):
+    solver = solvers.ProximalBPDN(operator)
+    coeffs, cold_iter = solver.solve(signal, 0.05, cv_threshold=1e-8)
+    coeffs = coeffs.copy()
+    warm, warm_iter = solver.solve(signal, 0.05, x0=coeffs, cv_threshold=1e-8)
+    assert warm_iter < cold_iter
+    numpy.testing.assert_allclose(warm, coeffs, atol=1e-6)
+
+def test_decompose_reaches_approx_error(operator, signal):
+    coeffs, report = solvers.ProximalBPDN(operator).decompose(
+        signal, 0.01, 0.5, 2., 1e-6, 1e-4)
+    residual = signal - operator.synthesis(coeffs)
+    relative = numpy.dot(residual, residual) / numpy.dot(signal, signal)
+    assert relative <= 0.01
+    assert relative == pytest.approx(report['residual'], rel=1e-6)
+
+def test_decompose_batch_matches_decompose(operator, signal):
+    signals = numpy.array([signal, 0.5 * signal[::-1], numpy.roll(signal, 7)])
+    solver = solvers.ProximalBPDN(operator)
+    coeffs, report = solver.decompose_batch(signals, 0.01, 0.5, 2., 1e-6, 1e-4)
+    for (n, row) in enumerate(signals):
+        expected, expected_report = solver.decompose(row, 0.01, 0.5, 2., 1e-6, 1e-4)
+        numpy.testing.assert_allclose(coeffs[n], expected, atol=1e-10)
+        assert report['num_iter'][n] == expected_report['num_iter']
+
+# INIHT on a random dictionary with the coefficient layout of a grid
+
+INIHT_PARAMS = dict(approx_error=1e-8, start_pixels=2, step_pixels=1, kappa=2.,
+                    c=0.01, cv_threshold=1e-6, max_iter=2000)
+
+@pytest.fixture
+def grid_operator(grid):
+    layout = tfcluster.CoefficientLayout(grid, 64)
+    matrix = numpy.random.RandomState(2).randn(64, layout.size) / numpy.sqrt(64)
+    return DenseOperator(matrix, layout)
+
+def sparse_signal(operator, pixels, seed):
+    """ Signal synthesized from the coefficients (all parts) of a few pixels """
+    rng = numpy.random.RandomState(seed)
+    thresholder = solvers.PixelThresholder(operator.layout)
+    mask = numpy.zeros(thresholder.num_pixels, dtype=bool)
+    mask[rng.choice(mask.size, size=pixels, replace=False)] = True
+    coeffs = thresholder.apply(rng.randn(operator.layout.size), mask)
+    return operator.synthesis(coeffs), mask
+
+def test_pixel_thresholder_matches_full_sort(grid_operator):
+    thresholder = solvers.PixelThresholder(grid_operator.layout)
+    coeffs = numpy.random.RandomState(3).randn(4, grid_operator.layout.size)
+    energies = thresholder.energies(coeffs)
+    for num_pixels in (1, 7, 50, thresholder.num_pixels):
+        expected = numpy.zeros(energies.shape, dtype=bool)
+        for (row, order) in zip(expected, numpy.argsort(-energies, axis=1)):
+            row[order[:num_pixels]] = True
+        numpy.testing.assert_array_equal(thresholder.support(coeffs, num_pixels),
+                                         expected)
+        for (n, row) in enumerate(coeffs):
+            numpy.testing.assert_array_equal(thresholder.support(row, num_pixels),
+                                             expected[n])
+
+    # Per-row numbers of pixels
+    mask = thresholder.support(coeffs, numpy.array([0, 1, 5, 12]))
+    assert list(numpy.sum(mask, axis=1)) == [0, 1, 5, 12]
+
+def test_iniht_recovers_sparse_support(grid_operator):
+    signal, support = sparse_signal(grid_operator, 3, seed=4)
+    solver = solvers.IncreasingNIHT(grid_operator)
+    coeffs, report = solver.decompose(signal, **INIHT_PARAMS)
+    assert report['residual'] <= INIHT_PARAMS['approx_error']
+    assert report['num_pixels'] == 3
+    numpy.testing.assert_array_equal(solver.threshold.energies(coeffs) > 0, support)
+
+def test_iniht_invalid_step_reduction(grid_operator):
+    solver = solvers.IncreasingNIHT(grid_operator)
+    with pytest.raises(ValueError):
+        solver.decompose(numpy.ones(64), 0.01, 2, 1, kappa=1., c=0.01,
+                         cv_threshold=1e-6)
+
+def test_iniht_batch_matches_decompose(grid_operator):
+    signals = numpy.array([sparse_signal(grid_operator, pixels, seed)[0]
+                           for (pixels, seed) in ((3, 4), (2, 5), (5, 6))])
+    solver = solvers.IncreasingNIHT(grid_operator)
+    coeffs, report = solver.decompose_batch(signals, **INIHT_PARAMS)
+    for (n, row) in enumerate(signals):
+        expected, expected_report = solver.decompose(row, **INIHT_PARAMS)
+        numpy.testing.assert_allclose(coeffs[n], expected, atol=1e-10)
+        assert report['num_iter'][n] == expected_report['num_iter']
+        assert report['num_pixels'][n] == expected_report['num_pixels']
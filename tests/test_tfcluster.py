@@ -0,0 +1,132 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+import numpy
+import pytest
+
+import tfcluster
+from tfcluster import Cluster, ClusterSet, GridPoint
+
+@pytest.fixture
+def clusters():
+    """ Random clusters (with repeated keys, to check the ties) """
+    rng = numpy.random.RandomState(0)
+    out = []
+    for n in range(6):
+        size = rng.randint(12)
+        points = [GridPoint(int(rng.randint(3)), int(rng.randint(20)),
+                            int(rng.randint(9))) for _ in range(size)]
+        out.append(Cluster(points, rng.randn(size).tolist(), 'cluster {}'.format(n)))
+    return out
+
+def reference_key(ordering, grid):
+    """ Sort key of a (GridPoint, value) pair, in pure Python """
+    def key(item):
+        point, value = item
+        keys = {'scale': point.scale_index,
+                'time': point.time_index,
+                'frequency': point.freq_index,
+                'value': value,
+                'phys_time': point.time_index * grid.timescales[point.scale_index],
+                'phys_frequency': point.freq_index
+                                  / (2 * grid.timescales[point.scale_index])}
+        return tuple(-keys[name[1:]] if name.startswith('-') else keys[name]
+                     for name in ordering)
+    return key
+
+def test_pack_round_trip(clusters):
+    cluster_set = ClusterSet.from_clusters(clusters)
+    assert len(cluster_set) == len(clusters)
+    assert cluster_set.offsets[-1] == sum(len(c.grid_points) for c in clusters)
+    for (cluster, unpacked) in zip(clusters, cluster_set.to_clusters()):
+        assert tuple(unpacked.grid_points) == tuple(cluster.grid_points)
+        assert list(unpacked.values) == list(cluster.values)
+        assert unpacked.metadata == cluster.metadata
+
+def test_empty_set():
+    cluster_set = ClusterSet.from_clusters([])
+    assert len(cluster_set) == 0
+    assert cluster_set.to_clusters() == []
+
+@pytest.mark.parametrize('ordering', [['frequency', 'time'],
+                                      ['time', '-frequency'],
+                                      ['phys_time', '-value'],
+                                      ['phys_frequency', 'scale', 'time'],
+                                      ['scale', 'time', 'frequency']])
+def test_sort_clusters_matches_python_sort(clusters, grid, ordering):
+    for (cluster, result) in zip(clusters,
+                                 tfcluster.sort_clusters(clusters, ordering, grid)):
+        # Both sorts are stable: ties keep the original order
+        expected = sorted(zip(cluster.grid_points, cluster.values),
+                          key=reference_key(ordering, grid))
+        assert list(result.grid_points) == [point for (point, _) in expected]
+        assert list(result.values) == [value for (_, value) in expected]
+        assert result.metadata == cluster.metadata
+
+def test_order_keeps_pixels_in_their_cluster(clusters):
+    cluster_set = ClusterSet.from_clusters(clusters)
+    perm = cluster_set.order(['-value'])
+    numpy.testing.assert_array_equal(cluster_set.cluster_ids()[perm],
+                                     cluster_set.cluster_ids())
+
+def test_invalid_keys(clusters):
+    cluster_set = ClusterSet.from_clusters(clusters)
+    with pytest.raises(ValueError):
+        cluster_set.order(['energy'])
+    with pytest.raises(ValueError):
+        cluster_set.order(['phys_time'])
+
+def test_shift_clusters(clusters, grid):
+    scale_index_max = len(grid.timescales_exp) - 1
+    for (cluster, shifted) in zip(clusters, tfcluster.shift_clusters(clusters, grid, 3)):
+        for (point, moved) in zip(cluster.grid_points, shifted.grid_points):
+            assert (moved.scale_index, moved.freq_index) \
+                == (point.scale_index, point.freq_index)
+            assert moved.time_index \
+                == point.time_index + 3 * 2**(scale_index_max - point.scale_index)
+        assert list(shifted.values) == list(cluster.values)
+        assert shifted.metadata == cluster.metadata
+
+def test_shift_clusters_wraps(grid):
+    # 8 time bins at the largest scale
+    num_samples = 8 * 2**int(grid.timescales_exp[-1])
+    points = [GridPoint(0, 30, 1), GridPoint(1, 14, 2), GridPoint(2, 7, 3)]
+    (shifted,) = tfcluster.shift_clusters([Cluster(points, [1., 2., 3.], 'c')], grid,
+                                          1, num_samples)
+    assert [p.time_index for p in shifted.grid_points] == [2, 0, 0]
+
+    # A full turn is the identity
+    (shifted,) = tfcluster.shift_clusters([Cluster(points, [1., 2., 3.], 'c')], grid,
+                                          8, num_samples)
+    assert list(shifted.grid_points) == points
+
+def test_shift_clusters_odd_number_of_bins(grid):
+    num_samples = 7 * 2**int(grid.timescales_exp[-1])
+    with pytest.raises(ValueError):
+        tfcluster.shift_clusters([], grid, 1, num_samples)
+
+def test_time_shifted_clusters(grid):
+    from timeseries import Timeseries
+
+    step = 2**int(grid.timescales_exp[-1])
+    signal = Timeseries(numpy.arange(8. * step), 256., 0., 'template')
+    calls = []
+
+    def decompose(shifted_signal):
+        # One pixel at the sample of the maximum, on the largest scale
+        calls.append(shifted_signal)
+        peak = int(numpy.argmax(shifted_signal.data))
+        return Cluster([GridPoint(2, peak // step, peak % step)], [1.],
+                       shifted_signal.metadata)
+
+    shifts = [0, 1, step, step + 1, 3 * step + 1, 5]
+    clusters = tfcluster.time_shifted_clusters(signal, grid, shifts, decompose)
+
+    # One decomposition per distinct residual shift (0, 1 and 5)
+    assert len(calls) == 3
+    assert len(clusters) == len(shifts)
+    for (shift, cluster) in zip(shifts, clusters):
+        peak = (len(signal.data) - 1 + shift % step) % len(signal.data)
+        (point,) = cluster.grid_points
+        assert point.time_index == (peak // step + shift // step) % 8
+        assert point.freq_index == peak % step
@@ -0,0 +1,187 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+import numpy
+import pytest
+
+import timeseries
+from timeseries import Timeseries
+
+SAMPLING_FREQ = 256.
+
+@pytest.fixture
+def white_noise():
+    """ 64 s of white noise of standard deviation 3 """
+    rng = numpy.random.RandomState(0)
+    return Timeseries(3. * rng.randn(int(64 * SAMPLING_FREQ)), SAMPLING_FREQ)
+
+def test_welch_psd_normalization(white_noise):
+    frequencies, psd = timeseries.welch_psd(white_noise, 4.)
+    assert frequencies[0] == 0.
+    assert frequencies[-1] == SAMPLING_FREQ / 2.
+    # One-sided density of white noise: 2 sigma**2 / fs
+    variance = numpy.var(white_noise.data)
+    assert numpy.mean(psd[1:-1]) == pytest.approx(2. * variance / SAMPLING_FREQ,
+                                                  rel=0.01)
+
+def test_welch_psd_median(white_noise):
+    _, mean_psd = timeseries.welch_psd(white_noise, 4.)
+    _, median_psd = timeseries.welch_psd(white_noise, 4., average='median')
+    assert numpy.mean(median_psd[1:-1]) == pytest.approx(numpy.mean(mean_psd[1:-1]),
+                                                         rel=0.05)
+
+def test_welch_psd_segment_too_long(white_noise):
+    with pytest.raises(ValueError):
+        timeseries.welch_psd(white_noise, 128.)
+
+def test_psd_to_nrms_flat_psd():
+    frequencies = numpy.linspace(0., SAMPLING_FREQ / 2., 513)
+    psd = numpy.full(frequencies.size, 0.5)
+    for scale in (2, 3, 5):
+        nrms = timeseries.psd_to_nrms(frequencies, psd, SAMPLING_FREQ, scale)
+        assert nrms.shape == (2**scale + 1,)
+        numpy.testing.assert_allclose(nrms, numpy.sqrt(0.5 * SAMPLING_FREQ / 2.))
+
+def test_psd_to_nrms_band_average():
+    # The PSD steps from 1 to 4 at 64 Hz, the edge of two layers of
+    # bandwidth 16 Hz (scale 3): the layers take the PSD of their band
+    frequencies = numpy.linspace(0., SAMPLING_FREQ / 2., 4097)
+    psd = numpy.where(frequencies < 64., 1., 4.)
+    nrms = timeseries.psd_to_nrms(frequencies, psd, SAMPLING_FREQ, 3)
+    numpy.testing.assert_allclose(nrms[:4], numpy.sqrt(SAMPLING_FREQ / 2.), rtol=1e-3)
+    numpy.testing.assert_allclose(nrms[5:], numpy.sqrt(4 * SAMPLING_FREQ / 2.),
+                                  rtol=1e-3)
+
+def test_noise_nrms_of_white_noise(white_noise, grid):
+    nrms = timeseries.noise_nrms(white_noise, grid, 4.)
+    assert len(nrms) == len(grid.timescales_exp)
+    for (scale, layers) in zip(grid.timescales_exp, nrms):
+        assert layers.shape == (2**int(scale) + 1,)
+        # Standard deviation of the noise (the end layers hold half bands)
+        assert numpy.mean(layers[1:-1]**2) \
+            == pytest.approx(numpy.var(white_noise.data), rel=0.01)
+        numpy.testing.assert_allclose(layers[1:-1], 3., rtol=0.1)
+
+    # Computed once
+    assert timeseries.noise_nrms(white_noise, grid, 4.) is nrms
+
+def test_noise_nrms_sampling_freq_mismatch(white_noise, grid):
+    noise = Timeseries(white_noise.data, 2 * SAMPLING_FREQ)
+    with pytest.raises(ValueError):
+        timeseries.noise_nrms(noise, grid, 4.)
+
+def is_smooth(length):
+    """ True if length is a product of powers of 2, 3 and 5 """
+    for factor in (2, 3, 5):
+        while length % factor == 0:
+            length //= factor
+    return length == 1
+
+def test_fast_length():
+    for num_samples in range(1, 2000):
+        length = timeseries.fast_length(num_samples)
+        assert length >= num_samples and is_smooth(length)
+        # Smallest such length
+        assert not any(is_smooth(n) for n in range(num_samples, length))
+    assert timeseries.fast_length(1000) == 1000
+    assert timeseries.fast_length(1001) == 1024
+
+def test_fast_length_multiple():
+    for num_samples in range(1, 5000, 7):
+        length = timeseries.fast_length(num_samples, 96)
+        assert length >= num_samples and length % 96 == 0 and is_smooth(length)
+        # Smallest such length
+        assert not any(is_smooth(k) for k in range(-(-num_samples // 96), length // 96))
+
+def test_grid_fast_length(grid):
+    step = 2**int(grid.timescales_exp[-1])
+    for num_samples in (1, 100, 1000, 2560, 46337):
+        length = timeseries.grid_fast_length(num_samples, grid)
+        assert length >= num_samples and is_smooth(length)
+        # Even number of time bins at the largest scale
+        assert length % (2 * step) == 0
+
+def test_pad_to_fast_length(grid):
+    signal = Timeseries(numpy.arange(1000.), SAMPLING_FREQ, 2., 'template')
+    padded = timeseries.pad_to_fast_length(signal, grid)
+    assert len(padded.data) == timeseries.grid_fast_length(1000, grid)
+    numpy.testing.assert_array_equal(padded.data[:1000], signal.data)
+    assert not padded.data[1000:].any()
+    assert (padded.sampling_freq, padded.t0, padded.metadata) == \
+        (SAMPLING_FREQ, 2., 'template')
+
+    # Suitable lengths are kept as is
+    signal = Timeseries(numpy.ones(1024), SAMPLING_FREQ)
+    assert timeseries.pad_to_fast_length(signal, grid) is signal
+
+def test_pad_stage(grid):
+    import pipeline
+
+    signals = [Timeseries(numpy.ones(n), SAMPLING_FREQ) for n in (100, 1024, 3000)]
+    lengths = [len(s.data) for s in pipeline.pad_stage(grid)(signals)]
+    assert lengths == [timeseries.grid_fast_length(n, grid) for n in (100, 1024, 3000)]
+
+def test_upfirdn_matches_direct_convolution():
+    rng = numpy.random.RandomState(2)
+    signal, fir = rng.randn(300), rng.randn(31)
+    upsampled = numpy.zeros(3 * signal.size)
+    upsampled[::3] = signal
+    expected = numpy.convolve(fir, upsampled)[::2]
+    numpy.testing.assert_allclose(timeseries.upfirdn(signal, fir, 3, 2), expected,
+                                  atol=1e-10)
+
+def test_resample():
+    t = numpy.arange(1024) / 512.
+    data = numpy.sin(2 * numpy.pi * 10. * t)
+    # The factors are reduced (256/512 = 1/2)
+    resampled, fir = timeseries.resample(data, 256, 512)
+    assert len(resampled) == 512
+    numpy.testing.assert_allclose(resampled[50:-50], data[::2][50:-50], atol=1e-3)
+
+    # The filter is reused
+    again, _ = timeseries.resample(data, 1, 2, fir)
+    numpy.testing.assert_array_equal(again, resampled)
+
+@pytest.fixture
+def template_file(tmp_path):
+    templates = [Timeseries(numpy.arange(n, dtype=float), SAMPLING_FREQ, 0.,
+                            'template {}'.format(n)) for n in (10, 25, 7)]
+    filename = str(tmp_path / 'templates.hdf')
+    timeseries.write_timeseries(filename, templates, 'test bank')
+    return filename
+
+def test_shared_templates(template_file):
+    pytest.importorskip('multiprocessing.shared_memory')
+    import pickle
+
+    name = timeseries.shared_bank_name(template_file)
+    bank = timeseries.share_templates(template_file)
+    try:
+        assert bank.owner and bank.name == name
+        # Already created: attached
+        other = timeseries.share_templates(template_file)
+        assert not other.owner
+        other.close()
+
+        expected, infos = timeseries.read_timeseries(template_file)
+        shared, shared_infos = timeseries.load_shared_templates(template_file)
+        assert shared_infos == infos
+        for (ts, ref) in zip(shared, expected):
+            numpy.testing.assert_array_equal(ts.data, ref.data)
+            assert (ts.sampling_freq, ts.metadata) == (ref.sampling_freq, ref.metadata)
+            assert not ts.data.flags.writeable
+
+        # Pickled as the name of the block
+        copy = pickle.loads(pickle.dumps(bank))
+        numpy.testing.assert_array_equal(copy[1].data, expected[1].data)
+        copy.close()
+        del shared, ts
+    finally:
+        timeseries._SHARED_BANKS.pop(name).close()
+        bank.close()
+        bank.unlink()
+
+def test_load_shared_templates_without_block(template_file):
+    shared, infos = timeseries.load_shared_templates(template_file, 'wg_no_block')
+    assert [len(ts.data) for ts in shared] == [10, 25, 7]
+    assert 'wg_no_block' not in timeseries._SHARED_BANKS
@@ -0,0 +1,251 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+import numpy
+import pytest
+
+import watutils
+
+FRACTIONS = [0.5, 0.9, 0.99]
+
+def random_map(shape, seed):
+    return numpy.random.RandomState(seed).exponential(size=shape)**3
+
+def dense_selection(tfmap, energy_fraction):
+    """ Reference: fewest pixels of largest energy, from a full sort """
+    energies = tfmap.ravel()
+    order = numpy.argsort(energies)[::-1]
+    count = int(numpy.searchsorted(numpy.cumsum(energies[order]),
+                                   energy_fraction * numpy.sum(energies))) + 1
+    return order[:count]
+
+def line_maps(grid, num_samples, seed=0):
+    """ Energy maps of a drifting line over a weak background, one per scale """
+    rng = numpy.random.RandomState(seed)
+    tfmaps = []
+    for exponent in grid.timescales_exp:
+        num_layers = 2**int(exponent)
+        times = (numpy.arange(num_samples // num_layers) + 0.5) * num_layers
+        line = (0.1 + 0.3 * times / num_samples) * num_layers
+        tfmap = numpy.exp(-0.5 * (numpy.arange(num_layers + 1)[:, None] - line)**2)
+        tfmaps.append(tfmap + 1e-4 * rng.exponential(size=tfmap.shape))
+    return tfmaps
+
+@pytest.mark.parametrize('energy_fraction', FRACTIONS)
+def test_sparse_energy_map_matches_dense_reference(energy_fraction):
+    for seed in range(5):
+        tfmap = random_map((17, 40), seed)
+        sparse_map = watutils.sparse_energy_map(tfmap, energy_fraction)
+        expected = dense_selection(tfmap, energy_fraction)
+        numpy.testing.assert_array_equal(sparse_map.keys, expected)
+        numpy.testing.assert_array_equal(sparse_map.energies, tfmap.ravel()[expected])
+        assert numpy.sum(sparse_map.energies) >= energy_fraction * numpy.sum(tfmap)
+        numpy.testing.assert_array_equal(sparse_map.todense() > 0,
+                                         numpy.isin(numpy.arange(tfmap.size),
+                                                    expected).reshape(tfmap.shape))
+
+def test_largest_energies_start_count():
+    energies = random_map(500, 0)
+    target = 0.8 * numpy.sum(energies)
+    expected = watutils._largest_energies(energies, target, 500)
+    for start_count in (0, 1, 3, 40, 499, 10000):
+        numpy.testing.assert_array_equal(
+            watutils._largest_energies(energies, target, start_count), expected)
+
+def test_sparse_energy_map_empty():
+    for tfmap in (numpy.zeros((5, 8)), numpy.zeros((0, 8))):
+        sparse_map = watutils.sparse_energy_map(tfmap, 0.9)
+        assert sparse_map.keys.size == 0 and sparse_map.shape == tfmap.shape
+
+@pytest.mark.parametrize('energy_fraction', FRACTIONS)
+def test_energy_pyramid_holds_energy_fraction(energy_fraction):
+    for (shape, seed) in (((17, 40), 0), ((33, 64), 1), ((9, 1000), 2)):
+        tfmap = random_map(shape, seed)
+        sparse_map = watutils.EnergyPyramid(tfmap, top_size=16).select(energy_fraction)
+        assert numpy.sum(sparse_map.energies) >= energy_fraction * numpy.sum(tfmap)
+        numpy.testing.assert_array_equal(sparse_map.energies,
+                                         tfmap.ravel()[sparse_map.keys])
+        assert numpy.unique(sparse_map.keys).size == sparse_map.keys.size
+        assert numpy.all(numpy.diff(sparse_map.energies) <= 0)
+        # Never fewer pixels than the optimal selection
+        assert sparse_map.keys.size >= dense_selection(tfmap, energy_fraction).size
+
+def test_project_support():
+    # A plane with twice fewer time bins has twice more frequency layers
+    sparse_map = watutils.SparseTFMap((9, 4), numpy.array([4 * 4 + 1]),
+                                      numpy.array([1.]))
+    support = watutils.project_support(sparse_map, (5, 8), margin=0)
+    assert set(zip(*numpy.nonzero(support))) == set([(2, 2), (2, 3)])
+
+    # Frequency between two layers of the finer plane: both are kept
+    sparse_map = watutils.SparseTFMap((17, 4), numpy.array([3 * 4 + 3]),
+                                      numpy.array([1.]))
+    support = watutils.project_support(sparse_map, (5, 16), margin=0)
+    assert set(zip(*numpy.nonzero(support))) \
+        == set((f, t) for f in (0, 1) for t in range(12, 16))
+
+    # Dilation by one pixel, wrapped around in time
+    support = watutils.project_support(sparse_map, (5, 16), margin=1)
+    freqs, times = numpy.nonzero(support)
+    assert (freqs.min(), freqs.max()) == (0, 2)
+    assert set(times) == set([11, 12, 13, 14, 15, 0])
+
+    with pytest.raises(ValueError):
+        watutils.project_support(sparse_map, (33, 2))
+
+@pytest.mark.parametrize('energy_fraction', FRACTIONS)
+def test_coarse_to_fine_holds_energy_fraction(grid, energy_fraction):
+    tfmaps = [random_map((2**int(s) + 1, 256 // 2**int(s)), k)
+              for (k, s) in enumerate(grid.timescales_exp)]
+    for (tfmap, sparse_map) in zip(tfmaps, watutils.coarse_to_fine_energy_maps(
+            tfmaps, energy_fraction, top_size=16)):
+        assert sparse_map.shape == tfmap.shape
+        assert numpy.sum(sparse_map.energies) >= energy_fraction * numpy.sum(tfmap)
+
+@pytest.mark.parametrize('energy_fraction', FRACTIONS)
+def test_coarse_to_fine_matches_exhaustive_search(grid, energy_fraction):
+    # The energy of each plane lies around the pixels of the coarser plane:
+    # restricting the search to them captures the energy of the exhaustive
+    # search, with about as many pixels. The pixels are the same when the
+    # support holds all the pixels of the exhaustive search
+    tfmaps = line_maps(grid, 4096)
+    for (tfmap, sparse_map) in zip(tfmaps, watutils.coarse_to_fine_energy_maps(
+            tfmaps, energy_fraction)):
+        reference = watutils.sparse_energy_map(tfmap, energy_fraction)
+        assert numpy.sum(sparse_map.energies) \
+            == pytest.approx(numpy.sum(reference.energies), rel=0.01)
+        assert sparse_map.keys.size == pytest.approx(reference.keys.size, rel=0.01)
+        assert numpy.sum(sparse_map.energies) >= energy_fraction * numpy.sum(tfmap)
+
+def test_coarse_to_fine_selects_exhaustive_pixels(grid):
+    tfmaps = line_maps(grid, 4096)
+    coarse_to_fine = watutils.coarse_to_fine_energy_maps(tfmaps, 0.9)
+    # The coarsest plane is searched with a pyramid: only the finer planes
+    for k in range(len(tfmaps) - 1):
+        numpy.testing.assert_array_equal(
+            coarse_to_fine[k].keys, watutils.sparse_energy_map(tfmaps[k], 0.9).keys)
+
+class FakeWDMType(object):
+    """ WDM type with the number of layers only """
+    def __init__(self, num_layers):
+        self.m_Layer = num_layers
+
+def fake_blocks(coefficients):
+    """ wdm_blocks() yielding the blocks of given (direct, dual) coefficients """
+    def wdm_blocks(signal, wdm_type, block_times):
+        direct, dual = coefficients[wdm_type.m_Layer]
+        block_times += block_times % 2
+        for start in range(0, direct.shape[1], block_times):
+            # The blocks are work arrays, overwritten by the caller
+            yield start, direct[:, start:start + block_times].copy(), \
+                  dual[:, start:start + block_times].copy()
+    return wdm_blocks
+
+@pytest.mark.parametrize('energy_fraction', FRACTIONS)
+def test_wdm_transform_blocked_sparse(monkeypatch, energy_fraction):
+    rng = numpy.random.RandomState(0)
+    num_samples = 1024
+    coefficients = {}
+    for num_layers in (4, 8, 16):
+        shape = (num_layers + 1, num_samples // num_layers)
+        coefficients[num_layers] = (rng.randn(*shape)**3, rng.randn(*shape))
+    wdm_types = [FakeWDMType(n) for n in sorted(coefficients)]
+    monkeypatch.setattr(watutils, 'wdm_blocks', fake_blocks(coefficients))
+    monkeypatch.setattr(watutils, '_as_WDM_types', lambda wdm_types: wdm_types)
+
+    signal = numpy.zeros(num_samples)
+    dense = watutils.wdm_transform_blocked(signal, wdm_types, 80)
+    sparse = watutils.wdm_transform_blocked(signal, wdm_types, 80, energy_fraction)
+    for (wdm_type, tfmap, sparse_map) in zip(wdm_types, dense, sparse):
+        direct, dual = coefficients[wdm_type.m_Layer]
+        numpy.testing.assert_array_equal(tfmap, dual * dual + direct * direct)
+
+        assert sparse_map.shape == tfmap.shape
+        numpy.testing.assert_array_equal(sparse_map.energies,
+                                         tfmap.ravel()[sparse_map.keys])
+        assert numpy.unique(sparse_map.keys).size == sparse_map.keys.size
+        assert numpy.sum(sparse_map.energies) >= energy_fraction * numpy.sum(tfmap)
+        # Never fewer pixels than the selection on the dense map
+        assert sparse_map.keys.size >= dense_selection(tfmap, energy_fraction).size
+
+def test_load_nrms_text_and_numpy(tmp_path):
+    nrms = numpy.linspace(1., 2., 9)
+    frequencies = numpy.linspace(0., 128., 9)
+
+    filename = str(tmp_path / 'nrms.txt')
+    numpy.savetxt(filename, nrms)
+    loaded, loaded_freqs = watutils.load_nrms_with_frequencies(filename)
+    numpy.testing.assert_allclose(loaded, nrms)
+    assert loaded_freqs is None
+    numpy.testing.assert_allclose(watutils.load_nrms(filename), nrms)
+
+    for name in ('nrms.txt.gz', 'nrms.npy'):
+        filename = str(tmp_path / name)
+        columns = numpy.column_stack((frequencies, nrms))
+        if name.endswith('.npy'):
+            numpy.save(filename, columns)
+        else:
+            numpy.savetxt(filename, columns)
+        loaded, loaded_freqs = watutils.load_nrms_with_frequencies(filename)
+        numpy.testing.assert_allclose(loaded, nrms)
+        numpy.testing.assert_allclose(loaded_freqs, frequencies)
+        numpy.testing.assert_allclose(watutils.load_nrms(filename), nrms)
+
+    filename = str(tmp_path / 'three_columns.txt')
+    numpy.savetxt(filename, numpy.ones((4, 3)))
+    with pytest.raises(ValueError):
+        watutils.load_nrms(filename)
+
+def test_load_nrms_hdf5(tmp_path):
+    h5py = pytest.importorskip('h5py')
+    nrms = numpy.linspace(1., 2., 9)
+    frequencies = numpy.linspace(0., 128., 9)
+    filename = str(tmp_path / 'nrms.hdf5')
+    with h5py.File(filename, 'w') as file:
+        file['nrms'] = nrms
+        file['H1'] = 2 * nrms
+        file['frequency'] = frequencies
+
+    loaded, loaded_freqs = watutils.load_nrms_with_frequencies(filename)
+    numpy.testing.assert_array_equal(loaded, nrms)
+    numpy.testing.assert_array_equal(loaded_freqs, frequencies)
+    numpy.testing.assert_array_equal(watutils.load_nrms(filename, 'H1'), 2 * nrms)
+
+def test_load_nrms_errors(tmp_path):
+    with pytest.raises(Exception, match='not found'):
+        watutils.load_nrms(str(tmp_path / 'missing.txt'))
+    filename = tmp_path / 'nrms.csv'
+    filename.write_text('1\n2\n')
+    with pytest.raises(Exception, match='Unsupported'):
+        watutils.load_nrms(str(filename))
+
+def test_nrms_on_grid(grid):
+    # Linear spectra are interpolated exactly
+    nyquist = grid.sampling_freq / 2.
+    frequencies = numpy.array([0., 20., 50., nyquist])
+    nrms = 1. + frequencies / nyquist
+    for (scale, layers) in zip(grid.timescales_exp,
+                               watutils.nrms_on_grid(nrms, grid, frequencies)):
+        expected = 1. + numpy.linspace(0., 1., 2**int(scale) + 1)
+        numpy.testing.assert_allclose(layers, expected)
+
+    # Without frequencies, the values are regularly spaced up to the
+    # Nyquist frequency: those of the finest layers are kept
+    nrms = numpy.random.RandomState(0).rand(2**int(grid.timescales_exp[-1]) + 1)
+    layers = watutils.nrms_on_grid(nrms, grid)
+    numpy.testing.assert_allclose(layers[-1], nrms)
+    numpy.testing.assert_allclose(layers[0], nrms[::4])
+
+def test_get_grid_nrms(grid, tmp_path):
+    nyquist = grid.sampling_freq / 2.
+    frequencies = numpy.linspace(0., nyquist, 5)
+    filename = str(tmp_path / 'nrms.txt')
+    numpy.savetxt(filename, numpy.column_stack((frequencies, 2. + frequencies)))
+
+    grid_nrms = watutils.get_grid_nrms(filename, grid)
+    assert len(grid_nrms) == len(grid.timescales_exp)
+    for (scale, layers) in zip(grid.timescales_exp, grid_nrms):
+        numpy.testing.assert_allclose(layers,
+                                      2. + numpy.linspace(0., nyquist, 2**int(scale) + 1))
+    # Loaded once per file and grid
+    assert watutils.get_grid_nrms(filename, grid) is grid_nrms
@@ -0,0 +1,224 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+# Content-addressed cache of the artifacts of the processing stages
+# (signals, clusters, graph). The key of an artifact is computed from
+# the content hashes of the inputs of the stage and from its parameters,
+# so that a stage is only recomputed when one of them changes.
+
+import os
+import json
+import shutil
+import pickle
+import hashlib
+import logging
+import collections
+
+# Content hashes of files already computed in this process, indexed by
+# (path, size, modification time)
+_FILE_HASHES = {}
+
+def file_hash(filename):
+    """ Return the sha256 hash of the content of a file """
+    if not os.path.isfile(filename):
+        raise Exception('File {} not found'.format(filename))
+
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    if key not in _FILE_HASHES:
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        _FILE_HASHES[key] = digest.hexdigest()
+    return _FILE_HASHES[key]
+
+def timeseries_hash(signals):
+    """ Return the sha256 hash of the content of a list of Timeseries """
+    digest = hashlib.sha256()
+    for signal in signals:
+        digest.update(repr((len(signal.data), signal.sampling_freq, signal.t0,
+                            signal.metadata)).encode('utf-8'))
+        digest.update(signal.data.tobytes())
+    return digest.hexdigest()
+
+def items_hash(items):
+    """
+    Return the sha256 hash of the content of a list of pipeline items
+    (Timeseries, or any picklable objects such as Clusters).
+    """
+    if all(hasattr(item, 'data') and hasattr(item, 'sampling_freq') for item in items):
+        return timeseries_hash(items)
+    return hashlib.sha256(pickle.dumps(list(items), protocol=2)).hexdigest()
+
+def params_string(params):
+    """
+    Return the canonical string of stage parameters: a string is taken
+    as is (e.g. the params string stored by tfcluster.write_clusters()),
+    and a dictionary is serialized with sorted keys.
+    """
+    if isinstance(params, dict):
+        return json.dumps(params, sort_keys=True, default=repr)
+    return str(params)
+
+def stage_key(stage, input_hashes, params):
+    """
+    Return the cache key of an artifact.
+
+    Inputs
+    ------
+    stage [str] -- stage name (e.g. 'signals', 'clusters', 'graph')
+    input_hashes [list] -- content hashes of the inputs of the stage
+    params [str/dict] -- parameters of the stage
+    """
+    digest = hashlib.sha256()
+    digest.update(stage.encode('utf-8'))
+    for value in input_hashes:
+        digest.update(b'\0' + value.encode('utf-8'))
+    digest.update(b'\0' + params_string(params).encode('utf-8'))
+    return digest.hexdigest()
+
+class StageCache(object):
+    """
+    Local directory of stage artifacts indexed by content-addressed keys.
+
+    The total size of the cache is bounded: when it is exceeded, the
+    least recently used artifacts are evicted. The numbers of hits and
+    misses are counted per stage.
+
+    Main attributes:
+    ----------------
+    directory -- cache directory
+    max_size  -- maximum total size of the artifacts [bytes] (None: unbounded)
+    hits, misses -- counts of cache hits and misses per stage
+    """
+    def __init__(self, directory, max_size=None):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key, extension=''):
+        """ Return the path of the artifact of a key """
+        return os.path.join(self.directory, key[:2], key + extension)
+
+    def lookup(self, stage, key, extension=''):
+        """
+        Return the path of the artifact of a key, or None if it is not
+        in the cache. The artifact is marked as recently used.
+        """
+        path = self.path(key, extension)
+        if os.path.isfile(path):
+            os.utime(path, None)
+            self.hits[stage] += 1
+            logging.debug('Cache hit for stage {} ({})'.format(stage, key[:12]))
+            return path
+        self.misses[stage] += 1
+        logging.debug('Cache miss for stage {} ({})'.format(stage, key[:12]))
+        return None
+
+    def store(self, key, filename, extension=''):
+        """ Copy an artifact into the cache and return its path """
+        path = self.path(key, extension)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Copy then rename, so that an interrupted copy is never used
+        shutil.copyfile(filename, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        self.evict()
+        return path
+
+    def artifacts(self):
+        """ Return the (last use time, size, path) of all the artifacts """
+        out = []
+        for (root, _, files) in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                out.append((stat.st_mtime, stat.st_size, path))
+        return out
+
+    def evict(self):
+        """ Remove the least recently used artifacts beyond the maximum size """
+        if self.max_size is None:
+            return
+        artifacts = sorted(self.artifacts())
+        size = sum(a[1] for a in artifacts)
+        for (_, artifact_size, path) in artifacts:
+            if size <= self.max_size:
+                break
+            os.remove(path)
+            size -= artifact_size
+            logging.debug('Evicted {} from the cache'.format(path))
+
+    def run(self, stage, input_files, params, output, compute):
+        """
+        Produce the output file of a stage, from the cache if possible.
+
+        Inputs
+        ------
+        stage [str] -- stage name
+        input_files [list] -- input files of the stage
+        params [str/dict] -- parameters of the stage
+        output [str] -- output file of the stage
+        compute [function] -- called with output to compute the artifact
+
+        Output
+        ------
+        hit [bool] -- True if the output was taken from the cache
+        """
+        key = stage_key(stage, [file_hash(f) for f in input_files], params)
+        extension = os.path.splitext(output)[1]
+        path = self.lookup(stage, key, extension)
+        if path is not None:
+            shutil.copyfile(path, output)
+            return True
+        compute(output)
+        self.store(key, output, extension)
+        return False
+
+    def memoize(self, stage, input_hashes, params, compute):
+        """
+        Return the (picklable) result of a stage of an in-memory pipeline,
+        from the cache if possible.
+
+        Inputs
+        ------
+        stage [str] -- stage name
+        input_hashes [list] -- content hashes of the inputs (see timeseries_hash())
+        params [str/dict] -- parameters of the stage
+        compute [function] -- called without argument to compute the result
+        """
+        key = stage_key(stage, input_hashes, params)
+        path = self.lookup(stage, key, '.pickle')
+        if path is not None:
+            with open(path, 'rb') as file:
+                return pickle.load(file)
+        result = compute()
+        path = self.path(key, '.pickle')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'wb') as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+        self.evict()
+        return result
+
+    def report(self):
+        """ Return the numbers of hits and misses per stage, and the cache size """
+        stages = sorted(set(self.hits) | set(self.misses))
+        return {'stages': dict((s, {'hits': self.hits[s], 'misses': self.misses[s]})
+                               for s in stages),
+                'size': sum(a[1] for a in self.artifacts())}
+
+    def log_report(self):
+        """ Log the report of the cache """
+        report = self.report()
+        for (stage, counts) in sorted(report['stages'].items()):
+            logging.info('Cache {}: {} hits, {} misses'.format(
+                stage, counts['hits'], counts['misses']))
+        logging.info('Cache size: {} bytes'.format(report['size']))
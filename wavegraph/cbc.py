@@ -5,20 +5,31 @@
 
 import logging
 
-import lalsimulation
-from lalsimulation.lalsimulation import SimInspiralCreateWaveformFlags
-from lalsimulation.lalsimulation import GetApproximantFromString
-from lalsimulation.lalsimulation import SimInspiralTD
-
-from lal.lal import MSUN_SI as LAL_MSUN_SI   # kg -- mass of the Sun
-from lal.lal import PC_SI as LAL_PC_SI       # m -- parsec
-from lal.lal import C_SI as LAL_C_SI         # m s^-1 -- speed of light
-from lal.lal import G_SI as LAL_G_SI         # m^3 kg^-1 s^-2 -- gravitational constant
+# LAL is only imported when a waveform is generated, so that the
+# parsing of template descriptions does not load it
 
 LIMIT_ECCENTRICITY = 0.62
 
 PARSER_STR = 'm1={mass1}, m2={mass2}, spin1z={spin1z}, spin2z={spin2z}, ecc={eccentricity}'
 
+def chirp_mass(mass1, mass2):
+    """ Returns the chirp mass of a binary [same unit as the masses] """
+    return (mass1 * mass2)**0.6 / (mass1 + mass2)**0.2
+
+def parse_description(description):
+    """
+    Returns the CompactBinaryCoalescence object described by a string
+    formatted with PARSER_STR (e.g. the metadata of CBC templates), or
+    None if the string does not follow that format.
+    """
+    try:
+        fields = dict(item.strip().split('=') for item in description.split(','))
+        return CompactBinaryCoalescence(fields['m1'], fields['m2'],
+                                        fields['spin1z'], fields['spin2z'],
+                                        fields.get('ecc', 0))
+    except (AttributeError, KeyError, ValueError):
+        return None
+
 class CompactBinaryCoalescence(object):
     """
     A CompactBinaryCoalescence object characterises the gravitational
@@ -43,6 +54,10 @@ class CompactBinaryCoalescence(object):
         """ Returns all attributes """
         return self.mass1, self.mass2, self.spin1z, self.spin2z, self.eccentricity
     
+    def chirp_mass(self):
+        """ Returns the chirp mass [Msun] """
+        return chirp_mass(self.mass1, self.mass2)
+
     def __str__(self):
         """ Print all attributes """
         return PARSER_STR.format(mass1=self.mass1, mass2=self.mass2,
@@ -92,6 +107,11 @@ class CompactBinaryCoalescence(object):
         f_ref = 0.                                    # reference GW frequency, Hz
         LALparams = None                              # LAL dictionary containing accessory parameters
 
+        from lalsimulation.lalsimulation import GetApproximantFromString
+        from lalsimulation.lalsimulation import SimInspiralTD
+        from lal.lal import MSUN_SI as LAL_MSUN_SI   # kg -- mass of the Sun
+        from lal.lal import PC_SI as LAL_PC_SI       # m -- parsec
+
         # Initialize approximant
         approximant_flag = GetApproximantFromString(approximant)
         
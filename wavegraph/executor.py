@@ -0,0 +1,224 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+# Local execution of the jobs of an argument file (one job per line, as
+# submitted to Condor queues) on a pool of worker processes. Completed
+# jobs are recorded in a manifest, so that an interrupted run resumes
+# where it left off, and failed jobs are retried. The executor can also
+# hold the template bank of the jobs in shared memory for the duration
+# of the run (see timeseries.share_templates()).
+
+import os
+import sys
+import json
+import time
+import shlex
+import hashlib
+import logging
+import argparse
+import subprocess
+import multiprocessing
+
+LOGGING_FMT = "%(levelname)s -- %(filename)s:line %(lineno)s in %(funcName)s(): %(message)s"
+
+def read_argument_file(filename):
+    """
+    Read the jobs of an argument file: one line of arguments per job.
+    Blank lines and lines starting with # are ignored.
+
+    Input
+    -----
+    filename [str] -- argument file
+
+    Output
+    ------
+    jobs [list] -- list of argument strings
+    """
+    if not os.path.isfile(filename):
+        raise Exception('File {} not found'.format(filename))
+
+    with open(filename) as file:
+        lines = [line.strip() for line in file]
+    return [line for line in lines if line and not line.startswith('#')]
+
+def job_id(command, arguments):
+    """
+    Return the identifier of a job: hash of its command (list of strings)
+    and of its arguments, so that the jobs of the same argument file run
+    with another command are not taken as completed.
+    """
+    key = json.dumps([list(command), arguments])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+def read_manifest(filename):
+    """
+    Return the identifiers of the completed jobs recorded in a manifest
+    (JSON lines file, one record per job attempt).
+    """
+    completed = set()
+    if not os.path.isfile(filename):
+        return completed
+    with open(filename) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Line truncated by an interruption
+                continue
+            if record.get('status') == 'done':
+                completed.add(record['job'])
+    return completed
+
+def _run_job(job):
+    """
+    Run a job in a worker process and return its record. A job whose
+    command cannot be started (or whose log files cannot be opened)
+    fails with the error in its record, instead of stopping the pool.
+    """
+    (identifier, command, arguments, attempt, log_dir) = job
+    start = time.time()
+    record = {'job': identifier,
+              'arguments': arguments,
+              'attempt': attempt}
+    try:
+        if log_dir is None:
+            returncode = subprocess.call(command + shlex.split(arguments))
+        else:
+            basename = os.path.join(log_dir, '{}.{}'.format(identifier, attempt))
+            with open(basename + '.out', 'w') as out, \
+                 open(basename + '.err', 'w') as err:
+                returncode = subprocess.call(command + shlex.split(arguments),
+                                             stdout=out, stderr=err)
+    except OSError as error:
+        record.update(returncode=None, status='failed', error=str(error))
+    else:
+        record.update(returncode=returncode,
+                      status='done' if returncode == 0 else 'failed')
+    record['duration'] = time.time() - start
+    return record
+
+class LocalExecutor(object):
+    """
+    Executor of the jobs of an argument file on a local pool of worker
+    processes, with checkpoint/resume and retries.
+
+    Each job runs command followed by the arguments of its line, exactly
+    as a Condor job of the same argument file, so that the outputs are
+    identical. Every attempt is appended to the manifest as soon as it
+    ends.
+
+    Main attributes:
+    ----------------
+    command     -- command (list of strings) run by each job
+    num_workers -- number of worker processes
+    manifest    -- manifest file
+    max_retries -- maximum number of retries of a failed job
+    log_dir     -- directory of the output and error files of the jobs
+                   (None to inherit the standard output and error)
+    template_bank -- .hdf template file packed into shared memory for the
+                   jobs, which load it with timeseries.load_shared_templates()
+                   (None for no shared memory)
+    """
+    def __init__(self, command, num_workers=None, manifest='jobs.manifest',
+                 max_retries=2, log_dir=None, template_bank=None):
+        self.command = shlex.split(command) if isinstance(command, str) \
+                       else list(command)
+        self.num_workers = num_workers or multiprocessing.cpu_count()
+        self.manifest = manifest
+        self.max_retries = max_retries
+        self.log_dir = log_dir
+        self.template_bank = template_bank
+        if log_dir is not None and not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+
+    def run(self, jobs):
+        """
+        Run the jobs not yet completed according to the manifest.
+
+        Input
+        -----
+        jobs [list] -- list of argument strings
+
+        Output
+        ------
+        failed [list] -- argument strings of the jobs that still fail
+                         after all the retries
+        """
+        completed = read_manifest(self.manifest)
+        pending = {}
+        for arguments in jobs:
+            identifier = job_id(self.command, arguments)
+            if identifier not in completed:
+                pending[identifier] = arguments
+
+        logging.info('{} jobs, {} already completed, {} workers'.format(
+            len(jobs), len(jobs) - len(pending), self.num_workers))
+
+        # The shared memory block of the templates is created before the
+        # jobs and destroyed after them
+        bank = None
+        if pending and self.template_bank is not None:
+            import timeseries
+            bank = timeseries.share_templates(self.template_bank)
+
+        pool = multiprocessing.Pool(self.num_workers)
+        try:
+            attempt = 0
+            while pending and attempt <= self.max_retries:
+                tasks = [(identifier, self.command, arguments, attempt, self.log_dir)
+                         for (identifier, arguments) in sorted(pending.items())]
+                with open(self.manifest, 'a') as manifest:
+                    for record in pool.imap_unordered(_run_job, tasks):
+                        manifest.write(json.dumps(record) + '\n')
+                        manifest.flush()
+                        if record['status'] == 'done':
+                            del pending[record['job']]
+                        else:
+                            logging.warning('Job {} failed (attempt {}, {})'.format(
+                                record['job'], attempt,
+                                record.get('error') or 'return code {}'.format(
+                                    record['returncode'])))
+                attempt += 1
+        finally:
+            pool.close()
+            pool.join()
+            if bank is not None:
+                bank.close()
+                if bank.owner:
+                    bank.unlink()
+
+        if pending:
+            logging.error('{} jobs failed after {} retries'.format(
+                len(pending), self.max_retries))
+        return sorted(pending.values())
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the jobs of an argument file on local worker processes')
+    parser.add_argument('--argument-file', required=True,
+                        help='argument file (one job per line)')
+    parser.add_argument('--command', required=True,
+                        help='command run by each job, e.g. wgclusters')
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--manifest', default=None,
+                        help='manifest file (default: argument file + .manifest)')
+    parser.add_argument('--max-retries', type=int, default=2)
+    parser.add_argument('--log-dir', default=None,
+                        help='directory of the output and error files of the jobs')
+    parser.add_argument('--template-bank', default=None,
+                        help='.hdf template file held in shared memory for '
+                        'the jobs during the run')
+    parser.add_argument('--log', default='info', help='logging level')
+    args = parser.parse_args()
+
+    logging.basicConfig(format=LOGGING_FMT, level=getattr(logging, args.log.upper()))
+
+    executor = LocalExecutor(args.command, args.num_workers,
+                             args.manifest or args.argument_file + '.manifest',
+                             args.max_retries, args.log_dir, args.template_bank)
+    failed = executor.run(read_argument_file(args.argument_file))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
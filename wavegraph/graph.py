@@ -11,7 +11,12 @@ import collections
 import itertools
 import logging
 import subprocess
-import yaml
+
+try:
+    from . import profiling
+except (ImportError, ValueError):
+    # Module imported from the wavegraph directory (e.g. "import timeseries")
+    import profiling
 
 # Information about a GridPoint in a Graph:
 GraphInfo = collections.namedtuple('GraphNodeInfo', 'value_avg value_stdev')
@@ -31,6 +36,7 @@ class Graph(object):
     in some of the original clusters.
     sorted_list -- a topologically sorted list of the GridPoints
     """
+    @profiling.timed('graph')
     def __init__(self, clusters):
         """
         Create a new graph from clusters.
@@ -88,6 +94,8 @@ class Graph(object):
                 self.point_info[grid_point]))
         
         self.sorted_list = self._topological_sorting()
+        profiling.annotate(num_nodes=len(self.sorted_list),
+                           num_head_nodes=len(self.head_nodes))
         
     def __str__(self, grid):
         """
@@ -216,6 +224,7 @@ def read_graph():
     """
     raise NotImplementedError
 
+@profiling.timed()
 def write_graph(filename, graph, metadata, grid, format='custom'):
     """
     Write graph to .txt file.
@@ -235,6 +244,8 @@ def write_graph(filename, graph, metadata, grid, format='custom'):
     with open(filename, 'w') as outfile:
         print >> outfile, metadata
         print >> outfile, graph.__str__(grid)
+    profiling.annotate(num_nodes=len(graph.sorted_list),
+                       bytes_written=os.path.getsize(filename))
         
     logging.info('Wrote graph ({} nodes) in {}'.format(len(graph.sorted_list), \
                                                        filename))
@@ -0,0 +1,380 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+# Inner products (overlaps) between the Wilson atoms of the planes of a
+# CoherentWaveBurstGrid
+
+import os
+import json
+import logging
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+# Overlap tables already computed in this process, indexed by configuration
+_OVERLAP_TABLES = {}
+
+def prototype_matrix(atoms, scale):
+    """
+    Return the prototype atoms of a scale stacked in a single array.
+
+    The prototypes are zero-padded to a common length with their
+    centers aligned, so that the atom of pixel (time_index, freq_index)
+    starts at sample 2**scale * time_index - length // 2.
+
+    Inputs:
+    -------
+    atoms [WilsonAtomDictionary] -- atom dictionary
+    scale                  [int] -- timescale exponent
+
+    Output:
+    -------
+    prototypes [Numpy Array] -- 4D array (dual flag x parity x freq x samples)
+    """
+    num_freqs = int(2**scale) + 1
+    protos = [[[atoms.prototype(scale, m, parity, dual) \
+                for m in range(num_freqs)] \
+               for parity in (0, 1)] \
+              for dual in (False, True)]
+    length = max(p.size for plane in protos for row in plane for p in row)
+
+    out = numpy.zeros((2, 2, num_freqs, length))
+    for dual in (0, 1):
+        for parity in (0, 1):
+            for m, p in enumerate(protos[dual][parity]):
+                start = length // 2 - p.size // 2
+                out[dual, parity, m, start:start + p.size] = p
+
+    return out
+
+class OverlapTable(object):
+    """
+    Table of the non-zero inner products between the Wilson atoms of the
+    planes of a CoherentWaveBurstGrid.
+
+    The atom of a pixel is identified by its scale index, its part (0
+    for the direct basis, 1 for the dual basis), its frequency index and
+    its time index. The inner product between two atoms a and b only
+    depends on their scales, parts, frequency indices, on the parities
+    of their time indices and on their relative position (lag) in samples:
+
+        lag = 2**scale_b * time_b - 2**scale_a * time_a
+
+    For each atom a (at parity 0 and 1) and each scale b, the table
+    stores the parts, frequency indices, parities and lags of the atoms
+    b whose overlap with a exceeds the tolerance, in a compressed
+    sparse row layout.
+
+    Main attributes:
+    ----------------
+    scales      -- timescale exponents of the grid planes
+    num_layers  -- number of layers 2**scale of each plane
+    tol         -- absolute tolerance below which overlaps are discarded
+    params      -- dictionary with the parameters of the WDM types
+    indptr      -- row pointers in the entry arrays
+    parts, freqs, parities, lags, values -- entry arrays
+    """
+    def __init__(self, scales, tol, params, row_base, indptr,
+                 parts, freqs, parities, lags, values):
+        self.scales = numpy.asarray(scales, dtype=int)
+        self.num_layers = 2**self.scales
+        self.tol = tol
+        self.params = params
+        self.row_base = row_base
+        self.indptr = indptr
+        self.parts = parts
+        self.freqs = freqs
+        self.parities = parities
+        self.lags = lags
+        self.values = values
+
+    @staticmethod
+    def _row_bases(scales):
+        """ Index of the first row of each (scale a, scale b) block """
+        num_rows = 4 * (2**numpy.asarray(scales, dtype=int) + 1)
+        sizes = numpy.repeat(num_rows, len(scales))
+        return numpy.concatenate(([0], numpy.cumsum(sizes))) \
+                    .astype(numpy.int64)
+
+    @classmethod
+    def build(cls, grid, atoms=None, tol=1e-6):
+        """
+        Compute the overlap table of a grid.
+
+        Inputs:
+        -------
+        grid [CoherentWaveBurstGrid object] -- cWB grid
+        atoms     [WilsonAtomDictionary] -- atom dictionary (default
+                                            WDM types if None)
+        tol                       [float] -- absolute tolerance below which
+                                             overlaps are discarded
+        """
+        if atoms is None:
+            import watutils
+            atoms = watutils.WILSON_ATOMS
+
+        scales = numpy.asarray(grid.timescales_exp, dtype=int)
+        protos = [prototype_matrix(atoms, scale) for scale in scales]
+
+        row_base = cls._row_bases(scales)
+        entries = []
+        counts = numpy.zeros(row_base[-1], dtype=numpy.int64)
+
+        for ia, scale_a in enumerate(scales):
+            for ib, scale_b in enumerate(scales):
+
+                logging.debug("Computing overlaps between scales {} and {}" \
+                              .format(scale_a, scale_b))
+
+                block = cls._build_block(protos[ia], int(2**scale_a),
+                                         protos[ib], int(2**scale_b), tol)
+
+                for (row, part, freq, parity, lag, value) in block:
+                    entries.append((part, freq, parity, lag, value))
+                    counts[row_base[ia * len(scales) + ib] + row] = part.size
+
+        indptr = numpy.concatenate(([0], numpy.cumsum(counts)))
+        entries = [numpy.concatenate(e) if e else numpy.empty(0) \
+                   for e in zip(*entries)]
+
+        params = {'wat_type': getattr(atoms, 'wat_type', None),
+                  'inu': getattr(atoms, 'inu', None),
+                  'precision': getattr(atoms, 'precision', None)}
+
+        return cls(scales, tol, params, row_base, indptr,
+                   entries[0].astype(numpy.int8), entries[1].astype(numpy.int32),
+                   entries[2].astype(numpy.int8), entries[3].astype(numpy.int64),
+                   entries[4].astype(float))
+
+    @staticmethod
+    def _build_block(protos_a, layers_a, protos_b, layers_b, tol):
+        """
+        Compute the overlaps between the atoms of two scales.
+
+        Yields for each row (atom a) a tuple (row, parts, freqs, parities,
+        lags, values) for the atoms b with non-negligible overlap.
+        """
+        length_a = protos_a.shape[-1]
+        length_b = protos_b.shape[-1]
+        half_a = length_a // 2
+        half_b = length_b // 2
+
+        # Both 2**scale_a * time_a and 2**scale_b * time_b are multiples
+        # of the smallest number of layers: only these lags are needed
+        step = min(layers_a, layers_b)
+
+        # The atoms overlap for lags such that the shift d between their
+        # first samples is in [-(length_b-1), length_a-1]
+        shift_to_lag = half_b - half_a
+        lag_min = -(length_b - 1) + shift_to_lag
+        lag_max = length_a - 1 + shift_to_lag
+        lags = step * numpy.arange(-(-lag_min // step), lag_max // step + 1)
+        starts = lags - shift_to_lag + length_b
+
+        freqs_a = numpy.arange(protos_a.shape[2]) / float(layers_a)
+        freqs_b = numpy.arange(protos_b.shape[2]) / float(layers_b)
+        bandwidth = 1. / layers_a + 1. / layers_b
+
+        padded = numpy.zeros(length_a + 2 * length_b + 1)
+        for part_a in (0, 1):
+            for parity_a in (0, 1):
+                for freq_a in range(protos_a.shape[2]):
+
+                    # Atoms are band-limited: only the atoms of scale b
+                    # with overlapping frequency bands are considered
+                    cands = numpy.flatnonzero(
+                        numpy.abs(freqs_b - freqs_a[freq_a]) <= bandwidth)
+
+                    # Windows of the zero-padded atom a at each lag, so
+                    # that the overlaps for all lags and all candidates
+                    # are obtained in a single matrix product
+                    padded[length_b:length_b + length_a] = \
+                        protos_a[part_a, parity_a, freq_a]
+                    windows = as_strided(padded[starts[0]:],
+                                         shape=(lags.size, length_b),
+                                         strides=(step * padded.itemsize,
+                                                  padded.itemsize))
+                    cand_protos = protos_b[:, :, cands, :]
+                    overlaps = windows.dot(
+                        cand_protos.reshape(-1, length_b).T) \
+                        .reshape(lags.size, 2, 2, cands.size)
+
+                    lag_idx, part_b, parity_b, cand_idx = \
+                        numpy.nonzero(numpy.abs(overlaps) > tol)
+
+                    row = (part_a * 2 + parity_a) * protos_a.shape[2] + freq_a
+                    yield (row, part_b, cands[cand_idx], parity_b, lags[lag_idx],
+                           overlaps[lag_idx, part_b, parity_b, cand_idx])
+
+    def row(self, scale_index_a, part_a, freq_a, parity_a, scale_index_b):
+        """
+        Return the entries of the table for atom a and scale b.
+
+        Inputs:
+        -------
+        scale_index_a [int] -- scale index of atom a
+        part_a        [int] -- part of atom a (0: direct, 1: dual)
+        freq_a        [int] -- frequency index of atom a
+        parity_a      [int] -- parity of the time index of atom a
+        scale_index_b [int] -- scale index of the atoms b
+
+        Outputs:
+        --------
+        parts, freqs, parities, lags, values [Numpy Arrays] -- parts,
+        frequency indices, time parities, lags and overlaps of atoms b
+        """
+        num_freqs = self.num_layers[scale_index_a] + 1
+        row = self.row_base[scale_index_a * len(self.scales) + scale_index_b] \
+              + (part_a * 2 + parity_a % 2) * num_freqs + freq_a
+        start, stop = self.indptr[row], self.indptr[row + 1]
+        return (self.parts[start:stop], self.freqs[start:stop],
+                self.parities[start:stop], self.lags[start:stop],
+                self.values[start:stop])
+
+    def neighbours(self, scale_index, part, freq_index, time_index, num_times=None):
+        """
+        Return all the atoms that overlap with a given atom, with their overlaps.
+
+        Inputs:
+        -------
+        scale_index      [int] -- scale index of the atom
+        part             [int] -- part of the atom (0: direct, 1: dual)
+        freq_index       [int] -- frequency index of the atom
+        time_index       [int] -- time index of the atom
+        num_times [list/None] -- number of time bins of each plane. If given,
+                                 time indices are wrapped around the segment
+
+        Outputs:
+        --------
+        scale_indices, parts, freq_indices, time_indices, values [Numpy Arrays]
+        """
+        position = self.num_layers[scale_index] * time_index
+        out = []
+        for ib in range(len(self.scales)):
+            parts, freqs, parities, lags, values = \
+                self.row(scale_index, part, freq_index, time_index, ib)
+            times, rems = numpy.divmod(position + lags, self.num_layers[ib])
+            valid = (rems == 0) & (times % 2 == parities)
+            times = times[valid]
+            if num_times is not None:
+                times %= num_times[ib]
+            out.append((numpy.full(times.size, ib), parts[valid],
+                        freqs[valid], times, values[valid]))
+
+        return tuple(numpy.concatenate(x) for x in zip(*out))
+
+    def overlap(self, atom_a, atom_b):
+        """
+        Return the inner product between two atoms.
+
+        Inputs:
+        -------
+        atom_a, atom_b [tuple] -- (scale_index, part, freq_index, time_index)
+                                  of the atoms
+
+        Output:
+        -------
+        value [float] -- inner product (zero if below the tolerance)
+        """
+        scale_a, part_a, freq_a, time_a = atom_a
+        scale_b, part_b, freq_b, time_b = atom_b
+        parts, freqs, parities, lags, values = \
+            self.row(scale_a, part_a, freq_a, time_a, scale_b)
+        lag = self.num_layers[scale_b] * time_b - self.num_layers[scale_a] * time_a
+        match = (parts == part_b) & (freqs == freq_b) & \
+                (parities == time_b % 2) & (lags == lag)
+        return values[match].sum()
+
+    def norms(self, scale_index):
+        """
+        Return the squared norms of the atoms of a plane.
+
+        Output:
+        -------
+        norms [Numpy Array] -- 3D array (part x parity x freq)
+        """
+        num_freqs = self.num_layers[scale_index] + 1
+        out = numpy.zeros((2, 2, num_freqs))
+        for part in (0, 1):
+            for parity in (0, 1):
+                for freq in range(num_freqs):
+                    out[part, parity, freq] = self.overlap(
+                        (scale_index, part, freq, parity),
+                        (scale_index, part, freq, parity))
+        return out
+
+    def save(self, filename):
+        """ Save the table into a .npz file """
+        numpy.savez_compressed(filename, scales=self.scales, tol=self.tol,
+                               params=json.dumps(self.params),
+                               row_base=self.row_base, indptr=self.indptr,
+                               parts=self.parts, freqs=self.freqs,
+                               parities=self.parities, lags=self.lags,
+                               values=self.values)
+
+        logging.info('Wrote overlap table ({} entries) in {}'.format(
+            self.values.size, filename))
+
+    @classmethod
+    def load(cls, filename):
+        """ Load a table saved with save() """
+        if not os.path.isfile(filename):
+            raise Exception('File {} not found'.format(filename))
+
+        logging.info("Reading {}".format(filename))
+
+        with numpy.load(filename) as data:
+            params = json.loads(str(data['params']))
+            return cls(data['scales'], float(data['tol']), params,
+                       data['row_base'], data['indptr'], data['parts'],
+                       data['freqs'], data['parities'], data['lags'],
+                       data['values'])
+
+def get_overlap_table(grid, atoms=None, tol=1e-6, cache_dir=None):
+    """
+    Return the overlap table of a grid.
+
+    The table is computed once per process and configuration. If
+    cache_dir is given, it is also stored there and reloaded by the next
+    processes instead of being recomputed.
+
+    Inputs:
+    -------
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    atoms     [WilsonAtomDictionary] -- atom dictionary (default
+                                        WDM types if None)
+    tol                       [float] -- absolute tolerance below which
+                                         overlaps are discarded
+    cache_dir              [str/None] -- directory of the disk cache
+    """
+    if atoms is None:
+        import watutils
+        atoms = watutils.WILSON_ATOMS
+
+    # The type of the atom dictionary is part of the key: dictionaries of
+    # different atoms can have the same parameters
+    atoms_type = '{}.{}'.format(type(atoms).__module__, type(atoms).__name__)
+    key = (atoms_type, tuple(int(s) for s in grid.timescales_exp),
+           getattr(atoms, 'wat_type', None), getattr(atoms, 'inu', None),
+           getattr(atoms, 'precision', None), tol)
+
+    if key in _OVERLAP_TABLES:
+        return _OVERLAP_TABLES[key]
+
+    filename = None
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir,
+            'overlap_{}_scales{}-{}_{}_inu{}_prec{}_tol{:g}.npz'.format(
+                atoms_type, key[1][0], key[1][-1],
+                'default' if key[2] is None else key[2], key[3], key[4], tol))
+
+    if filename is not None and os.path.isfile(filename):
+        table = OverlapTable.load(filename)
+    else:
+        table = OverlapTable.build(grid, atoms, tol)
+        if filename is not None:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            table.save(filename)
+
+    _OVERLAP_TABLES[key] = table
+    return table
@@ -0,0 +1,343 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+# In-memory processing chain from template signals to graphs. The stages
+# are generator functions: each one consumes the items of the previous
+# stage and yields its own, so that the items stream from the template
+# generation (see template_stage()) to the graph without intermediate
+# files. Tap points give access to the items leaving any stage, e.g. to
+# persist them.
+
+import logging
+import numpy
+
+import timeseries
+import tfcluster
+
+class Pipeline(object):
+    """
+    Chain of named generator stages.
+
+    A stage is a function that takes an iterable of items and returns
+    an iterable (usually a generator) of items. Taps are callables
+    called on each item leaving a stage; if a tap has a close() method,
+    it is called once the stage is exhausted.
+
+    Main attributes:
+    ----------------
+    stages -- list of (name, stage) pairs, in processing order
+    taps   -- dictionary mapping stage names to lists of taps
+    """
+    def __init__(self, stages=()):
+        """
+        stages [list] -- list of (name, stage) pairs
+        """
+        self.stages = []
+        self.taps = {}
+        for (name, stage) in stages:
+            self.add(name, stage)
+
+    def add(self, name, stage):
+        """ Append a stage and return the pipeline """
+        if name in dict(self.stages):
+            raise ValueError("Stage {} already exists".format(name))
+        self.stages.append((name, stage))
+        return self
+
+    def tap(self, name, callback):
+        """ Register a tap on the items leaving a stage and return the pipeline """
+        if name not in dict(self.stages):
+            raise ValueError("Unknown stage {}".format(name))
+        self.taps.setdefault(name, []).append(callback)
+        return self
+
+    def _tapped(self, name, items):
+        """ Pass the items through the taps of a stage """
+        taps = self.taps[name]
+        count = 0
+        for item in items:
+            for tap in taps:
+                tap(item)
+            count += 1
+            yield item
+        for tap in taps:
+            if hasattr(tap, 'close'):
+                tap.close()
+        logging.debug("Stage {}: {} items".format(name, count))
+
+    def run(self, source):
+        """
+        Return the generator of the items of the last stage, fed with
+        the items of source. Nothing is computed until the generator
+        is consumed.
+        """
+        items = iter(source)
+        for (name, stage) in self.stages:
+            items = stage(items)
+            if name in self.taps:
+                items = self._tapped(name, items)
+        return items
+
+class Collector(object):
+    """
+    Tap collecting the items of a stage, and passing them on to a
+    writer function when the stage is exhausted.
+    """
+    def __init__(self, writer=None):
+        """
+        writer [function/None] -- called with the list of the items
+        """
+        self.items = []
+        self.writer = writer
+
+    def __call__(self, item):
+        self.items.append(item)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer(self.items)
+
+def timeseries_reader(filename):
+    """
+    Return the Timeseries of a .hdf file, as the source of a pipeline.
+    They are taken from the shared memory block of the node if the
+    executor of the jobs created one (see timeseries.load_shared_templates()).
+    """
+    return timeseries.load_shared_templates(filename)[0]
+
+def timeseries_writer(filename, metadata):
+    """ Return a tap writing the Timeseries of a stage to a .hdf file """
+    return Collector(lambda items: timeseries.write_timeseries(filename, items,
+                                                               metadata))
+
+def clusters_writer(filename, params, metadata):
+    """ Return a tap writing the Cluster objects of a stage to a .hdf file """
+    return Collector(lambda items: tfcluster.write_clusters(filename, items,
+                                                            params, metadata))
+
+def template_stage(approximant, freq_min, sampling_freq):
+    """
+    Return a stage generating the Timeseries of the + polarization of
+    CBC templates (CompactBinaryCoalescence objects, e.g. read with
+    cbc.read_cbc_template_bank()), described by their parameters.
+
+    approximant [str] -- waveform approximant (see
+                         cbc.CompactBinaryCoalescence.waveform())
+    freq_min [float] -- lower frequency [Hz]
+    sampling_freq [float] -- sampling frequency [Hz]
+    """
+    def stage(templates):
+        for template in templates:
+            hp, _ = template.waveform(approximant, freq_min, sampling_freq)
+            yield timeseries.Timeseries(hp, sampling_freq, 0., str(template))
+    return stage
+
+def resample_stage(sampling_freq):
+    """
+    Return a stage resampling Timeseries to a sampling frequency (with
+    a rational factor, see timeseries.resample()).
+    """
+    def stage(signals):
+        filters = {}
+        for signal in signals:
+            if signal.sampling_freq == sampling_freq:
+                yield signal
+                continue
+            p, q = int(sampling_freq), int(signal.sampling_freq)
+            # The anti-aliasing filter only depends on the factors
+            data, filters[(p, q)] = timeseries.resample(signal.data, p, q,
+                                                        filters.get((p, q)))
+            yield timeseries.Timeseries(data, sampling_freq, signal.t0,
+                                        signal.metadata)
+    return stage
+
+def segment_stage(grid, duration, alignment='right'):
+    """
+    Return a stage placing Timeseries into zero-padded segments of a
+    given duration, the signal being aligned to the left or the right
+    of the segment (longer signals are truncated on the other side).
+    The number of samples of the segments must be a multiple of the
+    largest timescale of the grid.
+    """
+    if alignment not in ('left', 'right'):
+        raise ValueError("Unknown alignment {}".format(alignment))
+    num_samples = int(round(duration * grid.sampling_freq))
+    if num_samples % 2**int(grid.timescales_exp[-1]):
+        raise ValueError("The segment duration {} s is not a multiple of the " \
+                         "largest timescale {} s".format(duration,
+                                                         grid.timescale_max))
+
+    def stage(signals):
+        for signal in signals:
+            data = numpy.zeros(num_samples)
+            length = min(num_samples, len(signal.data))
+            if alignment == 'left':
+                data[:length] = signal.data[:length]
+            else:
+                data[num_samples - length:] = signal.data[len(signal.data) - length:]
+            yield timeseries.Timeseries(data, signal.sampling_freq, signal.t0,
+                                        signal.metadata)
+    return stage
+
+def pad_stage(grid):
+    """
+    Return a stage zero-padding Timeseries at the end to FFT-friendly
+    lengths suitable for the WDM transforms of the grid (see
+    timeseries.pad_to_fast_length()).
+    """
+    def stage(signals):
+        for signal in signals:
+            yield timeseries.pad_to_fast_length(signal, grid)
+    return stage
+
+def _chunks(items, size):
+    """ Split an iterable into lists of at most size items """
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def whitening_stage(nrms, batch_size=64):
+    """
+    Return a stage whitening Timeseries with an nRMS spectrum. The
+    signals are whitened by batches of batch_size signals (see
+    watutils.whitening_batch()), so that the WDM set-up is shared by
+    the signals of the same length of a batch.
+    """
+    def stage(signals):
+        import watutils
+
+        for chunk in _chunks(signals, batch_size):
+            whitened = [None] * len(chunk)
+            for indices in timeseries.group_by_length(chunk).values():
+                stack = numpy.array([chunk[n].data for n in indices], dtype=float)
+                watutils.whitening_batch(stack, nrms)
+                for (n, data) in zip(indices, stack):
+                    whitened[n] = timeseries.Timeseries(
+                        data, chunk[n].sampling_freq, chunk[n].t0,
+                        chunk[n].metadata)
+            for signal in whitened:
+                yield signal
+    return stage
+
+def clustering_stage(grid, decompose, shifts=None):
+    """
+    Return a stage decomposing Timeseries into Clusters.
+
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    decompose [function] -- function returning the Cluster of a Timeseries
+                            (e.g. wrapping solvers.iniht())
+    shifts [list/None] -- if given, one cluster is yielded per time shift
+                          (in samples) of each signal (see
+                          tfcluster.time_shifted_clusters())
+    """
+    def stage(signals):
+        for signal in signals:
+            if shifts is None:
+                yield decompose(signal)
+            else:
+                for cluster in tfcluster.time_shifted_clusters(signal, grid,
+                                                               shifts, decompose):
+                    yield cluster
+    return stage
+
+def ordering_stage(ordering, grid=None, batch_size=256):
+    """
+    Return a stage sorting the pixels of Clusters (see
+    tfcluster.ClusterSet.order()). The pixels of batch_size clusters
+    are sorted at once, in a single ClusterSet.
+    """
+    def stage(clusters):
+        for chunk in _chunks(clusters, batch_size):
+            for cluster in tfcluster.sort_clusters(chunk, ordering, grid):
+                yield cluster
+    return stage
+
+def cached_stage(stage_cache, name, stage, params):
+    """
+    Return a stage whose output items are taken from a cache when its
+    input items and its parameters are unchanged (see
+    cache.StageCache.memoize()). The input items are gathered before
+    the stage runs.
+
+    stage_cache [StageCache object] -- artifact cache
+    name [str] -- stage name
+    stage [function] -- stage to cache
+    params [str/dict] -- parameters of the stage
+    """
+    def cached(items):
+        import cache
+
+        items = list(items)
+        outputs = stage_cache.memoize(name, [cache.items_hash(items)], params,
+                                      lambda: list(stage(items)))
+        for item in outputs:
+            yield item
+    return cached
+
+def build_graph(clusters):
+    """ Return the Graph of the clusters leaving a pipeline """
+    import graph
+
+    return graph.Graph(clusters)
+
+def signals_to_graph(signals, grid, decompose, sampling_freq=None,
+                     segment_duration=None, alignment='right', nrms=None,
+                     shifts=None, ordering=None, taps=None, approximant=None,
+                     freq_min=None):
+    """
+    Build the graph of a bank of templates in memory.
+
+    Inputs:
+    -------
+    signals [iterable] -- Timeseries objects, or CBC templates
+                          (CompactBinaryCoalescence objects) if approximant
+                          is given
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    decompose [function] -- function returning the Cluster of a Timeseries
+    sampling_freq [float/None] -- analysis sampling frequency (no resampling if None)
+    approximant [str/None] -- waveform approximant of the CBC templates (see
+                              template_stage()). Their signals are generated
+                              at sampling_freq (or at the sampling frequency
+                              of the grid if None)
+    freq_min [float/None] -- lower frequency of the CBC templates [Hz]
+    segment_duration [float/None] -- segment duration [s]. If None, the signals
+                                     are zero-padded to FFT-friendly lengths
+                                     instead (see pad_stage())
+    alignment [str] -- 'left' or 'right' alignment in the segments
+    nrms [Numpy Array/None] -- nRMS spectrum for whitening (no whitening if None)
+    shifts [list/None] -- time shifts [samples] (see clustering_stage())
+    ordering [list/None] -- pixel ordering keys (see ordering_stage())
+    taps [dict/None] -- taps indexed by stage name ('templates', 'resample',
+                        'segment' or 'pad', 'whitening', 'clustering',
+                        'ordering')
+
+    Output:
+    -------
+    graph [Graph object] -- graph of the clusters
+    """
+    pipeline = Pipeline()
+    if approximant is not None:
+        pipeline.add('templates', template_stage(approximant, freq_min,
+                                                 sampling_freq or grid.sampling_freq))
+    if sampling_freq is not None:
+        pipeline.add('resample', resample_stage(sampling_freq))
+    if segment_duration is not None:
+        pipeline.add('segment', segment_stage(grid, segment_duration, alignment))
+    else:
+        pipeline.add('pad', pad_stage(grid))
+    if nrms is not None:
+        pipeline.add('whitening', whitening_stage(nrms))
+    pipeline.add('clustering', clustering_stage(grid, decompose, shifts))
+    if ordering is not None:
+        pipeline.add('ordering', ordering_stage(ordering, grid))
+
+    for (name, callbacks) in (taps or {}).items():
+        for callback in callbacks if isinstance(callbacks, list) else [callbacks]:
+            pipeline.tap(name, callback)
+
+    return build_graph(list(pipeline.run(signals)))
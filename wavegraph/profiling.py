@@ -0,0 +1,206 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+# Lightweight instrumentation of the processing stages: timers (context
+# manager or decorator) and counters, written as JSON lines (one record
+# per timed call) to a metrics file. When no metrics file is enabled, a
+# timed function costs one extra function call and a test.
+#
+# The metrics file is enabled with enable(), or by setting the
+# environment variable WAVEGRAPH_METRICS_FILE (e.g. in Condor jobs).
+# Several processes can append to the same file: each record holds the
+# process id. The counter totals are written when the outermost timer of
+# a process exits (e.g. at the end of each task of a pool worker, where
+# atexit functions are not run) and when the file is closed.
+
+import os
+import json
+import time
+import timeit
+import atexit
+import logging
+import functools
+import collections
+
+ENVIRONMENT_VARIABLE = 'WAVEGRAPH_METRICS_FILE'
+
+# Metrics file (None when the instrumentation is disabled), timers
+# currently running (innermost last) and counter totals of the process
+# since they were last written
+_OUTPUT = None
+_RUNNING = []
+_COUNTERS = collections.Counter()
+
+def enable(filename):
+    """ Append the metrics to a JSON lines file """
+    global _OUTPUT
+    disable()
+    try:
+        _OUTPUT = open(filename, 'a')
+    except IOError:
+        raise IOError('Cannot write file {}'.format(filename))
+    logging.debug("Writing metrics in {}".format(filename))
+
+def disable():
+    """ Write the counter totals and close the metrics file """
+    global _OUTPUT
+    if _OUTPUT is None:
+        return
+    _flush_counters()
+    _OUTPUT.close()
+    _OUTPUT = None
+
+def enabled():
+    """ Return True if the metrics are recorded """
+    return _OUTPUT is not None
+
+def emit(stage, **fields):
+    """ Write a record of a stage to the metrics file """
+    _write(stage, fields)
+
+def _write(stage, fields):
+    """
+    Write a record made of a dictionary of fields. The stage name, time
+    and process id of the record take precedence over fields of the
+    same names (e.g. added with annotate())
+    """
+    if _OUTPUT is None:
+        return
+    record = dict(fields)
+    record.update(stage=stage, time=time.time(), pid=os.getpid())
+    # One write per line, so that the records of concurrent processes
+    # are not interleaved
+    _OUTPUT.write(json.dumps(record, default=str) + '\n')
+    _OUTPUT.flush()
+
+def _flush_counters():
+    """ Write the counter totals not yet written, if any """
+    if _COUNTERS:
+        _write('counters', _COUNTERS)
+        _COUNTERS.clear()
+
+def annotate(**fields):
+    """
+    Add fields (e.g. template description, number of iterations, bytes
+    read) to the record of the innermost running timer.
+    """
+    if _OUTPUT is not None and _RUNNING:
+        _RUNNING[-1].fields.update(fields)
+
+def count(name, value=1):
+    """
+    Increment a counter, both in the record of the innermost running
+    timer and in the totals of the process (written when the outermost
+    timer exits, and by disable()).
+    """
+    if _OUTPUT is None:
+        return
+    _COUNTERS[name] += value
+    if _RUNNING:
+        fields = _RUNNING[-1].fields
+        fields[name] = fields.get(name, 0) + value
+
+class Timer(object):
+    """
+    Context manager measuring the wall time of a stage and writing its
+    record when it exits.
+
+    Main attributes:
+    ----------------
+    stage  -- stage name
+    fields -- additional fields of the record
+    """
+    def __init__(self, stage, fields):
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self):
+        if _RUNNING:
+            self.fields.setdefault('parent', _RUNNING[-1].stage)
+        _RUNNING.append(self)
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall_time = timeit.default_timer() - self.start
+        _RUNNING.remove(self)
+        if exc_type is not None:
+            self.fields['error'] = exc_type.__name__
+        # The fields are merged into a dictionary, so that annotated
+        # fields named as the fields of the record do not raise a TypeError
+        fields = dict(self.fields)
+        fields['wall_time'] = wall_time
+        _write(self.stage, fields)
+        if not _RUNNING:
+            _flush_counters()
+        return False
+
+class _NullTimer(object):
+    """ Timer doing nothing, used when the instrumentation is disabled """
+    def __init__(self):
+        self.fields = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+def timer(stage, **fields):
+    """
+    Return a context manager timing a block of code, e.g.
+
+        with profiling.timer('clustering', template=signal.metadata):
+            ...
+    """
+    if _OUTPUT is None:
+        return _NullTimer()
+    return Timer(stage, fields)
+
+def timed(stage=None):
+    """
+    Decorator timing each call of a function (the stage name is the
+    name of the function by default). The function can add fields to
+    its record with annotate().
+    """
+    def decorator(function):
+        name = stage or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _OUTPUT is None:
+                return function(*args, **kwargs)
+            with Timer(name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def summarize(filename):
+    """
+    Return the number of calls, total and maximum wall time per stage
+    of a metrics file.
+    """
+    if not os.path.isfile(filename):
+        raise Exception('File {} not found'.format(filename))
+
+    summary = {}
+    with open(filename) as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Line truncated by an interruption
+                continue
+            if 'wall_time' not in record:
+                continue
+            stats = summary.setdefault(record['stage'], {'calls': 0, 'total': 0.,
+                                                         'max': 0.})
+            stats['calls'] += 1
+            stats['total'] += record['wall_time']
+            stats['max'] = max(stats['max'], record['wall_time'])
+    return summary
+
+atexit.register(disable)
+
+if os.environ.get(ENVIRONMENT_VARIABLE):
+    enable(os.environ[ENVIRONMENT_VARIABLE])
@@ -0,0 +1,441 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+# Greedy decompositions of signals over the multi-scale WDM dictionary
+# of a CoherentWaveBurstGrid
+
+import logging
+import numpy
+from scipy.linalg import solve_triangular
+
+import tfcluster
+import overlap
+import profiling
+
+class IndexedMaxQueue(object):
+    """
+    Indexed max-priority queue over the keys 0..n-1.
+
+    The queue is a tournament tree stored in arrays: each internal node
+    holds the maximum priority of its two children and the key where it
+    is reached. The priorities of any set of keys are updated in
+    O(k log n) operations, vectorized over the keys.
+    """
+    def __init__(self, priorities):
+        """
+        priorities [Numpy Array] -- initial priorities of the keys
+        """
+        num_keys = len(priorities)
+        size = 1
+        while size < num_keys:
+            size *= 2
+        self._size = size
+
+        self._values = numpy.full(2 * size, -numpy.inf)
+        self._values[size:size + num_keys] = priorities
+        self._keys = numpy.zeros(2 * size, dtype=int)
+        self._keys[size:] = numpy.arange(size)
+
+        # Fill the internal nodes level by level
+        level = size // 2
+        while level >= 1:
+            self._fix(numpy.arange(level, 2 * level))
+            level //= 2
+
+    def _fix(self, nodes):
+        """ Recompute the maximum of the given internal nodes """
+        left = 2 * nodes
+        child = numpy.where(self._values[left] >= self._values[left + 1],
+                            left, left + 1)
+        self._values[nodes] = self._values[child]
+        self._keys[nodes] = self._keys[child]
+
+    def update(self, keys, priorities):
+        """ Set the priorities of the given keys """
+        leaves = numpy.asarray(keys) + self._size
+        self._values[leaves] = priorities
+        nodes = numpy.unique(leaves // 2)
+        while nodes.size:
+            self._fix(nodes)
+            nodes = numpy.unique(nodes[nodes > 1] // 2)
+
+    def top(self):
+        """ Return the key with maximum priority and its priority """
+        return self._keys[1], self._values[1]
+
+def atom_norms(layout, table):
+    """
+    Return the squared norms of all the atoms of a layout, as a flat
+    array in the layout order.
+
+    Inputs:
+    -------
+    layout [CoefficientLayout object] -- coefficient layout
+    table       [OverlapTable object] -- atom overlap table
+    """
+    planes = []
+    for (scale_index, num_times) in enumerate(layout.num_times):
+        norms = table.norms(scale_index)[:layout.num_parts]
+        # (part x parity x freq) -> (part x freq x time)
+        planes.append(numpy.take(norms, numpy.arange(num_times) % 2, axis=1) \
+                      .transpose(0, 2, 1))
+    return layout.join(planes)
+
+class MatchingPursuit(object):
+    """
+    Matching pursuit over the multi-scale WDM dictionary of a grid.
+
+    The inner products between the residual and all the atoms
+    (correlations) are stored in a flat array, and the best atom is
+    tracked with an indexed priority queue. After each selection, only
+    the correlations of the atoms that overlap with the selected one
+    are updated, using the overlap table, and the residual energy is
+    updated incrementally. No transform of the residual is needed.
+
+    Main attributes:
+    ----------------
+    layout -- CoefficientLayout object
+    table  -- OverlapTable object
+    norms  -- squared norms of the atoms (flat array)
+    """
+    def __init__(self, layout, table):
+        """
+        layout [CoefficientLayout object] -- coefficient layout
+        table       [OverlapTable object] -- atom overlap table of the grid
+        """
+        self.layout = layout
+        self.table = table
+        self.norms = atom_norms(layout, table)
+        self._neighbours = {}
+
+    def neighbours(self, index):
+        """
+        Return the flat indices of the atoms overlapping with a given
+        atom, and the overlaps.
+        """
+        if index not in self._neighbours:
+            scale_index, part, freq_index, time_index = \
+                self.layout.unravel_index(index)
+            scales, parts, freqs, times, values = self.table.neighbours(
+                scale_index, part, freq_index, time_index, self.layout.num_times)
+            keep = parts < self.layout.num_parts
+            self._neighbours[index] = (
+                self.layout.ravel_index(scales[keep], parts[keep],
+                                        freqs[keep], times[keep]),
+                values[keep])
+        return self._neighbours[index]
+
+    def _scores(self, correlations, indices=None):
+        """ Energy removed from the residual by each atom """
+        if indices is None:
+            norms = self.norms
+        else:
+            norms = self.norms[indices]
+            correlations = correlations[indices]
+        scores = numpy.zeros(correlations.shape)
+        valid = norms > self.table.tol
+        scores[valid] = correlations[valid]**2 / norms[valid]
+        return scores
+
+    def decompose(self, correlations, energy, approx_error, max_iter=None):
+        """
+        Decompose a signal given its correlations with the atoms.
+
+        Inputs:
+        -------
+        correlations [Numpy Array] -- inner products of the signal with the
+                                      atoms (WDM coefficients, flat layout)
+        energy             [float] -- energy of the signal
+        approx_error       [float] -- stop when the residual energy is below
+                                      approx_error times the signal energy
+        max_iter        [int/None] -- maximum number of iterations
+
+        Outputs:
+        --------
+        coeffs   [Numpy Array] -- coefficients of the selected atoms
+                                  (flat layout)
+        residual       [float] -- residual energy
+        num_iter         [int] -- number of iterations
+        """
+        correlations = numpy.array(correlations, dtype=float)
+        coeffs = numpy.zeros(self.layout.size)
+        queue = IndexedMaxQueue(self._scores(correlations))
+
+        residual = float(energy)
+        target = approx_error * residual
+        num_iter = 0
+
+        while residual > target and (max_iter is None or num_iter < max_iter):
+
+            index, score = queue.top()
+            if score <= 0:
+                break
+
+            # Project the residual onto the best atom
+            alpha = correlations[index] / self.norms[index]
+            coeffs[index] += alpha
+            residual -= score
+
+            # Local update of the correlations of the overlapping atoms
+            indices, values = self.neighbours(index)
+            numpy.add.at(correlations, indices, -alpha * values)
+            queue.update(indices, self._scores(correlations, indices))
+
+            num_iter += 1
+
+        logging.debug("Matching pursuit: {} iterations, residual energy {:g}" \
+                      .format(num_iter, residual / energy if energy else 0.))
+
+        return coeffs, residual, num_iter
+
+class OrthogonalMatchingPursuit(MatchingPursuit):
+    """
+    Orthogonal matching pursuit over the multi-scale WDM dictionary of a grid.
+
+    The atoms are selected as in MatchingPursuit, but the coefficients
+    of all the selected atoms are refitted at each iteration by least
+    squares. The Cholesky factor of the Gram matrix of the selected
+    atoms is updated with one new row per iteration, from the overlap
+    table. The residual energy decreases by the square of the new entry
+    of the forward-substituted right-hand side, and only the
+    correlations of the atoms that overlap with the selected atoms are
+    updated.
+    """
+    def _scores(self, correlations, indices=None):
+        """ Energy removed from the residual by each atom """
+        scores = super(OrthogonalMatchingPursuit, self)._scores(correlations,
+                                                                indices)
+        excluded = self._excluded if indices is None else self._excluded[indices]
+        scores[excluded] = 0
+        return scores
+
+    def decompose(self, correlations, energy, approx_error, max_iter=None):
+        """
+        Decompose a signal given its correlations with the atoms.
+
+        Inputs and outputs are those of MatchingPursuit.decompose().
+        """
+        initial = numpy.array(correlations, dtype=float)
+        correlations = initial.copy()
+
+        # Selected atoms and their rank in the selection
+        selected = []
+        rank = numpy.full(self.layout.size, -1)
+        self._excluded = numpy.zeros(self.layout.size, dtype=bool)
+
+        # Cholesky factor of the Gram matrix of the selected atoms and
+        # forward-substituted right-hand side (grown on demand)
+        chol = numpy.zeros((64, 64))
+        forward = numpy.zeros(64)
+        weights = numpy.zeros(0)
+
+        queue = IndexedMaxQueue(self._scores(correlations))
+
+        residual = float(energy)
+        target = approx_error * residual
+        num_iter = 0
+
+        while residual > target and (max_iter is None or num_iter < max_iter):
+
+            index, score = queue.top()
+            if score <= 0:
+                break
+
+            num_selected = len(selected)
+            if num_selected == chol.shape[0]:
+                chol = numpy.pad(chol, ((0, num_selected), (0, num_selected)),
+                                 'constant')
+                forward = numpy.pad(forward, (0, num_selected), 'constant')
+
+            # Overlaps between the new atom and the selected atoms
+            indices, values = self.neighbours(index)
+            ranks = rank[indices]
+            gram = numpy.zeros(num_selected)
+            numpy.add.at(gram, ranks[ranks >= 0], values[ranks >= 0])
+
+            # New row of the Cholesky factor
+            row = solve_triangular(chol[:num_selected, :num_selected], gram,
+                                   lower=True) if num_selected else gram
+            pivot = self.norms[index] - numpy.dot(row, row)
+
+            self._excluded[index] = True
+            if pivot <= self.table.tol * self.norms[index]:
+                # The atom is (numerically) spanned by the selected atoms
+                queue.update([index], [0.])
+                continue
+
+            chol[num_selected, :num_selected] = row
+            chol[num_selected, num_selected] = numpy.sqrt(pivot)
+            forward[num_selected] = (initial[index] - numpy.dot(row, forward[:num_selected])) \
+                                    / chol[num_selected, num_selected]
+            rank[index] = num_selected
+            selected.append(index)
+            num_selected += 1
+
+            residual -= forward[num_selected - 1]**2
+
+            # Least-squares coefficients of the selected atoms
+            previous = numpy.append(weights, 0.)
+            weights = solve_triangular(chol[:num_selected, :num_selected].T,
+                                       forward[:num_selected], lower=False)
+
+            # Local update of the correlations of the atoms that overlap
+            # with selected atoms whose coefficient has changed
+            touched = []
+            for (atom, delta) in zip(selected, weights - previous):
+                if delta != 0:
+                    indices, values = self.neighbours(atom)
+                    numpy.add.at(correlations, indices, -delta * values)
+                    touched.append(indices)
+            touched = numpy.unique(numpy.concatenate(touched))
+            queue.update(touched, self._scores(correlations, touched))
+
+            num_iter += 1
+
+        coeffs = numpy.zeros(self.layout.size)
+        coeffs[selected] = weights
+
+        logging.debug("Orthogonal matching pursuit: {} iterations, {} atoms, " \
+                      "residual energy {:g}".format(num_iter, len(selected),
+                                                    residual / energy if energy else 0.))
+
+        return coeffs, residual, num_iter
+
+def wdm_correlations(layout, signals):
+    """
+    Return the inner products of signals with all the atoms of a layout
+    (i.e. their WDM coefficients) in flat layout order.
+
+    Inputs:
+    -------
+    layout [CoefficientLayout object] -- coefficient layout
+    signals              [Numpy Array] -- signal or 2D stack of signals
+
+    Output:
+    -------
+    correlations [Numpy Array] -- (..., layout.size) array
+    """
+    import watutils
+
+    signals = numpy.asarray(signals)
+    directs, duals = watutils.wdm_transform_batch(signals, layout.grid)
+    planes = [numpy.stack((direct, dual)[:layout.num_parts], axis=-3) \
+              for (direct, dual) in zip(directs, duals)]
+    out = layout.join(planes)
+    return out if signals.ndim > 1 else out[0]
+
+def _pursuit(engine_class, signal, grid, approx_error, max_iter,
+             reject_zero_freq, table):
+    """ Decompose a Timeseries with a pursuit engine and return the Cluster """
+    if table is None:
+        table = overlap.get_overlap_table(grid)
+
+    layout = tfcluster.CoefficientLayout(grid, len(signal.data))
+    engine = engine_class(layout, table)
+    coeffs, residual, num_iter = engine.decompose(
+        wdm_correlations(layout, signal.data), numpy.sum(signal.data**2),
+        approx_error, max_iter)
+    profiling.annotate(template=signal.metadata, num_samples=len(signal.data),
+                       residual=residual)
+    profiling.count('num_iter', int(num_iter))
+
+    return layout.to_cluster(coeffs, signal.metadata, reject_zero_freq)
+
+@profiling.timed()
+def matching_pursuit(signal, grid, approx_error, max_iter=None,
+                     reject_zero_freq=False, table=None):
+    """
+    Return the cluster obtained by decomposing a signal with matching
+    pursuit over the multi-scale WDM dictionary of a grid.
+
+    Inputs:
+    -------
+    signal          [Timeseries object] -- input signal (its number of samples
+                                           is a multiple of the largest timescale)
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    approx_error                [float] -- relative residual energy at which
+                                           the decomposition stops
+    max_iter                 [int/None] -- maximum number of iterations
+    reject_zero_freq             [bool] -- discard pixels at zero frequency
+    table     [OverlapTable object/None] -- atom overlap table (the table of
+                                           the grid is used if None)
+
+    Output:
+    -------
+    cluster [Cluster object] -- selected pixels valued by their energy
+    """
+    return _pursuit(MatchingPursuit, signal, grid, approx_error, max_iter,
+                    reject_zero_freq, table)
+
+@profiling.timed()
+def orthogonal_matching_pursuit(signal, grid, approx_error, max_iter=None,
+                                reject_zero_freq=False, table=None):
+    """
+    Return the cluster obtained by decomposing a signal with orthogonal
+    matching pursuit over the multi-scale WDM dictionary of a grid.
+
+    Inputs and output are those of matching_pursuit().
+    """
+    return _pursuit(OrthogonalMatchingPursuit, signal, grid, approx_error,
+                    max_iter, reject_zero_freq, table)
+
+def _pursuit_batch(engine_class, signals, grid, approx_error, max_iter,
+                   reject_zero_freq, table):
+    """
+    Decompose a list of Timeseries with a pursuit engine and return the
+    Clusters. The WDM correlations of the signals of the same length are
+    computed at once, and their decompositions share the same engine
+    (and thus its memoized atom neighbourhoods).
+    """
+    import timeseries
+
+    if table is None:
+        table = overlap.get_overlap_table(grid)
+
+    profiling.annotate(num_signals=len(signals))
+    clusters = [None] * len(signals)
+    for (num_samples, indices) in timeseries.group_by_length(signals).items():
+        layout = tfcluster.CoefficientLayout(grid, num_samples)
+        engine = engine_class(layout, table)
+        stack = numpy.array([signals[n].data for n in indices])
+        correlations = wdm_correlations(layout, stack)
+        for (n, corr, energy) in zip(indices, correlations,
+                                     numpy.sum(stack**2, axis=1)):
+            coeffs, _, num_iter = engine.decompose(corr, energy, approx_error,
+                                                   max_iter)
+            profiling.count('num_iter', int(num_iter))
+            clusters[n] = layout.to_cluster(coeffs, signals[n].metadata,
+                                            reject_zero_freq)
+    return clusters
+
+@profiling.timed()
+def matching_pursuit_batch(signals, grid, approx_error, max_iter=None,
+                           reject_zero_freq=False, table=None):
+    """
+    Return the clusters of a list of signals decomposed with matching
+    pursuit (see matching_pursuit()).
+
+    Input:
+    ------
+    signals [list] -- list of Timeseries objects
+    other inputs   -- see matching_pursuit()
+
+    Output:
+    -------
+    clusters [list] -- Cluster objects, in the order of the input signals
+    """
+    return _pursuit_batch(MatchingPursuit, signals, grid, approx_error,
+                          max_iter, reject_zero_freq, table)
+
+@profiling.timed()
+def orthogonal_matching_pursuit_batch(signals, grid, approx_error,
+                                      max_iter=None, reject_zero_freq=False,
+                                      table=None):
+    """
+    Return the clusters of a list of signals decomposed with orthogonal
+    matching pursuit (see orthogonal_matching_pursuit()).
+
+    Inputs and output are those of matching_pursuit_batch().
+    """
+    return _pursuit_batch(OrthogonalMatchingPursuit, signals, grid,
+                          approx_error, max_iter, reject_zero_freq, table)
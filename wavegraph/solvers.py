@@ -0,0 +1,963 @@
+# (C) 2014-2018
+# Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
+
+# Sparse approximation solvers based on the matrix-free WDM operator of a
+# CoherentWaveBurstGrid (see watutils.WDMOperator). An operator maps a
+# flat coefficient array (see tfcluster.CoefficientLayout) to a signal
+# with synthesis(), and a signal to coefficients with analysis().
+
+import logging
+import timeit
+import numpy
+
+import profiling
+
+# WDM operators and solvers already built in this process, indexed by
+# configuration
+_OPERATORS = {}
+_SOLVERS = {}
+
+def get_operator(grid, num_samples, num_parts=2, wat_type=None):
+    """
+    Return the WDM operator of a grid for segments of num_samples samples.
+    Operators (and their work buffers) are built once per configuration.
+    """
+    import watutils
+
+    key = (tuple(int(s) for s in grid.timescales_exp), int(num_samples),
+           num_parts, wat_type)
+    if key not in _OPERATORS:
+        _OPERATORS[key] = watutils.WDMOperator(grid, num_samples, num_parts,
+                                               wat_type)
+    return _OPERATORS[key]
+
+def get_solver(solver_class, operator):
+    """
+    Return a solver of the given class for an operator. Solvers (and
+    their work buffers) are built once per operator configuration.
+    """
+    key = (solver_class.__name__,) + operator.key()
+    if key not in _SOLVERS:
+        _SOLVERS[key] = solver_class(operator)
+    return _SOLVERS[key]
+
+# Lipschitz constants (squared operator norms) already estimated in this
+# process, indexed by operator configuration
+_LIPSCHITZ = {}
+
+def lipschitz_constant(operator, num_iter=100, tol=1e-6):
+    """
+    Return the squared norm of an operator, i.e. the Lipschitz constant
+    of the gradient of the data fidelity term. It is estimated by power
+    iteration once per operator configuration.
+
+    Inputs:
+    -------
+    operator [WDMOperator object] -- matrix-free WDM operator
+    num_iter                [int] -- maximum number of power iterations
+    tol                   [float] -- relative tolerance on the estimate
+    """
+    key = operator.key()
+    if key not in _LIPSCHITZ:
+        vector = numpy.random.RandomState(0).randn(operator.layout.size)
+        vector /= numpy.linalg.norm(vector)
+        value = 0.
+        for _ in range(num_iter):
+            vector = operator.analysis(operator.synthesis(vector), out=vector)
+            previous, value = value, numpy.linalg.norm(vector)
+            vector /= value
+            if abs(value - previous) <= tol * value:
+                break
+        # Power iteration approaches the norm from below: add a small margin
+        _LIPSCHITZ[key] = value * (1. + 1e-3)
+        logging.debug("Lipschitz constant of {}: {:g}".format(key, _LIPSCHITZ[key]))
+    return _LIPSCHITZ[key]
+
+def _row_dot(a, b):
+    """ Inner products of the rows of two 2D arrays """
+    return numpy.einsum('ij,ij->i', a, b)
+
+def _ratio(num, denom, default=0.):
+    """ Elementwise num/denom, with default where denom is zero """
+    out = numpy.full(numpy.shape(num), default, dtype=float)
+    numpy.divide(num, denom, out=out, where=denom > 0)
+    return out
+
+def soft_threshold(coeffs, threshold, out=None):
+    """ Soft thresholding of a coefficient array (out may be coeffs) """
+    sign = numpy.sign(coeffs)
+    out = numpy.abs(coeffs, out=out)
+    out -= threshold
+    numpy.maximum(out, 0, out=out)
+    out *= sign
+    return out
+
+class PixelThresholder(object):
+    """
+    Hard thresholding of coefficient arrays at the pixel level: the
+    coefficients (all parts) of the pixels with the largest energies are
+    kept, the others are set to zero. The largest pixels are found with
+    a partial sort (argpartition).
+
+    All the methods also accept 2D stacks of coefficient arrays (one row
+    per template), in which case the number of pixels may differ per row.
+    """
+    def __init__(self, layout):
+        """
+        layout [CoefficientLayout object] -- coefficient layout
+        """
+        self.layout = layout
+        self.num_pixels = int(sum(f * t for (f, t) in zip(layout.num_freqs,
+                                                         layout.num_times)))
+        self._energies = numpy.empty(self.num_pixels)
+        self._offsets = numpy.concatenate(
+            ([0], numpy.cumsum(layout.num_freqs * layout.num_times)))
+
+    def _pixel_views(self, array):
+        """ (freq x time) views of a flat pixel array, one per plane """
+        lead = array.shape[:-1]
+        return [array[..., start:stop].reshape(lead + (f, t)) for \
+                (start, stop, f, t) in zip(self._offsets[:-1], self._offsets[1:],
+                                           self.layout.num_freqs,
+                                           self.layout.num_times)]
+
+    def energies(self, coeffs):
+        """ Return the pixel energies of a coefficient array (flat pixel array) """
+        if coeffs.ndim == 1:
+            energies = self._energies
+        else:
+            energies = numpy.empty((len(coeffs), self.num_pixels))
+        for (plane, energy) in zip(self.layout.planes(coeffs),
+                                   self._pixel_views(energies)):
+            numpy.einsum('...pft,...pft->...ft', plane, plane, out=energy)
+        return energies
+
+    def support(self, coeffs, num_pixels):
+        """ Return the mask of the num_pixels pixels of largest energy """
+        energies = self.energies(coeffs)
+        if coeffs.ndim > 1:
+            return self._support_batch(energies, num_pixels)
+        mask = numpy.zeros(self.num_pixels, dtype=bool)
+        if num_pixels >= self.num_pixels:
+            mask[:] = True
+        elif num_pixels > 0:
+            mask[numpy.argpartition(energies, -num_pixels)[-num_pixels:]] = True
+        return mask
+
+    def _support_batch(self, energies, num_pixels):
+        """ Masks of the largest pixels of each row, for per-row numbers of pixels """
+        num_rows = len(energies)
+        num_pixels = numpy.minimum(numpy.broadcast_to(num_pixels, (num_rows,)),
+                                   self.num_pixels)
+        mask = numpy.zeros((num_rows, self.num_pixels), dtype=bool)
+        largest = int(numpy.max(num_pixels)) if num_rows else 0
+        if largest <= 0:
+            return mask
+
+        # The largest pixels of all rows are sorted by decreasing energy, and
+        # each row keeps the first ones
+        if largest < self.num_pixels:
+            order = numpy.argpartition(-energies, largest - 1, axis=1)[:, :largest]
+        else:
+            order = numpy.tile(numpy.arange(self.num_pixels), (num_rows, 1))
+        ranks = numpy.argsort(-numpy.take_along_axis(energies, order, axis=1),
+                              axis=1, kind='stable')
+        order = numpy.take_along_axis(order, ranks, axis=1)
+        keep = numpy.arange(largest) < num_pixels[:, None]
+        rows = numpy.broadcast_to(numpy.arange(num_rows)[:, None], keep.shape)
+        mask[rows[keep], order[keep]] = True
+        return mask
+
+    def apply(self, coeffs, mask, out=None):
+        """ Zero the coefficients of the pixels out of the mask """
+        if out is None:
+            out = numpy.empty_like(coeffs)
+        for (plane_in, plane_out, keep) in zip(self.layout.planes(coeffs),
+                                               self.layout.planes(out),
+                                               self._pixel_views(mask)):
+            numpy.multiply(plane_in, keep[..., None, :, :], out=plane_out)
+        return out
+
+    def __call__(self, coeffs, num_pixels, out=None):
+        """
+        Keep the num_pixels pixels of largest energy.
+
+        Outputs:
+        --------
+        out  [Numpy Array] -- thresholded coefficients
+        mask [Numpy Array] -- mask of the kept pixels
+        """
+        mask = self.support(coeffs, num_pixels)
+        return self.apply(coeffs, mask, out), mask
+
+class IncreasingNIHT(object):
+    """
+    Increasing Normalised Iterative Hard Thresholding (INIHT).
+
+    The signal is approximated with a fixed number of pixels by the
+    normalised iterative hard thresholding (NIHT) algorithm. When the
+    iterations have converged and the residual energy is still above
+    the target, the number of pixels is increased and the iterations
+    resume from the current solution.
+
+    All the work arrays are allocated once and reused for all the
+    signals decomposed with the same object. Each decomposition returns
+    a report with per-iteration timing and convergence telemetry.
+
+    Main attributes:
+    ----------------
+    operator    -- WDM operator (see watutils.WDMOperator)
+    threshold   -- PixelThresholder object
+    """
+    # Maximum number of step size reductions in an iteration
+    MAX_SHRINK = 100
+
+    def __init__(self, operator):
+        """
+        operator [WDMOperator object] -- matrix-free WDM operator
+        """
+        self.operator = operator
+        self.threshold = PixelThresholder(operator.layout)
+
+        size = operator.layout.size
+        num_samples = operator.layout.num_samples
+        self._coeffs = numpy.empty(size)
+        self._candidate = numpy.empty(size)
+        self._gradient = numpy.empty(size)
+        self._restricted = numpy.empty(size)
+        self._residual = numpy.empty(num_samples)
+        self._synth = numpy.empty(num_samples)
+
+    @staticmethod
+    def _check_step_reduction(kappa, c):
+        """ The step size must decrease when it is divided by kappa*(1-c) """
+        if not 0 <= c < 1 or kappa * (1. - c) <= 1:
+            raise ValueError("kappa (={}) must be larger than 1/(1-c) (c={})" \
+                             .format(kappa, c))
+
+    def _step_bound(self, candidate, coeffs, c):
+        """ Maximum step size allowed when the support changes """
+        diff = candidate - coeffs
+        num = numpy.dot(diff, diff)
+        if num == 0:
+            return numpy.inf
+        synth = self.operator.synthesis(diff, out=self._synth)
+        denom = numpy.dot(synth, synth)
+        return (1. - c) * num / denom if denom > 0 else numpy.inf
+
+    def decompose(self, signal, approx_error, start_pixels, step_pixels,
+                  kappa, c, cv_threshold, max_iter=1000, verbose=False):
+        """
+        Decompose a signal.
+
+        Inputs:
+        -------
+        signal [Numpy Array] -- signal to decompose
+        approx_error [float] -- relative residual energy at which the
+                                decomposition stops
+        start_pixels   [int] -- initial number of pixels
+        step_pixels    [int] -- increment of the number of pixels
+        kappa        [float] -- step size reduction factor (> 1/(1-c))
+        c            [float] -- small constant of the step size bound
+        cv_threshold [float] -- relative change of the coefficients below
+                                which the iterations have converged
+        max_iter       [int] -- maximum number of iterations
+        verbose       [bool] -- log the telemetry of each iteration
+
+        Outputs:
+        --------
+        coeffs [Numpy Array] -- flat coefficient array (a copy)
+        report        [dict] -- number of iterations and pixels, relative
+                                residual energy, total time and list of
+                                per-iteration telemetry records
+        """
+        self._check_step_reduction(kappa, c)
+        start = timeit.default_timer()
+        operator = self.operator
+        coeffs = self._coeffs
+        candidate = self._candidate
+        gradient = self._gradient
+        restricted = self._restricted
+        residual = self._residual
+
+        energy = numpy.dot(signal, signal)
+        num_pixels = int(start_pixels)
+        telemetry = []
+
+        # Initial support from the largest pixels of the analysis of the signal
+        coeffs[:] = 0
+        residual[:] = signal
+        operator.analysis(residual, out=gradient)
+        mask = self.threshold.support(gradient, num_pixels)
+        res_energy = energy
+
+        num_iter = 0
+        while num_iter < max_iter:
+
+            tic = timeit.default_timer()
+
+            # Step size from the gradient restricted to the support
+            self.threshold.apply(gradient, mask, out=restricted)
+            synth = operator.synthesis(restricted, out=self._synth)
+            denom = numpy.dot(synth, synth)
+            step = numpy.dot(restricted, restricted) / denom if denom > 0 else 0.
+
+            # Gradient step and hard thresholding
+            numpy.multiply(gradient, step, out=candidate)
+            candidate += coeffs
+            candidate, new_mask = self.threshold(candidate, num_pixels, out=candidate)
+
+            # Shrink the step if the support has changed and the step
+            # size is too large to guarantee convergence
+            if not numpy.array_equal(new_mask, mask):
+                num_shrink = 0
+                while step > self._step_bound(candidate, coeffs, c):
+                    if num_shrink == self.MAX_SHRINK:
+                        logging.warning("INIHT: step size bound not reached after " \
+                                        "{} reductions".format(num_shrink))
+                        break
+                    num_shrink += 1
+                    step /= kappa * (1. - c)
+                    numpy.multiply(gradient, step, out=candidate)
+                    candidate += coeffs
+                    candidate, new_mask = self.threshold(candidate, num_pixels,
+                                                         out=candidate)
+
+            numpy.subtract(candidate, coeffs, out=restricted)
+            change = numpy.linalg.norm(restricted)
+            coeffs, candidate = candidate, coeffs
+            mask = new_mask
+            norm = numpy.linalg.norm(coeffs)
+            change = change / norm if norm > 0 else 0.
+
+            # New residual and gradient
+            operator.synthesis(coeffs, out=residual)
+            numpy.subtract(signal, residual, out=residual)
+            operator.analysis(residual, out=gradient)
+            res_energy = numpy.dot(residual, residual)
+
+            num_iter += 1
+            record = {'iteration': num_iter,
+                      'time': timeit.default_timer() - tic,
+                      'num_pixels': num_pixels,
+                      'step': step,
+                      'change': change,
+                      'residual': res_energy / energy if energy > 0 else 0.}
+            telemetry.append(record)
+            if verbose:
+                logging.debug("INIHT: {}".format(record))
+
+            if res_energy <= approx_error * energy:
+                break
+
+            # Converged with the current number of pixels: increase it
+            if change < cv_threshold:
+                if num_pixels >= self.threshold.num_pixels:
+                    break
+                num_pixels += int(step_pixels)
+                mask = self.threshold.support(coeffs + gradient, num_pixels)
+
+        # Keep the work arrays attached to the object
+        self._coeffs, self._candidate = coeffs, candidate
+
+        report = {'num_iter': num_iter,
+                  'num_pixels': num_pixels,
+                  'residual': res_energy / energy if energy > 0 else 0.,
+                  'time': timeit.default_timer() - start,
+                  'telemetry': telemetry}
+
+        logging.debug("INIHT: {} iterations, {} pixels, residual energy {:g}, " \
+                      "{:.3f} s".format(num_iter, num_pixels, report['residual'],
+                                        report['time']))
+
+        return coeffs.copy(), report
+
+    def _step_bound_batch(self, candidate, coeffs, c):
+        """ Maximum step sizes allowed when the supports change (2D stacks) """
+        diff = candidate - coeffs
+        synth = self.operator.synthesis(diff)
+        return _ratio((1. - c) * _row_dot(diff, diff), _row_dot(synth, synth),
+                      numpy.inf)
+
+    def decompose_batch(self, signals, approx_error, start_pixels, step_pixels,
+                        kappa, c, cv_threshold, max_iter=1000):
+        """
+        Decompose a stack of signals of the same length simultaneously.
+
+        The hard thresholding, step size computations and convergence
+        tests of all the signals are vectorized over the stack of the
+        signals whose decomposition is still running. The operator
+        itself is applied signal by signal (see WDMOperator.analysis()
+        and synthesis()), so its cost is not reduced by the batching.
+        A signal drops out of the stack as soon as its decomposition
+        ends. The result for each signal is that of decompose().
+
+        Inputs:
+        -------
+        signals [Numpy Array] -- (signal x sample) stack of signals
+        other inputs          -- see decompose()
+
+        Outputs:
+        --------
+        coeffs [Numpy Array] -- (signal x size) coefficient arrays
+        report        [dict] -- per-signal number of iterations and pixels,
+                                relative residual energy, and total time
+        """
+        self._check_step_reduction(kappa, c)
+        start = timeit.default_timer()
+        operator = self.operator
+        signals = numpy.atleast_2d(signals)
+        num_signals = len(signals)
+
+        energy = _row_dot(signals, signals)
+        res_energy = energy.copy()
+        num_pixels = numpy.full(num_signals, int(start_pixels))
+        num_iter = numpy.zeros(num_signals, dtype=int)
+
+        coeffs = numpy.zeros((num_signals, operator.layout.size))
+        gradient = operator.analysis(signals)
+        mask = self.threshold.support(gradient, num_pixels)
+
+        active = numpy.arange(num_signals)
+        while len(active):
+
+            current = coeffs[active]
+            grad = gradient[active]
+            pixels = num_pixels[active]
+
+            # Step sizes from the gradients restricted to the supports
+            restricted = self.threshold.apply(grad, mask[active])
+            synth = operator.synthesis(restricted)
+            step = _ratio(_row_dot(restricted, restricted), _row_dot(synth, synth))
+
+            # Gradient steps and hard thresholding
+            candidate, new_mask = self.threshold(current + step[:, None] * grad,
+                                                 pixels)
+
+            # Shrink the steps of the signals whose support has changed
+            # while the step size is too large
+            rows = numpy.flatnonzero(numpy.any(new_mask != mask[active], axis=1))
+            num_shrink = 0
+            while len(rows):
+                rows = rows[step[rows] > self._step_bound_batch(
+                    candidate[rows], current[rows], c)]
+                if len(rows) and num_shrink == self.MAX_SHRINK:
+                    logging.warning("INIHT: step size bound not reached after " \
+                                    "{} reductions".format(num_shrink))
+                    break
+                num_shrink += 1
+                step[rows] /= kappa * (1. - c)
+                candidate[rows], new_mask[rows] = self.threshold(
+                    current[rows] + step[rows, None] * grad[rows], pixels[rows])
+
+            change = _ratio(numpy.linalg.norm(candidate - current, axis=1),
+                            numpy.linalg.norm(candidate, axis=1))
+
+            # New residuals and gradients
+            residual = signals[active] - operator.synthesis(candidate)
+            grad = operator.analysis(residual)
+            res = _row_dot(residual, residual)
+            num_iter[active] += 1
+
+            done = (res <= approx_error * energy[active]) \
+                   | (num_iter[active] >= max_iter)
+
+            # Converged with the current number of pixels: increase it
+            grow = ~done & (change < cv_threshold)
+            done |= grow & (pixels >= self.threshold.num_pixels)
+            grow &= ~done
+            if numpy.any(grow):
+                pixels[grow] += int(step_pixels)
+                new_mask[grow] = self.threshold.support(candidate[grow] + grad[grow],
+                                                        pixels[grow])
+
+            coeffs[active] = candidate
+            gradient[active] = grad
+            mask[active] = new_mask
+            num_pixels[active] = pixels
+            res_energy[active] = res
+            active = active[~done]
+
+        report = {'num_iter': num_iter,
+                  'num_pixels': num_pixels,
+                  'residual': _ratio(res_energy, energy),
+                  'time': timeit.default_timer() - start}
+
+        logging.debug("INIHT: {} signals, {} iterations, {:.3f} s".format(
+            num_signals, numpy.sum(num_iter), report['time']))
+
+        return coeffs, report
+
+@profiling.timed()
+def iniht(signal, grid, approx_error, start_pixels, step_pixels, kappa, c,
+          cv_threshold, max_iter=1000, reject_zero_freq=False, verbose=False):
+    """
+    Return the cluster obtained by decomposing a signal with the INIHT
+    algorithm over the multi-scale WDM dictionary of a grid.
+
+    Inputs:
+    -------
+    signal          [Timeseries object] -- input signal (its number of samples
+                                           is a multiple of the largest timescale)
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    reject_zero_freq             [bool] -- discard pixels at zero frequency
+    other inputs                        -- see IncreasingNIHT.decompose()
+
+    Output:
+    -------
+    cluster [Cluster object] -- selected pixels valued by their energy
+    """
+    operator = get_operator(grid, len(signal.data))
+    coeffs, report = get_solver(IncreasingNIHT, operator).decompose(
+        signal.data, approx_error, start_pixels, step_pixels, kappa, c,
+        cv_threshold, max_iter, verbose)
+    profiling.annotate(template=signal.metadata, num_samples=len(signal.data),
+                       num_pixels=report['num_pixels'], residual=report['residual'])
+    profiling.count('num_iter', report['num_iter'])
+
+    return operator.layout.to_cluster(coeffs, signal.metadata, reject_zero_freq)
+
+@profiling.timed()
+def iniht_batch(signals, grid, approx_error, start_pixels, step_pixels, kappa,
+                c, cv_threshold, max_iter=1000, reject_zero_freq=False):
+    """
+    Return the clusters of a list of signals decomposed with the INIHT
+    algorithm. The signals of the same length are decomposed together
+    (see IncreasingNIHT.decompose_batch()).
+
+    Inputs:
+    -------
+    signals [list] -- list of Timeseries objects
+    other inputs   -- see iniht()
+
+    Output:
+    -------
+    clusters [list] -- Cluster objects, in the order of the input signals
+    """
+    import timeseries
+
+    profiling.annotate(num_signals=len(signals))
+    clusters = [None] * len(signals)
+    for (num_samples, indices) in timeseries.group_by_length(signals).items():
+        operator = get_operator(grid, num_samples)
+        coeffs, report = get_solver(IncreasingNIHT, operator).decompose_batch(
+            numpy.array([signals[n].data for n in indices]), approx_error,
+            start_pixels, step_pixels, kappa, c, cv_threshold, max_iter)
+        profiling.count('num_iter', int(numpy.sum(report['num_iter'])))
+        for (n, row) in zip(indices, coeffs):
+            clusters[n] = operator.layout.to_cluster(row, signals[n].metadata,
+                                                     reject_zero_freq)
+    return clusters
+
+class ProximalBPDN(object):
+    """
+    Constrained basis pursuit denoising (CBPDN) with proximal gradient
+    solvers.
+
+    The constrained problem (minimum l1 norm with a residual energy
+    below a fraction of the signal energy) is solved by continuation
+    over the penalized problem
+
+        min_x 1/2 ||y - A x||^2 + lambda ||x||_1,
+
+    whose penalty lambda is divided by kappa until the residual energy
+    constraint is met. Each penalized problem is solved by FISTA with
+    adaptive (gradient-based) restart, or by ISTA, with the step size
+    given by the cached Lipschitz constant of the operator, starting
+    from the previous solution.
+
+    Main attributes:
+    ----------------
+    operator  -- WDM operator (see watutils.WDMOperator)
+    lipschitz -- Lipschitz constant of the operator
+    """
+    SOLVERS = ('fista', 'ista')
+
+    def __init__(self, operator):
+        """
+        operator [WDMOperator object] -- matrix-free WDM operator
+        """
+        self.operator = operator
+        self.lipschitz = lipschitz_constant(operator)
+
+        size = operator.layout.size
+        num_samples = operator.layout.num_samples
+        self._coeffs = numpy.empty(size)
+        self._previous = numpy.empty(size)
+        self._momentum = numpy.empty(size)
+        self._gradient = numpy.empty(size)
+        self._residual = numpy.empty(num_samples)
+
+    def _gradient_step(self, point, signal, penalty, out):
+        """ Proximal gradient step from point, written into out """
+        residual = self.operator.synthesis(point, out=self._residual)
+        numpy.subtract(signal, residual, out=residual)
+        gradient = self.operator.analysis(residual, out=self._gradient)
+        numpy.multiply(gradient, 1. / self.lipschitz, out=out)
+        out += point
+        return soft_threshold(out, penalty / self.lipschitz, out=out)
+
+    def solve(self, signal, penalty, x0=None, solver='fista',
+              cv_threshold=1e-6, max_iter=10000):
+        """
+        Solve the penalized problem for a given penalty.
+
+        Inputs:
+        -------
+        signal  [Numpy Array] -- signal to decompose
+        penalty       [float] -- l1 penalty lambda
+        x0 [Numpy Array/None] -- initial coefficients (warm start)
+        solver          [str] -- 'fista' or 'ista'
+        cv_threshold  [float] -- relative change of the coefficients
+                                 below which the iterations stop
+        max_iter        [int] -- maximum number of iterations
+
+        Outputs:
+        --------
+        coeffs [Numpy Array] -- coefficients (work array of the object)
+        num_iter       [int] -- number of iterations
+        """
+        if solver not in self.SOLVERS:
+            raise ValueError("Unknown solver {}".format(solver))
+
+        coeffs = self._coeffs
+        previous = self._previous
+        momentum = self._momentum
+        if x0 is None:
+            coeffs[:] = 0
+        else:
+            coeffs[:] = x0
+        momentum[:] = coeffs
+        t = 1.
+
+        num_iter = 0
+        while num_iter < max_iter:
+
+            previous[:] = coeffs
+            self._gradient_step(momentum if solver == 'fista' else previous,
+                                signal, penalty, coeffs)
+            num_iter += 1
+
+            diff = coeffs - previous
+            norm = numpy.linalg.norm(coeffs)
+            if norm == 0 or numpy.linalg.norm(diff) < cv_threshold * norm:
+                break
+
+            if solver == 'fista':
+                # Adaptive restart when the momentum opposes the progress
+                if numpy.dot(momentum - coeffs, diff) > 0:
+                    t = 1.
+                t_next = (1. + numpy.sqrt(1. + 4. * t**2)) / 2.
+                numpy.multiply(diff, (t - 1.) / t_next, out=momentum)
+                momentum += coeffs
+                t = t_next
+
+        return coeffs, num_iter
+
+    def decompose(self, signal, approx_error, gamma, kappa, cv_threshold,
+                  cv_diff, x0=None, solver='fista', max_iter=10000):
+        """
+        Decompose a signal by continuation over the l1 penalty.
+
+        Inputs:
+        -------
+        signal  [Numpy Array] -- signal to decompose
+        approx_error  [float] -- relative residual energy to reach
+        gamma         [float] -- initial penalty, relative to the largest
+                                 absolute WDM coefficient of the signal
+        kappa         [float] -- penalty reduction factor between two
+                                 continuation steps (> 1)
+        cv_threshold  [float] -- see solve()
+        cv_diff       [float] -- stop the continuation when the relative
+                                 residual energy decreases by less than
+                                 cv_diff between two steps
+        x0 [Numpy Array/None] -- initial coefficients (warm start, e.g. the
+                                 solution of a neighbouring template)
+        solver          [str] -- 'fista' or 'ista'
+        max_iter        [int] -- maximum total number of iterations
+
+        Outputs:
+        --------
+        coeffs [Numpy Array] -- flat coefficient array (a copy)
+        report        [dict] -- number of iterations and continuation steps,
+                                final penalty and relative residual energy
+        """
+        start = timeit.default_timer()
+        energy = numpy.dot(signal, signal)
+        penalty = gamma * numpy.max(numpy.abs(
+            self.operator.analysis(signal, out=self._gradient)))
+
+        coeffs = x0
+        num_iter = 0
+        num_steps = 0
+        rel_residual = numpy.inf
+        while num_iter < max_iter:
+
+            coeffs, n = self.solve(signal, penalty, coeffs, solver,
+                                   cv_threshold, max_iter - num_iter)
+            num_iter += n
+            num_steps += 1
+
+            residual = self.operator.synthesis(coeffs, out=self._residual)
+            numpy.subtract(signal, residual, out=residual)
+            previous, rel_residual = rel_residual, \
+                numpy.dot(residual, residual) / energy if energy > 0 else 0.
+
+            logging.debug("CBPDN: penalty {:g}, {} iterations, residual energy {:g}" \
+                          .format(penalty, n, rel_residual))
+
+            if rel_residual <= approx_error or previous - rel_residual < cv_diff * previous:
+                break
+
+            penalty /= kappa
+
+        report = {'num_iter': num_iter,
+                  'num_steps': num_steps,
+                  'penalty': penalty,
+                  'residual': rel_residual,
+                  'time': timeit.default_timer() - start}
+
+        return coeffs.copy(), report
+
+    def decompose_batch(self, signals, approx_error, gamma, kappa, cv_threshold,
+                        cv_diff, x0=None, solver='fista', max_iter=10000):
+        """
+        Decompose a stack of signals of the same length simultaneously.
+
+        The proximal gradient updates of all the signals are vectorized,
+        each signal having its own penalty, momentum and continuation
+        state. The operator itself is applied signal by signal (see
+        WDMOperator.analysis() and synthesis()). A signal drops out of
+        the stack as soon as its decomposition ends. The result for each
+        signal is that of decompose().
+
+        Inputs:
+        -------
+        signals [Numpy Array] -- (signal x sample) stack of signals
+        x0 [Numpy Array/None] -- initial coefficients, common to all the
+                                 signals or one row per signal
+        other inputs          -- see decompose()
+
+        Outputs:
+        --------
+        coeffs [Numpy Array] -- (signal x size) coefficient arrays
+        report        [dict] -- per-signal number of iterations and
+                                continuation steps, final penalty and
+                                relative residual energy, and total time
+        """
+        if solver not in self.SOLVERS:
+            raise ValueError("Unknown solver {}".format(solver))
+
+        start = timeit.default_timer()
+        operator = self.operator
+        signals = numpy.atleast_2d(signals)
+        num_signals = len(signals)
+
+        energy = _row_dot(signals, signals)
+        penalty = gamma * numpy.max(numpy.abs(operator.analysis(signals)), axis=1)
+
+        coeffs = numpy.zeros((num_signals, operator.layout.size))
+        if x0 is not None:
+            coeffs[:] = x0
+        momentum = coeffs.copy()
+        t = numpy.ones(num_signals)
+
+        num_iter = numpy.zeros(num_signals, dtype=int)
+        num_steps = numpy.zeros(num_signals, dtype=int)
+        rel_residual = numpy.full(num_signals, numpy.inf)
+
+        active = numpy.arange(num_signals)
+        while len(active):
+
+            # Proximal gradient steps
+            current = coeffs[active]
+            point = momentum[active] if solver == 'fista' else current
+            residual = signals[active] - operator.synthesis(point)
+            candidate = operator.analysis(residual)
+            candidate /= self.lipschitz
+            candidate += point
+            soft_threshold(candidate, penalty[active, None] / self.lipschitz,
+                           out=candidate)
+            num_iter[active] += 1
+
+            diff = candidate - current
+            norm = numpy.linalg.norm(candidate, axis=1)
+            solved = (norm == 0) \
+                     | (numpy.linalg.norm(diff, axis=1) < cv_threshold * norm) \
+                     | (num_iter[active] >= max_iter)
+
+            if solver == 'fista':
+                # Adaptive restart when the momentum opposes the progress
+                t_active = t[active]
+                t_active[_row_dot(point - candidate, diff) > 0] = 1.
+                t_next = (1. + numpy.sqrt(1. + 4. * t_active**2)) / 2.
+                momentum[active] = candidate + ((t_active - 1.) / t_next)[:, None] * diff
+                t[active] = t_next
+
+            coeffs[active] = candidate
+
+            # End of a continuation step for the signals whose penalized
+            # problem is solved
+            finished = numpy.zeros(len(active), dtype=bool)
+            if numpy.any(solved):
+                rows = active[solved]
+                residual = signals[rows] - operator.synthesis(coeffs[rows])
+                previous = rel_residual[rows]
+                current_residual = _ratio(_row_dot(residual, residual), energy[rows])
+                rel_residual[rows] = current_residual
+                num_steps[rows] += 1
+
+                stop = (current_residual <= approx_error) \
+                       | (previous - current_residual < cv_diff * previous) \
+                       | (num_iter[rows] >= max_iter)
+                finished[solved] = stop
+
+                rows = rows[~stop]
+                penalty[rows] /= kappa
+                momentum[rows] = coeffs[rows]
+                t[rows] = 1.
+
+            active = active[~finished]
+
+        report = {'num_iter': num_iter,
+                  'num_steps': num_steps,
+                  'penalty': penalty,
+                  'residual': rel_residual,
+                  'time': timeit.default_timer() - start}
+
+        logging.debug("CBPDN: {} signals, {} iterations, {:.3f} s".format(
+            num_signals, numpy.sum(num_iter), report['time']))
+
+        return coeffs, report
+
+@profiling.timed()
+def cbpdn(signal, grid, approx_error, gamma, kappa, cv_threshold, cv_diff,
+          bpdn_solver='fista', x0=None, max_iter=10000, reject_zero_freq=False):
+    """
+    Return the cluster obtained by decomposing a signal with constrained
+    basis pursuit denoising over the multi-scale WDM dictionary of a grid.
+
+    Inputs:
+    -------
+    signal          [Timeseries object] -- input signal (its number of samples
+                                           is a multiple of the largest timescale)
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    bpdn_solver                   [str] -- 'fista' or 'ista'
+    reject_zero_freq             [bool] -- discard pixels at zero frequency
+    other inputs                        -- see ProximalBPDN.decompose()
+
+    Outputs:
+    --------
+    cluster [Cluster object] -- selected pixels valued by their energy
+    coeffs  [Numpy Array]    -- coefficients (warm start for the next template)
+    """
+    operator = get_operator(grid, len(signal.data))
+    coeffs, report = get_solver(ProximalBPDN, operator).decompose(
+        signal.data, approx_error, gamma, kappa, cv_threshold, cv_diff,
+        x0, bpdn_solver, max_iter)
+    profiling.annotate(template=signal.metadata, num_samples=len(signal.data),
+                       num_steps=report['num_steps'], residual=report['residual'],
+                       warm_start=x0 is not None)
+    profiling.count('num_iter', report['num_iter'])
+
+    return operator.layout.to_cluster(coeffs, signal.metadata,
+                                      reject_zero_freq), coeffs
+
+def warm_start_order(signals):
+    """
+    Return the order in which a bank of templates is best decomposed with
+    warm starts: CBC templates are sorted by chirp mass, so that each
+    template follows its closest neighbour. Other templates keep their order.
+
+    Input:
+    ------
+    signals [list] -- list of Timeseries objects
+
+    Output:
+    -------
+    order [list] -- indices of the templates
+    """
+    import cbc
+
+    sources = [cbc.parse_description(s.metadata) for s in signals]
+    if any(source is None for source in sources):
+        return list(range(len(signals)))
+    return sorted(range(len(signals)), key=lambda n: sources[n].chirp_mass())
+
+def cbpdn_bank(signals, grid, approx_error, gamma, kappa, cv_threshold,
+               cv_diff, bpdn_solver='fista', max_iter=10000,
+               reject_zero_freq=False):
+    """
+    Return the clusters of a bank of templates decomposed with cbpdn().
+    The templates are processed in chirp mass order, each decomposition
+    being warm-started with the solution of the previous template
+    of the same length.
+
+    Inputs:
+    -------
+    signals [list] -- list of Timeseries objects
+    other inputs   -- see cbpdn()
+
+    Output:
+    -------
+    clusters [list] -- Cluster objects, in the order of the input templates
+    """
+    clusters = [None] * len(signals)
+    solutions = {}
+    for n in warm_start_order(signals):
+        signal = signals[n]
+        clusters[n], solutions[len(signal.data)] = cbpdn(
+            signal, grid, approx_error, gamma, kappa, cv_threshold, cv_diff,
+            bpdn_solver, solutions.get(len(signal.data)), max_iter,
+            reject_zero_freq)
+    return clusters
+
+@profiling.timed()
+def cbpdn_batch(signals, grid, approx_error, gamma, kappa, cv_threshold,
+                cv_diff, bpdn_solver='fista', max_iter=10000,
+                reject_zero_freq=False, batch_size=16):
+    """
+    Return the clusters of a list of signals decomposed with constrained
+    basis pursuit denoising. The signals of the same length are
+    decomposed by batches (see ProximalBPDN.decompose_batch()).
+
+    As in cbpdn_bank(), the templates are taken in chirp mass order
+    (see warm_start_order()), and split into interleaved batches: batch
+    k holds the templates k, k + K, k + 2K... of that order (K batches).
+    Each template of a batch is thus warm-started with the solution of
+    the template that precedes it, solved in the previous batch.
+
+    Inputs:
+    -------
+    signals [list] -- list of Timeseries objects
+    batch_size [int] -- maximum number of templates decomposed together
+    other inputs   -- see cbpdn()
+
+    Output:
+    -------
+    clusters [list] -- Cluster objects, in the order of the input signals
+    """
+    import timeseries
+
+    profiling.annotate(num_signals=len(signals))
+    clusters = [None] * len(signals)
+    groups = timeseries.group_by_length(signals)
+    rank = dict((n, r) for (r, n) in enumerate(warm_start_order(signals)))
+    for (num_samples, indices) in groups.items():
+        operator = get_operator(grid, num_samples)
+        solver = get_solver(ProximalBPDN, operator)
+        order = sorted(indices, key=rank.get)
+        num_batches = -(-len(order) // int(batch_size))
+        x0 = None
+        for k in range(num_batches):
+            batch = order[k::num_batches]
+            coeffs, report = solver.decompose_batch(
+                numpy.array([signals[n].data for n in batch]), approx_error,
+                gamma, kappa, cv_threshold, cv_diff,
+                None if x0 is None else x0[:len(batch)], bpdn_solver, max_iter)
+            profiling.count('num_iter', int(numpy.sum(report['num_iter'])))
+            x0 = coeffs
+            for (n, row) in zip(batch, coeffs):
+                clusters[n] = operator.layout.to_cluster(row, signals[n].metadata,
+                                                         reject_zero_freq)
+    return clusters
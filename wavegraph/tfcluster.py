@@ -5,12 +5,17 @@ import numpy
 import os
 import itertools
 import collections
-import h5py
 import getpass
 import time
 import subprocess
 import logging
 
+try:
+    from . import profiling
+except (ImportError, ValueError):
+    # Module imported from the wavegraph directory (e.g. "import timeseries")
+    import profiling
+
 class CoherentWaveBurstGrid(object):
     """
     Time-frequency-scale grid associated to the WDM transform used by
@@ -90,6 +95,10 @@ class Cluster(ClusterNamedTuple):
         instance.metadata = metadata
         return instance
 
+    def __getnewargs__(self):
+        """ Arguments of __new__() used when unpickling """
+        return (self.grid_points, self.values, self.metadata)
+
     @classmethod
     def from_numpyarray(cls, array, metadata):
         """
@@ -134,6 +143,247 @@ class Cluster(ClusterNamedTuple):
                        for (val, gp) in zip(self.values, self.grid_points)]
         return numpy.array(phys_values)
 
+class ClusterSet(object):
+    """
+    Set of clusters stored in packed arrays: the pixels of all the
+    clusters are concatenated, the pixels of cluster n being those of
+    indices offsets[n] to offsets[n+1]. Operations on the pixels of a
+    whole bank of clusters are then single array operations.
+
+    Main attributes:
+    ----------------
+    scale_index, time_index, freq_index -- pixel coordinates (integer arrays)
+    values   -- pixel values
+    offsets  -- index of the first pixel of each cluster (and total number
+                of pixels)
+    metadata -- list of the description strings of the clusters
+    """
+    # Keys available for ordering the pixels
+    KEYS = ('scale', 'time', 'frequency', 'value', 'phys_time', 'phys_frequency')
+
+    def __init__(self, scale_index, time_index, freq_index, values, offsets,
+                 metadata):
+        self.scale_index = numpy.asarray(scale_index, dtype=int)
+        self.time_index = numpy.asarray(time_index, dtype=int)
+        self.freq_index = numpy.asarray(freq_index, dtype=int)
+        self.values = numpy.asarray(values, dtype=float)
+        self.offsets = numpy.asarray(offsets, dtype=int)
+        self.metadata = list(metadata)
+
+    @classmethod
+    def from_clusters(cls, clusters):
+        """ Pack a list of Cluster objects """
+        sizes = [len(cluster.grid_points) for cluster in clusters]
+        points = numpy.array([p for cluster in clusters for p in cluster.grid_points],
+                             dtype=int).reshape(-1, 3)
+        values = [v for cluster in clusters for v in cluster.values]
+        return cls(points[:, 0], points[:, 1], points[:, 2], values,
+                   numpy.concatenate(([0], numpy.cumsum(sizes, dtype=int))),
+                   [cluster.metadata for cluster in clusters])
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def cluster_ids(self):
+        """ Return the index of the cluster of each pixel """
+        return numpy.repeat(numpy.arange(len(self)), numpy.diff(self.offsets))
+
+    def cluster(self, n):
+        """ Return cluster n as a Cluster object """
+        start, stop = self.offsets[n], self.offsets[n+1]
+        return Cluster([GridPoint(*p) for p in zip(
+                           self.scale_index[start:stop].tolist(),
+                           self.time_index[start:stop].tolist(),
+                           self.freq_index[start:stop].tolist())],
+                       self.values[start:stop].tolist(),
+                       self.metadata[n])
+
+    def to_clusters(self):
+        """ Return the list of Cluster objects """
+        return [self.cluster(n) for n in range(len(self))]
+
+    def key(self, name, grid=None):
+        """
+        Return the values of an ordering key for all the pixels.
+
+        name [str] -- one of KEYS. Physical keys require the grid
+        grid [CoherentWaveBurstGrid object/None] -- cWB grid
+        """
+        if name == 'scale':
+            return self.scale_index
+        if name == 'time':
+            return self.time_index
+        if name == 'frequency':
+            return self.freq_index
+        if name == 'value':
+            return self.values
+        if name not in self.KEYS:
+            raise ValueError("Unknown ordering key {} (valid keys: {})".format(
+                name, ', '.join(self.KEYS)))
+        if grid is None:
+            raise ValueError("Ordering key {} requires the grid".format(name))
+        timescales = grid.timescales[self.scale_index]
+        if name == 'phys_time':
+            return self.time_index * timescales
+        return self.freq_index / (2 * timescales)
+
+    def order(self, ordering, grid=None):
+        """
+        Return the permutation of the pixels that sorts the pixels of each
+        cluster lexicographically (the clusters keep their order).
+
+        ordering [list] -- ordering keys (see KEYS), by decreasing priority.
+                           A key prefixed with '-' is sorted in decreasing order
+        grid [CoherentWaveBurstGrid object/None] -- cWB grid (for physical keys)
+        """
+        keys = []
+        for name in ordering:
+            if name.startswith('-'):
+                keys.append(-self.key(name[1:], grid))
+            else:
+                keys.append(self.key(name, grid))
+        # numpy.lexsort sorts by its last key first: the cluster index
+        # comes last so that the sort is segmented by cluster
+        return numpy.lexsort(keys[::-1] + [self.cluster_ids()])
+
+    def sorted(self, ordering, grid=None):
+        """ Return the ClusterSet with the pixels of each cluster sorted (see order()) """
+        perm = self.order(ordering, grid)
+        return ClusterSet(self.scale_index[perm], self.time_index[perm],
+                          self.freq_index[perm], self.values[perm],
+                          self.offsets, self.metadata)
+
+def sort_clusters(clusters, ordering, grid=None):
+    """
+    Return clusters whose pixels are sorted lexicographically by the
+    given keys (see ClusterSet.order()). The pixel order defines the
+    edges of the graph built from the clusters.
+
+    clusters [list] -- list of Cluster objects
+    ordering [list] -- ordering keys, e.g. ['frequency', 'time']
+    grid [CoherentWaveBurstGrid object/None] -- cWB grid (for physical keys)
+    """
+    return ClusterSet.from_clusters(clusters).sorted(ordering, grid).to_clusters()
+
+class CoefficientLayout(object):
+    """
+    Layout of the WDM coefficients of a segment over all the planes of a
+    CoherentWaveBurstGrid, stored in a single flat array.
+
+    The coefficients of each plane are stored as a (part x freq x time)
+    block, where part 0 holds the direct coefficients and part 1 (if
+    any) the dual coefficients. The blocks are concatenated by
+    increasing scale. Leading dimensions (e.g. templates) are allowed
+    in front of the flat dimension.
+
+    Main attributes:
+    ----------------
+    grid        -- CoherentWaveBurstGrid object
+    num_samples -- number of samples of the segment
+    num_parts   -- 2 with the dual coefficients, 1 without
+    num_layers  -- number of layers 2**scale of each plane
+    num_freqs, num_times -- number of frequency and time bins of each plane
+    offsets     -- index of the first coefficient of each plane
+    size        -- total number of coefficients
+    """
+    def __init__(self, grid, num_samples, num_parts=2):
+        """
+        grid [CoherentWaveBurstGrid object] -- cWB grid
+        num_samples                   [int] -- number of samples of the segment
+        num_parts                     [int] -- 2 to include the dual coefficients,
+                                               1 otherwise
+        """
+        self.grid = grid
+        self.num_samples = int(num_samples)
+        self.num_parts = int(num_parts)
+        self.num_layers = 2**numpy.asarray(grid.timescales_exp, dtype=int)
+
+        if self.num_samples % self.num_layers[-1]:
+            raise ValueError("The number of samples (={}) is not a multiple " \
+                             "of the largest timescale (={} samples)".format(
+                                 self.num_samples, self.num_layers[-1]))
+
+        self.num_freqs = self.num_layers + 1
+        self.num_times = self.num_samples // self.num_layers
+        self.shapes = [(self.num_parts, f, t) \
+                       for (f, t) in zip(self.num_freqs, self.num_times)]
+        self.offsets = numpy.concatenate(
+            ([0], numpy.cumsum([numpy.prod(s) for s in self.shapes])))
+        self.size = int(self.offsets[-1])
+
+    def planes(self, coeffs):
+        """
+        Return the views on the (part x freq x time) block of each plane
+        of a coefficient array of shape (..., size).
+        """
+        return [coeffs[..., start:stop].reshape(coeffs.shape[:-1] + shape) \
+                for (start, stop, shape) in zip(self.offsets[:-1],
+                                                self.offsets[1:],
+                                                self.shapes)]
+
+    def join(self, planes, out=None):
+        """
+        Return the flat coefficient array of a list of (part x freq x time)
+        blocks (with optional leading dimensions), one per plane.
+        """
+        if out is None:
+            out = numpy.empty(planes[0].shape[:-3] + (self.size,))
+        for (view, plane) in zip(self.planes(out), planes):
+            view[...] = plane
+        return out
+
+    def ravel_index(self, scale_index, part, freq_index, time_index):
+        """ Return the flat index of coefficients given by their coordinates """
+        scale_index = numpy.asarray(scale_index)
+        num_freqs = self.num_freqs[scale_index]
+        num_times = self.num_times[scale_index]
+        return self.offsets[scale_index] \
+               + (numpy.asarray(part) * num_freqs + freq_index) * num_times \
+               + time_index
+
+    def unravel_index(self, index):
+        """
+        Return the coordinates (scale_index, part, freq_index, time_index)
+        of coefficients given by their flat indices.
+        """
+        index = numpy.asarray(index)
+        scale_index = numpy.searchsorted(self.offsets, index, side='right') - 1
+        rem = index - self.offsets[scale_index]
+        rem, time_index = numpy.divmod(rem, self.num_times[scale_index])
+        part, freq_index = numpy.divmod(rem, self.num_freqs[scale_index])
+        return scale_index, part, freq_index, time_index
+
+    def energy_maps(self, coeffs):
+        """
+        Return the pixel energies (sum of the squared coefficients of
+        all the parts) as a list of (freq x time) maps, one per plane.
+        """
+        return [numpy.sum(plane**2, axis=-3) for plane in self.planes(coeffs)]
+
+    def to_cluster(self, coeffs, metadata, reject_zero_freq=False):
+        """
+        Return the Cluster made of the pixels with non-zero coefficients,
+        valued by their energy.
+
+        Inputs:
+        -------
+        coeffs      [Numpy Array] -- flat coefficient array
+        metadata            [str] -- description string of the cluster
+        reject_zero_freq   [bool] -- if True, pixels at zero frequency are
+                                     discarded
+        """
+        grid_points = []
+        values = []
+        for (scale_index, energy) in enumerate(self.energy_maps(coeffs)):
+            if reject_zero_freq:
+                energy[0, :] = 0
+            freq_index, time_index = numpy.nonzero(energy)
+            grid_points.extend(GridPoint(scale_index, t, f) \
+                               for (f, t) in zip(freq_index, time_index))
+            values.extend(energy[freq_index, time_index])
+
+        return Cluster(grid_points, values, metadata)
+
 def shift_clusters_to_zero_index(clusters, grid):
     """ 
     Shift all computed clusters to zero time index.
@@ -167,6 +417,84 @@ def shift_clusters_to_zero_index(clusters, grid):
         )
             for cluster in clusters]
 
+def shift_clusters(clusters, grid, steps, num_samples=None):
+    """
+    Shift clusters in time by a number of time steps of the largest
+    timescale of the grid. This is the only time shift that maps exactly
+    to a time index shift on every plane.
+
+    clusters [list] -- list of Cluster objects
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    steps [int] -- time shift in units of the largest timescale
+    num_samples [int/None] -- if given, the time indices are wrapped around
+                              a segment of num_samples samples (circular shift)
+    """
+    scale_index_max = len(grid.timescales_exp) - 1
+
+    if num_samples is not None \
+       and (num_samples // 2**int(grid.timescales_exp[-1])) % 2:
+        # With an odd number of time bins at the largest scale, the parity
+        # of the wrapped time indices flips, and the direct and dual
+        # coefficients do not map onto each other across the wrap:
+        raise ValueError("Circular shifts require an even number of time " \
+                         "bins at the largest timescale (num_samples={})".format(
+                             num_samples))
+
+    def shifted(grid_point):
+        time_index = grid_point.time_index \
+                     + steps * 2**(scale_index_max - grid_point.scale_index)
+        if num_samples is not None:
+            time_index %= num_samples // 2**int(grid.timescales_exp[grid_point.scale_index])
+        return grid_point._replace(time_index=int(time_index))
+
+    return [Cluster([shifted(grid_point) for grid_point in cluster.grid_points],
+                    cluster.values, cluster.metadata)
+            for cluster in clusters]
+
+def time_shifted_clusters(signal, grid, shifts, decompose):
+    """
+    Return the clusters of circularly time-shifted copies of a signal.
+
+    Each shift is split into a multiple of the largest timescale and a
+    residual sub-grid shift. The signal is decomposed once per distinct
+    residual shift, and the clusters of all the shifts are obtained from
+    these decompositions with shift_clusters(). The segment must hold
+    an even number of time bins at the largest timescale.
+
+    Input
+    -----
+    signal [Timeseries object] -- input signal
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    shifts [list] -- time shifts in samples
+    decompose [function] -- function returning the Cluster of a Timeseries
+                            (e.g. wrapping solvers.iniht())
+
+    Output
+    ------
+    clusters [list] -- list of Cluster objects, one per shift
+    """
+    import timeseries
+
+    num_samples = len(signal.data)
+    step = 2**int(grid.timescales_exp[-1])
+
+    decompositions = {}
+    clusters = []
+    for shift in shifts:
+        steps, residual = divmod(int(shift), step)
+        if residual not in decompositions:
+            decompositions[residual] = decompose(timeseries.Timeseries(
+                numpy.roll(signal.data, residual), signal.sampling_freq,
+                signal.t0, signal.metadata))
+        clusters.extend(shift_clusters([decompositions[residual]], grid, steps,
+                                       num_samples))
+
+    logging.debug("{} time shifts from {} decompositions".format(
+        len(clusters), len(decompositions)))
+
+    return clusters
+
+@profiling.timed()
 def read_clusters(filename):
     """
     Read clusters from a .hdf file.
@@ -186,6 +514,8 @@ def read_clusters(filename):
     - ...
  
     """
+    import h5py
+
     if not os.path.isfile(filename):
         raise Exception('File {} not found'.format(filename))
     
@@ -199,8 +529,12 @@ def read_clusters(filename):
                  'metadata': file.attrs['metadata'], \
                  'params': file.attrs['params']}
 
+    profiling.annotate(num_clusters=len(clusters),
+                       bytes_read=os.path.getsize(filename))
+
     return clusters, infos
 
+@profiling.timed()
 def write_clusters(filename, clusters, params, metadata):
     """
     Write clusters to a .hdf file.
@@ -223,6 +557,8 @@ def write_clusters(filename, clusters, params, metadata):
     --- descr [str]
     - ...
     """
+    import h5py
+
     # Open writing session for .hdf file.
     try:
         outfile = h5py.File(filename, 'w')
@@ -259,5 +595,7 @@ def write_clusters(filename, clusters, params, metadata):
         
     # Close writing session of .hdf file.
     outfile.close()
+    profiling.annotate(num_clusters=len(clusters),
+                       bytes_written=os.path.getsize(filename))
     
     logging.info('Wrote {} clusters in {}'.format(len(clusters), filename))
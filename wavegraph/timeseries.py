@@ -5,23 +5,35 @@ from __future__ import division
 
 import os
 import sys
-import h5py
 import numpy
 import argparse
 import getpass
 import time
 import logging
-import fractions
+import math
+import hashlib
+import json
 import subprocess
 import sys
-from scipy import signal
+
+try:
+    from . import profiling
+except (ImportError, ValueError):
+    # Module imported from the wavegraph directory (e.g. "import timeseries")
+    import profiling
+
+# h5py, scipy.signal and multiprocessing.shared_memory are imported on
+# first use, so that importing this module (e.g. only for Timeseries)
+# stays fast
 
 LOGGING_FMT = "%(levelname)s -- %(filename)s:line %(lineno)s in %(funcName)s(): %(message)s"
 
 
 class Timeseries(object):
-    def __init__(self, data, fs, t0=0, meta=None):
-        self.data = numpy.array(data)
+    def __init__(self, data, fs, t0=0, meta=None, copy=True):
+        # With copy=False, an array is used as is (e.g. a view on the
+        # shared memory of a SharedTemplateBank)
+        self.data = numpy.array(data) if copy else numpy.asarray(data)
         self.sampling_freq = fs
         self.t0 = t0
         self.metadata = meta
@@ -35,6 +47,7 @@ class Timeseries(object):
     def __str__(self):
         return str(self.data)
     
+@profiling.timed()
 def read_timeseries(filename):
     """
     Read an .hdf file and returns a list of Timeseries.
@@ -60,6 +73,8 @@ def read_timeseries(filename):
     - ...
     
     """
+    import h5py
+
     if not os.path.isfile(filename):
         raise Exception('File {} not found'.format(filename))
     
@@ -75,8 +90,12 @@ def read_timeseries(filename):
         infos = {'description:': file.attrs['description'],
                  'metadata': file.attrs['metadata']}
 
+    profiling.annotate(num_timeseries=len(timeseries),
+                       bytes_read=os.path.getsize(filename))
+
     return timeseries, infos
 
+@profiling.timed()
 def write_timeseries(filename, timeseries, metadata):
     """
     Write timeseries to a .hdf file.
@@ -98,6 +117,8 @@ def write_timeseries(filename, timeseries, metadata):
     --- descr [string]
     - ...
     """
+    import h5py
+
     if os.path.isfile(filename):
         logging.info('{} already exists -- Removing'.format(filename))
         os.remove(filename)
@@ -132,10 +153,465 @@ def write_timeseries(filename, timeseries, metadata):
 
     # Close writing session of .hdf file.
     outfile.close()
+    profiling.annotate(num_timeseries=len(timeseries),
+                       bytes_written=os.path.getsize(filename))
         
     logging.info('Wrote {} timeseries in {}'.format(len(timeseries), filename))
 
+def group_by_length(timeseries):
+    """
+    Group timeseries by number of samples, so that each group can be
+    stacked into a 2D array and processed at once.
+
+    Input
+    -----
+    timeseries [list] -- list of Timeseries objects
+
+    Output
+    ------
+    groups [dict] -- indices of the timeseries, indexed by number of samples
+    """
+    groups = {}
+    for n, ts in enumerate(timeseries):
+        groups.setdefault(len(ts.data), []).append(n)
+    return groups
+
+def _attach_shared_memory(name):
+    """
+    Attach to an existing shared memory block without registering it with
+    the resource tracker, which would destroy the block when the process
+    exits, although other processes still use it.
+    """
+    from multiprocessing import shared_memory
+
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13: the registration is skipped (unregistering it
+        # afterwards would also unregister the block of the parent
+        # process, whose resource tracker is shared with its children)
+        from multiprocessing import resource_tracker
+
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+class SharedTemplateBank(object):
+    """
+    Template bank whose samples are packed into a shared memory block, so
+    that the worker processes of a node attach zero-copy (read-only)
+    Timeseries views instead of each holding a copy of the templates.
+
+    Layout of the block:
+    - header [int64 x 4]: number of templates, total number of samples,
+      size of the JSON description [bytes], ready flag
+    - offsets [int64 x (number of templates + 1)]: first sample of each
+      template in the packed samples
+    - sampling frequencies [float64 x number of templates]
+    - packed samples [float64]
+    - JSON description: metadata of the templates and infos of the bank
+
+    A bank is pickled as the name of its block, so that it can be passed
+    to worker processes (e.g. as an argument of multiprocessing.Pool),
+    which attach to the block. The views must be deleted before close().
+
+    Main attributes:
+    ----------------
+    name      -- name of the shared memory block
+    offsets   -- first sample of each template (and total number of samples)
+    sampling_freqs -- sampling frequency of each template [Hz]
+    metadata  -- description of each template
+    infos     -- description of the bank (see read_timeseries())
+    owner     -- True if this object created the block
+    """
+    HEADER_SIZE = 4
+
+    def __init__(self, block, owner=False):
+        """
+        block [SharedMemory object] -- shared memory block of the bank
+        owner                [bool] -- True if the block was created by
+                                       this process
+        """
+        self._block = block
+        self.name = block.name
+        self.owner = owner
+        self._parse()
+
+    def _parse(self):
+        """ Set up the views on the arrays of the block """
+        header = numpy.ndarray(self.HEADER_SIZE, dtype=numpy.int64,
+                               buffer=self._block.buf)
+        num_templates, num_samples, description_size, _ = [int(v) for v in header]
+        start = header.nbytes
+        self.offsets = numpy.ndarray(num_templates + 1, dtype=numpy.int64,
+                                     buffer=self._block.buf, offset=start)
+        start += self.offsets.nbytes
+        self.sampling_freqs = numpy.ndarray(num_templates, dtype=numpy.float64,
+                                            buffer=self._block.buf, offset=start)
+        start += self.sampling_freqs.nbytes
+        self._samples = numpy.ndarray(num_samples, dtype=numpy.float64,
+                                      buffer=self._block.buf, offset=start)
+        start += self._samples.nbytes
+        description = json.loads(bytes(self._block.buf[start:start + description_size])
+                                  .decode('utf-8'))
+        self.metadata = description['metadata']
+        self.infos = description['infos']
+        self._header = header
+
+    @staticmethod
+    def _size(num_templates, num_samples, description_size):
+        """ Size of the block [bytes] """
+        return 8 * (SharedTemplateBank.HEADER_SIZE + 2 * num_templates + 1 \
+                    + num_samples) + description_size
+
+    @classmethod
+    def create(cls, timeseries, infos=None, name=None):
+        """
+        Pack a list of Timeseries into a new shared memory block.
+
+        Input
+        -----
+        timeseries [list] -- list of Timeseries objects
+        infos [dict] -- description of the bank (see read_timeseries())
+        name [str/None] -- name of the block (chosen by the system if None)
+
+        Output
+        ------
+        bank [SharedTemplateBank object] -- bank owning the block
+        """
+        from multiprocessing import shared_memory
+
+        lengths = [len(ts.data) for ts in timeseries]
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths))).astype(numpy.int64)
+        description = json.dumps({'metadata': [ts.metadata for ts in timeseries],
+                                  'infos': infos or {}},
+                                 default=str).encode('utf-8')
+        size = cls._size(len(timeseries), int(offsets[-1]), len(description))
+        block = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        header = numpy.ndarray(cls.HEADER_SIZE, dtype=numpy.int64, buffer=block.buf)
+        header[:] = [len(timeseries), offsets[-1], len(description), 0]
+        start = header.nbytes
+        numpy.ndarray(len(offsets), dtype=numpy.int64, buffer=block.buf,
+                      offset=start)[:] = offsets
+        start += offsets.nbytes
+        numpy.ndarray(len(timeseries), dtype=numpy.float64, buffer=block.buf,
+                      offset=start)[:] = [ts.sampling_freq for ts in timeseries]
+        start += 8 * len(timeseries)
+        samples = numpy.ndarray(int(offsets[-1]), dtype=numpy.float64,
+                                buffer=block.buf, offset=start)
+        for (n, ts) in enumerate(timeseries):
+            samples[offsets[n]:offsets[n + 1]] = ts.data
+        start += samples.nbytes
+        block.buf[start:start + len(description)] = description
+        del samples
+
+        # The block is ready for the other processes
+        header[3] = 1
+        del header
+
+        logging.info('Packed {} templates ({} bytes) in shared memory block {}' \
+                     .format(len(timeseries), size, block.name))
+        return cls(block, owner=True)
+
+    @classmethod
+    def attach(cls, name, timeout=60.):
+        """
+        Attach to the shared memory block of a bank, waiting at most
+        timeout seconds for the process creating it to fill it.
+        """
+        block = _attach_shared_memory(name)
+        header = numpy.ndarray(cls.HEADER_SIZE, dtype=numpy.int64, buffer=block.buf)
+        deadline = time.time() + timeout
+        while not header[3]:
+            if time.time() > deadline:
+                del header
+                block.close()
+                raise RuntimeError('Shared memory block {} not ready after {} s' \
+                                   .format(name, timeout))
+            time.sleep(0.01)
+        del header
+        return cls(block)
+
+    def __reduce__(self):
+        return (SharedTemplateBank.attach, (self.name,))
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def __getitem__(self, n):
+        """ Return a read-only Timeseries view on template n """
+        data = self._samples[self.offsets[n]:self.offsets[n + 1]]
+        data.flags.writeable = False
+        return Timeseries(data, float(self.sampling_freqs[n]), 0.0,
+                          self.metadata[n], copy=False)
+
+    def timeseries(self):
+        """ Return the list of the Timeseries views on the templates """
+        return [self[n] for n in range(len(self))]
+
+    def close(self):
+        """
+        Detach from the block. The Timeseries views must have been
+        deleted beforehand.
+        """
+        del self.offsets, self.sampling_freqs, self._samples, self._header
+        self._block.close()
+
+    def unlink(self):
+        """ Destroy the block (once all the processes have closed it) """
+        self._block.unlink()
+
+def shared_bank_name(filename):
+    """
+    Return the name of the shared memory block of a template bank file,
+    which changes when the file is modified.
+    """
+    stat = os.stat(filename)
+    key = '{} {} {}'.format(os.path.abspath(filename), stat.st_size, stat.st_mtime)
+    return 'wg_' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+def share_templates(filename, name=None):
+    """
+    Pack the templates of an .hdf file (see read_timeseries()) into a
+    shared memory block, for the processes of the node that load them
+    with load_shared_templates().
+
+    The block must be created by a process that outlives them (e.g. the
+    executor of the jobs of the node, see executor.LocalExecutor), which
+    destroys it with unlink() once they are done. The block is also
+    destroyed if that process exits without calling unlink().
+
+    Input
+    -----
+    filename [str] -- input .hdf file
+    name [str/None] -- name of the block (see shared_bank_name() if None)
+
+    Output
+    -----
+    bank [SharedTemplateBank object/None] -- bank of the block (owner if it
+                                             was created), or None if shared
+                                             memory is not available
+    """
+    if not os.path.isfile(filename):
+        raise Exception('File {} not found'.format(filename))
+
+    name = name or shared_bank_name(filename)
+    try:
+        return SharedTemplateBank.attach(name)
+    except ImportError:
+        # No multiprocessing.shared_memory (Python < 3.8)
+        logging.warning('Shared memory not available: the templates of {} ' \
+                        'are read by each process'.format(filename))
+        return None
+    except (IOError, OSError):
+        # FileNotFoundError under Python 3: the block does not exist yet
+        pass
+
+    timeseries, infos = read_timeseries(filename)
+    try:
+        return SharedTemplateBank.create(timeseries, infos, name)
+    except (IOError, OSError):
+        # FileExistsError: another process has just created the block
+        return SharedTemplateBank.attach(name)
+
+# Shared template banks attached by this process, indexed by block name.
+# They are kept so that their Timeseries views stay valid
+_SHARED_BANKS = {}
+
+def load_shared_templates(filename, name=None):
+    """
+    Return the templates of an .hdf file (see read_timeseries()) as
+    read-only views on the shared memory block of the node, if it was
+    created with share_templates(). Otherwise (no block, or no shared
+    memory under Python < 3.8), the file is read.
+
+    Input
+    -----
+    filename [str] -- input .hdf file
+    name [str/None] -- name of the block (see shared_bank_name() if None)
+
+    Output
+    -----
+    timeseries [list] -- list of Timeseries objects
+    infos [str] -- description of the data set
+    """
+    if not os.path.isfile(filename):
+        raise Exception('File {} not found'.format(filename))
+
+    name = name or shared_bank_name(filename)
+    if name not in _SHARED_BANKS:
+        try:
+            _SHARED_BANKS[name] = SharedTemplateBank.attach(name)
+        except (ImportError, IOError, OSError):
+            # No multiprocessing.shared_memory (Python < 3.8), or no
+            # block for this file (FileNotFoundError)
+            return read_timeseries(filename)
+        logging.info('Templates of {} taken from shared memory block {}' \
+                     .format(filename, name))
+
+    bank = _SHARED_BANKS[name]
+    return bank.timeseries(), bank.infos
+
+def welch_psd(noise, segment_duration, overlap=0.5, average='mean', window='hann'):
+    """
+    Estimate the one-sided power spectral density of noise with the
+    Welch method (average of the periodograms of overlapping segments).
+
+    Input
+    -----
+    noise [Timeseries object] -- noise data
+    segment_duration [float] -- duration of the segments [s]
+    overlap [float] -- overlap between consecutive segments (fraction)
+    average [str] -- 'mean' or 'median' (robust to glitches) averaging
+    window [str] -- window applied to each segment
+
+    Output
+    ------
+    frequencies [Numpy array] -- frequencies [Hz]
+    psd [Numpy array] -- power spectral density [1/Hz]
+    """
+    from scipy import signal
+
+    num_per_segment = int(round(segment_duration * noise.sampling_freq))
+    if not 0 < num_per_segment <= len(noise.data):
+        raise ValueError('Segment duration {} s does not fit in the noise data '
+                         '({} s)'.format(segment_duration, noise.duration()))
+
+    return signal.welch(noise.data, fs=noise.sampling_freq, window=window,
+                        nperseg=num_per_segment,
+                        noverlap=int(overlap * num_per_segment),
+                        average=average)
+
+def psd_to_nrms(frequencies, psd, sampling_freq, scale):
+    """
+    Return the nRMS of each layer of a WDM transform from a power spectral
+    density: the amplitude sqrt(S * fs/2) of white noise of density S,
+    with S averaged over the frequency band of the layer.
+
+    Input
+    -----
+    frequencies [Numpy array] -- frequencies of the PSD [Hz]
+    psd [Numpy array] -- one-sided power spectral density [1/Hz]
+    sampling_freq [float] -- sampling frequency [Hz]
+    scale [int] -- timescale exponent of the WDM transform
+
+    Output
+    ------
+    nrms [Numpy array] -- nRMS of the 2**scale + 1 layers
+    """
+    num_layers = 2**int(scale)
+    nyquist = sampling_freq / 2.
+    bandwidth = nyquist / num_layers
+    edges = numpy.clip((numpy.arange(num_layers + 2) - 0.5) * bandwidth, 0., nyquist)
+
+    # Band averages from the cumulative integral of the PSD
+    cumulative = numpy.concatenate(
+        ([0.], numpy.cumsum((psd[1:] + psd[:-1]) / 2. * numpy.diff(frequencies))))
+    band_psd = numpy.diff(numpy.interp(edges, frequencies, cumulative)) \
+               / numpy.diff(edges)
+
+    return numpy.sqrt(band_psd * nyquist)
+
+# Noise nRMS already estimated in this process, indexed by data and parameters
+_NOISE_NRMS = {}
+
+def noise_nrms(noise, grid, segment_duration, overlap=0.5, average='mean'):
+    """
+    Estimate the nRMS of each layer of every scale of a grid from noise
+    data, for whitening (see watutils.whitening_batch()). The PSD is
+    estimated once with welch_psd(), and the result is cached.
+
+    Input
+    -----
+    noise [Timeseries object] -- noise data
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    segment_duration, overlap, average -- see welch_psd()
+
+    Output
+    ------
+    nrms [list] -- list of 1D arrays (one per scale, of length the number
+                   of layers + 1)
+    """
+    if noise.sampling_freq != grid.sampling_freq:
+        raise ValueError('Noise sampling frequency ({} Hz) differs from that '
+                         'of the grid ({} Hz)'.format(noise.sampling_freq,
+                                                      grid.sampling_freq))
+
+    key = (hashlib.sha1(numpy.ascontiguousarray(noise.data)).hexdigest(),
+           grid.sampling_freq, tuple(int(s) for s in grid.timescales_exp),
+           segment_duration, overlap, average)
+    if key not in _NOISE_NRMS:
+        frequencies, psd = welch_psd(noise, segment_duration, overlap, average)
+        _NOISE_NRMS[key] = [psd_to_nrms(frequencies, psd, grid.sampling_freq, scale)
+                            for scale in grid.timescales_exp]
+        logging.info('Estimated noise nRMS from {} s of data'.format(noise.duration()))
+
+    return _NOISE_NRMS[key]
+
+def fast_length(num_samples, multiple=1):
+    """
+    Return the smallest FFT-friendly length (product of powers of 2, 3
+    and 5) not smaller than num_samples that is a multiple of multiple.
+    The result is FFT-friendly when multiple is itself a product of
+    powers of 2, 3 and 5 (e.g. a number of samples of a grid timescale).
+
+    Input
+    -----
+    num_samples [int] -- minimum length
+    multiple [int] -- alignment constraint
+
+    Output
+    ------
+    length [int] -- padded length
+    """
+    target = -(-int(num_samples) // int(multiple))
+    length = target
+    while True:
+        rem = length
+        for factor in (2, 3, 5):
+            while rem % factor == 0:
+                rem //= factor
+        if rem == 1:
+            return length * int(multiple)
+        length += 1
+
+def grid_fast_length(num_samples, grid):
+    """
+    Return the FFT-friendly length not smaller than num_samples that is
+    a multiple of the number of samples of the largest timescale of a
+    grid (as required by the WDM transforms), with an even number of
+    time bins at that scale (as required by tfcluster.shift_clusters()).
+
+    Input
+    -----
+    num_samples [int] -- minimum length
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    """
+    return fast_length(num_samples, 2**(int(grid.timescales_exp[-1]) + 1))
+
+def pad_to_fast_length(timeseries, grid=None):
+    """
+    Return a Timeseries zero-padded at the end to a FFT-friendly length,
+    aligned on the largest timescale of a grid if given (see
+    grid_fast_length()). The Timeseries is returned as is if its length
+    is already suitable.
+    """
+    num_samples = len(timeseries.data)
+    length = grid_fast_length(num_samples, grid) if grid is not None \
+             else fast_length(num_samples)
+    if length == num_samples:
+        return timeseries
+    data = numpy.zeros(length, dtype=timeseries.data.dtype)
+    data[:num_samples] = timeseries.data
+    return Timeseries(data, timeseries.sampling_freq, timeseries.t0,
+                      timeseries.metadata)
+
 ## XXX Could be included in the above class XXX
+@profiling.timed()
 def resample(s, p, q, h=None):
     """Change sampling rate by rational factor. This implementation is based on
     the Octave implementation of the resample function. It designs the 
@@ -150,10 +626,11 @@ def resample(s, p, q, h=None):
     Prentice-Hall, 1999
     """
     
-    gcd = fractions.gcd(p,q)
+    profiling.annotate(num_samples=len(s), up=int(p), down=int(q))
+    gcd = math.gcd(int(p), int(q))
     if gcd > 1:
-        p = p/gcd
-        q = q/gcd
+        p = p//gcd
+        q = q//gcd
         
     if h is None: #design filter
         
@@ -171,6 +648,8 @@ def resample(s, p, q, h=None):
         t = numpy.arange(-l, l + 1)
         ideal_filter=2 * p * stopband_cutoff_f * numpy.sinc(2*stopband_cutoff_f*t)
         
+        from scipy import signal
+
         #determine parameter of Kaiser window
         #use empirical formula from [2] Chap 7, Eq. (7.62) p 474
         beta = signal.kaiser_beta(rejection_db)
@@ -208,6 +687,18 @@ def upfirdn(s, h, p, q):
     to do a full convolution operation (and its much faster than convolve).
     """
 
+    from scipy import signal
+
     a = upsample(s, p)
     b = signal.fftconvolve(h, a)
     return downsample(b, q)
+
+def upsample(s, p):
+    """ Upsample signal s by an integer factor p (zero insertion). """
+    out = numpy.zeros(len(s) * int(p), dtype=numpy.result_type(s, float))
+    out[::int(p)] = s
+    return out
+
+def downsample(s, q):
+    """ Downsample signal s by an integer factor q (decimation). """
+    return s[::int(q)]
@@ -2,37 +2,49 @@
 # Contributed to by Eve Chase, Eric Chassande-Mottin, Eric Lebigot, Philippe Bacon, Quentin Bammey
 
 import os
-import copy
+import logging
+import collections
 import numpy as np
 
 # import wavegraph_env as wgenv
 # wgenv.init_ROOT()
 
-import ROOT
-from ROOT import wavearray
-from ROOT import WDM
-from ROOT import WSeries
+# ROOT (with the wseries extension) and scipy.sparse are imported by the
+# functions that use them, so that importing this module does not load
+# ROOT (e.g. for the tools only handling clusters and graphs)
 
-import wseries
 import timeseries
+import tfcluster
+import profiling
 
 CWB_DEFAULT_INU = 6
 CWB_DEFAULT_PRECISION = 10
 
-def convert_numpyarray_to_wavearray(array, sampling_freq=1.):
+def convert_numpyarray_to_wavearray(array, sampling_freq=1., out=None):
     """
     Convert a Numpy array to a wavearray.
+
+    The data are copied into the wavearray. When out is given, the
+    wavearray is reused and no allocation is made (see also
+    WavearrayBuffer).
     
     Inputs:
     -------
     array   [Numpy Array] -- input data
     sampling_freq [float]-- sampling frequency [Hz]
+    out     [Wavearray/None] -- wavearray of the same size as array to fill
 
     Output:
     -------
     out [Wavearray] -- Wavearray object
     """
-    out = wavearray('double')(array.size)
+    from ROOT import wavearray
+
+    if out is None:
+        out = wavearray('double')(array.size)
+    elif out.size() != array.size:
+        raise ValueError("Size of the output wavearray (={}) does not match " \
+                         "that of the input array (={})".format(out.size(), array.size))
     out.rate(sampling_freq)
     tmp_buffer = np.ndarray(shape=out.size(),
                             buffer=out.data,
@@ -45,6 +57,10 @@ def convert_wavearray_to_numpyarray(wavearray):
     """
     Convert a wavearray to a Numpy array
 
+    No copy is made: the Numpy array is a view on the memory of the
+    wavearray, which remains the owner of the data. The view is only
+    valid as long as the wavearray is alive and is not resized.
+
     Input:
     ------
     wavearray [Wavearray] -- input data
@@ -57,7 +73,388 @@ def convert_wavearray_to_numpyarray(wavearray):
                       buffer=wavearray.data,
                       dtype='double').T
 
-def initialize_WDM_types(grid, wat_type=None):
+class WavearrayBuffer(object):
+    """
+    Wavearray and Numpy array sharing the same memory.
+
+    A wavearray frees its data when it is destroyed, so it cannot be
+    built on top of memory owned by Numpy. The buffer is therefore
+    allocated by the wavearray, and exposed to Numpy as a view:
+    writing into the Numpy array fills the wavearray without copy.
+
+    Ownership rules:
+    ----------------
+    - the wavearray owns the memory;
+    - the Numpy view (the array attribute) is valid as long as the
+      WavearrayBuffer object is alive: keep a reference to it, not
+      only to the view;
+    - the wavearray must not be resized (this would invalidate the view).
+
+    Main attributes:
+    ----------------
+    wavearray -- wavearray owning the memory
+    array     -- Numpy view on the wavearray data
+    """
+    def __init__(self, size, sampling_freq=1.):
+        """
+        size          [int]   -- number of samples
+        sampling_freq [float] -- sampling frequency [Hz]
+        """
+        from ROOT import wavearray
+
+        self.wavearray = wavearray('double')(int(size))
+        self.wavearray.rate(sampling_freq)
+        self.array = convert_wavearray_to_numpyarray(self.wavearray)
+
+    def fill(self, array):
+        """ Copy array into the buffer and return the wavearray """
+        self.array[:] = array
+        return self.wavearray
+
+def energy_map(direct, dual, out=None, work=None):
+    """
+    Compute the energy map dual**2 + direct**2 of a WDM transform
+    (bitwise identical to that expression) in preallocated arrays.
+
+    Inputs:
+    -------
+    direct [Numpy Array] -- direct WDM coefficients
+    dual   [Numpy Array] -- dual WDM coefficients (same shape as direct)
+    out    [Numpy Array/None] -- output array (same shape as direct). It
+                                 is allocated if None
+    work   [Numpy Array/None] -- work array (same shape as direct). It
+                                 is allocated if None
+
+    Output:
+    -------
+    out [Numpy Array] -- energy map
+    """
+    out = np.multiply(dual, dual, out=out)
+    work = np.multiply(direct, direct, out=work)
+    out += work
+    return out
+
+class SparseTFMap(collections.namedtuple('SparseTFMap', 'shape keys energies')):
+    """
+    Sparse (freq x time) energy map: only the pixels of largest energy
+    are kept, sorted by decreasing energy. Pixels are identified by their
+    key freq_index * num_times + time_index.
+    """
+    __slots__ = ()
+
+    def indices(self):
+        """ Return the frequency and time indices of the pixels """
+        return np.unravel_index(self.keys, self.shape)
+
+    def todense(self):
+        """ Return the dense energy map """
+        out = np.zeros(self.shape)
+        out.flat[self.keys] = self.energies
+        return out
+
+def sparse_energy_map(tfmap, energy_fraction, start_pixels=None):
+    """
+    Return the sparse TF map made of the fewest pixels of largest energy
+    holding a given fraction of the energy of a TF map.
+
+    The largest pixels are found with partial sorts (argpartition) of
+    a growing number of pixels, starting from start_pixels and doubling
+    it until the selected pixels hold the requested energy: only the
+    selected pixels are fully sorted.
+
+    Inputs:
+    -------
+    tfmap    [Numpy Array] -- 2D energy map
+    energy_fraction [float] -- fraction of the energy to keep (e.g.
+                               1 - approximation error)
+    start_pixels [int/None] -- initial number of pixels (1% of the
+                               pixels if None)
+
+    Output:
+    -------
+    sparse_map [SparseTFMap] -- sparse TF map
+    """
+    energies = tfmap.ravel()
+    target = energy_fraction * np.sum(energies)
+    if energies.size == 0 or target <= 0:
+        return SparseTFMap(tfmap.shape, np.empty(0, dtype=int), np.empty(0))
+
+    keys = _largest_energies(energies, target,
+                             start_pixels or energies.size // 100)
+    return SparseTFMap(tfmap.shape, keys, energies[keys])
+
+def _largest_energies(energies, target, start_count):
+    """
+    Return the indices of the fewest largest energies summing to at
+    least target (or of all the energies), by decreasing energy, found
+    with partial sorts of a doubling number of energies.
+
+    energies [Numpy Array] -- 1D array of energies
+    target         [float] -- energy to reach
+    start_count      [int] -- initial number of energies
+    """
+    num_pixels = energies.size
+    count = min(num_pixels, max(1, int(start_count)))
+    while True:
+        if count < num_pixels:
+            keys = np.argpartition(energies, num_pixels - count)[num_pixels - count:]
+        else:
+            keys = np.arange(num_pixels)
+        if count == num_pixels or np.sum(energies[keys]) >= target:
+            break
+        count = min(num_pixels, 2 * count)
+
+    keys = keys[np.argsort(energies[keys])[::-1]]
+    cumulated = np.cumsum(energies[keys])
+    return keys[:min(int(np.searchsorted(cumulated, target)) + 1, keys.size)]
+
+class EnergyPyramid(object):
+    """
+    Multi-resolution pyramid of a TF energy map, for coarse-to-fine
+    pixel selection.
+
+    Each level sums the energies of the 2x2 blocks of pixels of the level
+    below, up to a top level small enough to be sorted at once. The
+    pixels holding a given fraction of the energy are searched from the
+    top: at each level, the fewest cells of largest energy holding the
+    target energy of the level are kept, and only their children are
+    examined at the next level. The targets decrease from the top level
+    down to the requested energy at the pixel level: since the children
+    of the kept cells hold at least the target of their level, the
+    selected pixels are guaranteed to hold the requested energy, while
+    the empty regions of the map are never sorted.
+
+    Main attributes:
+    ----------------
+    levels -- list of 2D arrays, from the TF map (level 0) to the top level
+    """
+    def __init__(self, tfmap, top_size=64):
+        """
+        tfmap [Numpy Array] -- 2D energy map
+        top_size      [int] -- maximum number of cells of the top level
+        """
+        self.levels = [np.asarray(tfmap, dtype=float)]
+        while self.levels[-1].size > top_size:
+            level = self.levels[-1]
+            num_rows, num_cols = level.shape
+            if num_rows % 2 or num_cols % 2:
+                padded = np.zeros((num_rows + num_rows % 2, num_cols + num_cols % 2))
+                padded[:num_rows, :num_cols] = level
+                level = padded
+            pooled = level[0::2] + level[1::2]
+            self.levels.append(pooled[:, 0::2] + pooled[:, 1::2])
+
+    def select(self, energy_fraction):
+        """
+        Return the sparse TF map of the pixels holding at least a given
+        fraction of the energy, found from coarse to fine levels.
+
+        Input:
+        ------
+        energy_fraction [float] -- fraction of the energy to keep
+
+        Output:
+        -------
+        sparse_map [SparseTFMap] -- selected pixels, by decreasing energy
+        """
+        shape = self.levels[0].shape
+        total = np.sum(self.levels[-1])
+        if energy_fraction * total <= 0:
+            return SparseTFMap(shape, np.empty(0, dtype=int), np.empty(0))
+
+        rows, cols = [index.ravel() for index in np.indices(self.levels[-1].shape)]
+        for k in range(len(self.levels) - 1, -1, -1):
+
+            # The missed energy allowed at level k is halved at each
+            # coarser level, so that the coarse cells do not exclude
+            # fine pixels of large energy
+            target = (1. - (1. - energy_fraction) / 2**k) * total
+            energies = self.levels[k][rows, cols]
+            order = np.argsort(energies)[::-1]
+            count = min(int(np.searchsorted(np.cumsum(energies[order]), target)) + 1,
+                        order.size)
+            rows, cols = rows[order[:count]], cols[order[:count]]
+            if k == 0:
+                break
+
+            # Children of the kept cells at the finer level
+            num_rows, num_cols = self.levels[k-1].shape
+            rows = (2 * rows[:, None] + [0, 0, 1, 1]).ravel()
+            cols = (2 * cols[:, None] + [0, 1, 0, 1]).ravel()
+            inside = (rows < num_rows) & (cols < num_cols)
+            rows, cols = rows[inside], cols[inside]
+
+        return SparseTFMap(shape, np.ravel_multi_index((rows, cols), shape),
+                           self.levels[0][rows, cols])
+
+def project_support(sparse_map, shape, margin=1):
+    """
+    Return the mask of the pixels of a TF map of another scale that
+    overlap the pixels of a sparse TF map.
+
+    A pixel (freq_index, time_index) of a plane with r times fewer time
+    bins covers the time bins r*time_index to r*time_index + r - 1 of the
+    finer plane, and the frequency bins around freq_index / r. The
+    projected pixels are dilated by margin pixels in time and frequency,
+    since the WDM atoms of neighbouring pixels overlap. Time indices wrap
+    around (the WDM transform is circular).
+
+    Inputs:
+    -------
+    sparse_map [SparseTFMap] -- sparse TF map of the coarser plane
+    shape            [tuple] -- (freq x time) shape of the finer plane
+    margin             [int] -- number of pixels added around the projection
+
+    Output:
+    -------
+    support [Numpy Array] -- boolean (freq x time) mask of the finer plane
+    """
+    num_freqs, num_times = shape
+    ratio = num_times // sparse_map.shape[1]
+    if ratio < 1 or num_times % sparse_map.shape[1]:
+        raise ValueError("The TF map of shape {} is not finer in time than " \
+                         "the sparse map of shape {}".format(shape, sparse_map.shape))
+
+    freq_index, time_index = sparse_map.indices()
+    support = np.zeros(shape, dtype=bool)
+    for freqs in (freq_index // ratio, np.minimum(-(-freq_index // ratio),
+                                                  num_freqs - 1)):
+        for time_offset in range(ratio):
+            support[freqs, ratio * time_index + time_offset] = True
+
+    # Dilation by margin pixels
+    for _ in range(margin):
+        dilated = support.copy()
+        dilated[1:] |= support[:-1]
+        dilated[:-1] |= support[1:]
+        support = dilated | np.roll(dilated, 1, axis=1) | np.roll(dilated, -1, axis=1)
+    return support
+
+def coarse_to_fine_energy_maps(tfmaps, energy_fraction, top_size=64, margin=1):
+    """
+    Return the sparse TF maps holding a fraction of the energy of each
+    plane of a grid. The planes are processed from the coarsest scale
+    (fewest time bins) to the finest.
+
+    The pixels of the coarsest plane are selected with an EnergyPyramid.
+    The pixels selected on each plane are then projected onto the next
+    finer plane (see project_support()), and only the projected pixels
+    are sorted there, if they hold the requested fraction of the energy
+    of the plane. Otherwise (the energy of the plane lies outside the
+    support of the coarser plane), the plane is searched with an
+    EnergyPyramid. Each sparse map thus holds at least the requested
+    fraction of the energy of its plane.
+
+    Inputs:
+    -------
+    tfmaps          [list] -- list of 2D energy maps, one per scale
+    energy_fraction [float] -- fraction of the energy to keep
+    top_size         [int] -- maximum number of cells of the top levels
+    margin           [int] -- number of pixels added around the projected
+                              support (see project_support())
+
+    Output:
+    -------
+    sparse_maps [list] -- list of SparseTFMap objects, in the order of tfmaps
+    """
+    sparse_maps = [None] * len(tfmaps)
+    selected = None
+    for k in sorted(range(len(tfmaps)), key=lambda k: tfmaps[k].shape[1]):
+        tfmap = np.asarray(tfmaps[k], dtype=float)
+        if selected is not None and selected.keys.size:
+            keys = np.flatnonzero(project_support(selected, tfmap.shape, margin))
+            energies = tfmap.ravel()[keys]
+            target = energy_fraction * np.sum(tfmap)
+            if 0 < target <= np.sum(energies):
+                # The finer plane has ratio times more time bins, and
+                # about ratio times more selected pixels
+                order = _largest_energies(
+                    energies, target,
+                    selected.keys.size * tfmap.shape[1] // selected.shape[1])
+                sparse_maps[k] = SparseTFMap(tfmap.shape, keys[order],
+                                             energies[order])
+        if sparse_maps[k] is None:
+            sparse_maps[k] = EnergyPyramid(tfmap, top_size).select(energy_fraction)
+        selected = sparse_maps[k]
+    return sparse_maps
+
+def sparse_tfmaps_to_cluster(tfmaps, metadata, reject_zero_freq=False):
+    """
+    Return the Cluster made of the pixels of sparse TF maps (one per
+    scale of the grid), valued by their energy. The maps are typically
+    obtained with
+
+        _, tfmaps = wdm_transform(signal, grid, energy_fraction=fraction)
+
+    Inputs:
+    -------
+    tfmaps           [list] -- list of SparseTFMap objects
+    metadata          [str] -- description string of the cluster
+    reject_zero_freq [bool] -- if True, pixels at zero frequency are discarded
+    """
+    grid_points = []
+    values = []
+    for (scale_index, tfmap) in enumerate(tfmaps):
+        freq_index, time_index = tfmap.indices()
+        energies = tfmap.energies
+        if reject_zero_freq:
+            keep = freq_index != 0
+            freq_index, time_index, energies = \
+                freq_index[keep], time_index[keep], energies[keep]
+        grid_points.extend(tfcluster.GridPoint(scale_index, t, f) \
+                           for (f, t) in zip(freq_index, time_index))
+        values.extend(energies)
+
+    return tfcluster.Cluster(grid_points, values, metadata)
+
+# Process-wide cache of the WDM transform objects. The design of the
+# WDM filters is expensive for large scales and high precisions: the
+# objects are built once and shared by all the callers.
+# Keys are (scale exponent, window type, inu, precision)
+_WDM_TYPES = {}
+
+def _make_WDM_type(scale, wat_type, inu, precision):
+    """
+    Build the WDM type for the given scale exponent, window type,
+    inu and precision parameters
+    """
+    from ROOT import WDM
+
+    if wat_type=='alternative_window':
+        return WDM('double')(int(2**scale),
+                             'I',
+                             int(2**scale), \
+                             inu, precision)
+
+    elif wat_type==None:
+        return WDM('double')(int(2**scale), int(2**scale), \
+                             inu, precision)
+
+    raise ValueError('Unsupported wavelet type {}'.format(wat_type))
+
+def get_WDM_type(scale, wat_type=None, inu=CWB_DEFAULT_INU,
+                 precision=CWB_DEFAULT_PRECISION):
+    """
+    Return the WDM type associated to a given scale. The WDM type is
+    taken from the process-wide cache, and built only if missing.
+
+    Inputs:
+    ------
+    scale          [int] -- timescale exponent (the WDM has 2**scale layers)
+    wat_type  [str/None] -- wavelet type
+    inu            [int] -- WDM filter steepness parameter
+    precision      [int] -- WDM filter precision parameter
+    """
+    key = (int(scale), wat_type, int(inu), int(precision))
+
+    if key not in _WDM_TYPES:
+        logging.debug("Building WDM type {}".format(key))
+        _WDM_TYPES[key] = _make_WDM_type(*key)
+
+    return _WDM_TYPES[key]
+
+def initialize_WDM_types(grid, wat_type=None, inu=CWB_DEFAULT_INU,
+                         precision=CWB_DEFAULT_PRECISION):
     """
     Return the WDM types associated to a CoherentWaveBurstGrid object
 
@@ -65,58 +462,360 @@ def initialize_WDM_types(grid, wat_type=None):
     ------
     grid [CoherentWaveBurstGrid object] -- cWB grid
     wat_type                 [str/None] -- wavelet type 
+    inu                           [int] -- WDM filter steepness parameter
+    precision                     [int] -- WDM filter precision parameter
     """
-    if wat_type=='alternative_window':
-        return [WDM('double')(int(2**scale),
-                              'I',
-                              int(2**scale), \
-                              CWB_DEFAULT_INU, CWB_DEFAULT_PRECISION) \
-                for scale in grid.timescales_exp]
-    
-    elif wat_type==None:
-        return [WDM('double')(int(2**scale), int(2**scale), \
-                              CWB_DEFAULT_INU, CWB_DEFAULT_PRECISION) \
-                for scale in grid.timescales_exp]
-    
-def wdm_transform(signal, wdm_types, plotmode=False):
+    return [get_WDM_type(scale, wat_type, inu, precision) \
+            for scale in grid.timescales_exp]
+
+def _as_WDM_types(wdm_types):
+    """
+    Return wdm_types if it is a list of WDM types, or the (cached) WDM
+    types of the grid if wdm_types is a CoherentWaveBurstGrid object
+    """
+    if hasattr(wdm_types, 'timescales_exp'):
+        return initialize_WDM_types(wdm_types)
+    return wdm_types
+
+def _WDM_type_name(key):
+    """ Name of the object that stores a cached WDM type in a .root file """
+    scale, wat_type, inu, precision = key
+    return 'wdm_{}_{}_{}_{}'.format(scale, inu, precision,
+                                    'default' if wat_type is None else wat_type)
+
+def save_WDM_types(filename):
+    """
+    Save the WDM types of the process-wide cache (including the designed
+    filters) into a .root file, so that they can be reloaded with
+    load_WDM_types() instead of being designed again.
+
+    Input:
+    ------
+    filename [str] -- name of the .root file to write
+    """
+    import ROOT
+
+    outfile = ROOT.TFile(filename, 'RECREATE')
+    if outfile.IsZombie():
+        raise IOError('Cannot write file {}'.format(filename))
+
+    for key, wdm_type in _WDM_TYPES.items():
+        outfile.WriteObject(wdm_type, _WDM_type_name(key))
+
+    outfile.Close()
+
+    logging.info('Wrote {} WDM types in {}'.format(len(_WDM_TYPES), filename))
+
+def load_WDM_types(filename):
+    """
+    Load the WDM types stored in a .root file by save_WDM_types() into
+    the process-wide cache. Entries already in the cache are kept.
+
+    Input:
+    ------
+    filename [str] -- name of the .root file to read
+    """
+    import ROOT
+
+    if not os.path.isfile(filename):
+        raise Exception('File {} not found'.format(filename))
+
+    logging.info("Reading {}".format(filename))
+
+    infile = ROOT.TFile(filename)
+    for item in infile.GetListOfKeys():
+        name = item.GetName()
+        _, scale, inu, precision, wat_type = name.split('_', 4)
+        key = (int(scale), None if wat_type == 'default' else wat_type, \
+               int(inu), int(precision))
+        if key not in _WDM_TYPES:
+            _WDM_TYPES[key] = infile.Get(name)
+    infile.Close()
+
+@profiling.timed()
+def wdm_transform(signal, wdm_types, plotmode=False, tfmaps=None,
+                  energy_fraction=None, work=None):
     """
     Return the WDM transforms and associated TF maps of the input signal
 
     Inputs:
     -------
     signal [Numpy Array] -- signal to decompose on WDM basis
-    wdm_types     [list] -- WSeries type list
+    wdm_types     [list] -- WDM type list, or CoherentWaveBurstGrid object
+                            (its WDM types are then taken from the cache)
+    tfmaps  [list/None] -- list of 2D arrays (one per WDM type) where the TF maps
+                           are written. They are allocated if None
+    energy_fraction [float/None] -- if given, sparse TF maps holding this
+                           fraction of the energy of each scale are returned
+                           (see sparse_energy_map()). Each WSeries object and
+                           its dense TF map are then released as soon as its
+                           sparse map is extracted (the dense maps are only
+                           work arrays, kept if given in tfmaps), so that a
+                           single scale is held in memory at a time
+    work    [list/None] -- list of 2D arrays (one per WDM type) used as work
+                           arrays by energy_map(), so that transforming a
+                           bank of templates makes no allocation per
+                           template. With energy_fraction, the direct
+                           coefficients (released afterwards) are used instead
 
     Outputs:
     -------
-    wdms    [list] -- WSeries objects list
+    wdms    [list] -- WSeries objects list (None with energy_fraction)
     tfmaps  [list] -- list of 2D arrays of different shapes containing coefficients of 
-                      WDM transform.
+                      WDM transform, or list of SparseTFMap objects
     """
+    from ROOT import WSeries
+    import wseries
+
+    wdm_types = _as_WDM_types(wdm_types)
+    profiling.annotate(num_samples=len(signal), num_scales=len(wdm_types))
     signal_wavearray = convert_numpyarray_to_wavearray(signal)
 
     wdms = []
-    tfmaps = []
+    work_maps = tfmaps
+    if tfmaps is None:
+        tfmaps = [None] * len(wdm_types)
+    sparse_maps = []
     time_axes = []
     freq_axes = []
     
-    for wdm_type in wdm_types:
+    for k, wdm_type in enumerate(wdm_types):
         
         wdm = WSeries('double')()
         wseries.extend_WSeries(wdm)
         wdm.Forward(signal_wavearray, wdm_type)
-        wdms.append(wdm)
         direct, dual = wdm.nparray()
         
-        tfmaps.append(dual**2 + direct**2)
+        if energy_fraction is not None:
+            work_map = direct
+        else:
+            work_map = None if work is None else work[k]
+        tfmap = energy_map(direct, dual,
+                           out=None if work_maps is None else work_maps[k],
+                           work=work_map)
         time_axes.append(wdm.times())
         freq_axes.append(wdm.freqs())
 
+        if energy_fraction is None:
+            wdms.append(wdm)
+            tfmaps[k] = tfmap
+        else:
+            sparse_maps.append(sparse_energy_map(tfmap, energy_fraction))
+            # The coefficients of the scale are no longer needed:
+            del direct, dual, tfmap, work_map, wdm
+
+    if energy_fraction is not None:
+        wdms = None
+        tfmaps = sparse_maps
+
     if plotmode:
         return wdms, tfmaps, time_axes, freq_axes
     else:
         return wdms, tfmaps
-    
+
+@profiling.timed()
+def wdm_transform_batch(signals, wdm_types):
+    """
+    Return the WDM transforms of a stack of signals of equal length.
+
+    The input wavearray, the WSeries objects (one per WDM type) and the
+    output arrays are allocated once and reused for all the signals of
+    the stack.
+
+    Inputs:
+    -------
+    signals [Numpy Array] -- 2D array (template x time) of signals to decompose
+    wdm_types      [list] -- WDM type list, or CoherentWaveBurstGrid object
+
+    Outputs:
+    -------
+    directs [list] -- list of 3D arrays (template x freq x time), one per
+                      WDM type, containing the direct WDM coefficients
+    duals   [list] -- same as directs for the dual (quadrature) coefficients
+    """
+    from ROOT import WSeries
+    import wseries
+
+    wdm_types = _as_WDM_types(wdm_types)
+    signals = np.atleast_2d(signals)
+    num_signals, num_samples = signals.shape
+    profiling.annotate(num_signals=num_signals, num_samples=num_samples,
+                       num_scales=len(wdm_types))
+
+    signal_buffer = WavearrayBuffer(num_samples)
+
+    wdms = []
+    for wdm_type in wdm_types:
+        wdm = WSeries('double')()
+        wseries.extend_WSeries(wdm)
+        wdms.append(wdm)
+
+    directs = [None] * len(wdm_types)
+    duals = [None] * len(wdm_types)
+
+    for n, signal in enumerate(signals):
+
+        signal_wavearray = signal_buffer.fill(signal)
+
+        for k, (wdm, wdm_type) in enumerate(zip(wdms, wdm_types)):
+
+            wdm.Forward(signal_wavearray, wdm_type)
+            direct, dual = wdm.nparray()
+
+            # Output arrays are allocated once the shape of the
+            # transform at this scale is known
+            if directs[k] is None:
+                directs[k] = np.empty((num_signals,) + direct.shape)
+                duals[k] = np.empty((num_signals,) + dual.shape)
+
+            directs[k][n] = direct
+            duals[k][n] = dual
+
+    return directs, duals
+
+def _half_support(wdm_type):
+    """ Half length of the support of the atoms of a WDM type (in samples) """
+    from ROOT import wavearray
+
+    wavelet = wavearray('double')()
+    wdm_type.getBaseWave(1, wavelet, False)
+    return int(wavelet.size()) // 2
+
+def wdm_blocks(signal, wdm_type, block_times):
+    """
+    Compute the WDM transform of a long signal block by block, and
+    yield the coefficients of each block.
+
+    Each block of time indices is transformed from the samples it
+    covers, extended on both sides by a margin of at least half the
+    atom support: the coefficients of the block are then exactly those
+    of the transform of the whole (periodic) signal. The margins are
+    multiples of two time steps, so that the blocks start at even time
+    indices and keep the phases of the Wilson atoms. Only one block
+    (and its margins) is held in memory at a time.
+
+    Inputs:
+    -------
+    signal [Numpy Array] -- signal (its length is a multiple of the number
+                            of layers of the WDM type)
+    wdm_type       [WDM] -- WDM type
+    block_times    [int] -- number of time indices per block (rounded to
+                            the next even number)
+
+    Yields:
+    -------
+    start          [int] -- first time index of the block
+    direct [Numpy Array] -- (freq x time) direct coefficients of the block
+    dual   [Numpy Array] -- (freq x time) dual coefficients of the block
+
+    The coefficient arrays are views on work arrays that are overwritten
+    by the next block: copy them to keep them.
+    """
+    from ROOT import WSeries
+    import wseries
+
+    num_layers = int(wdm_type.m_Layer)
+    num_samples = len(signal)
+    if num_samples % num_layers:
+        raise ValueError("The number of samples (={}) is not a multiple of " \
+                         "the number of layers (={})".format(num_samples,
+                                                             num_layers))
+    num_times = num_samples // num_layers
+    block_times = int(block_times) + int(block_times) % 2
+    margin = 2 * int(np.ceil(_half_support(wdm_type) / (2. * num_layers)))
+
+    wdm = WSeries('double')()
+    wseries.extend_WSeries(wdm)
+
+    # Short signals are transformed at once
+    if block_times + 2 * margin >= num_times:
+        wdm.Forward(convert_numpyarray_to_wavearray(signal), wdm_type)
+        direct, dual = wdm.nparray()
+        yield 0, direct, dual
+        return
+
+    chunk = WavearrayBuffer((block_times + 2 * margin) * num_layers)
+    indices = np.arange(chunk.array.size) - margin * num_layers
+
+    for start in range(0, num_times, block_times):
+        stop = min(start + block_times, num_times)
+        np.take(signal, indices + start * num_layers, mode='wrap', out=chunk.array)
+        wdm.Forward(chunk.wavearray, wdm_type)
+        direct, dual = wdm.nparray()
+        yield start, direct[:, margin:margin + stop - start], \
+              dual[:, margin:margin + stop - start]
+
+def wdm_transform_blocked(signal, wdm_types, block_duration, energy_fraction=None):
+    """
+    Return the TF maps of a long signal computed with the blocked WDM
+    transform (see wdm_blocks()), for signals whose full transform does
+    not fit in memory.
+
+    With energy_fraction, the dense maps are never built: the pixels of
+    each block holding energy_fraction of the energy of the block are
+    kept as candidates (so that they hold at least energy_fraction of
+    the energy of the plane), and the fewest largest candidates holding
+    energy_fraction of the energy of the plane are returned. Only one
+    block of the energy map, and the candidates, are held in memory.
+
+    Inputs:
+    -------
+    signal [Numpy Array] -- signal to decompose on WDM basis
+    wdm_types     [list] -- WDM type list, or CoherentWaveBurstGrid object
+    block_duration [int] -- number of samples per block (rounded to an
+                            even number of time steps at each scale)
+    energy_fraction [float/None] -- if given, sparse TF maps are returned
+                                    (see sparse_energy_map())
+
+    Output:
+    -------
+    tfmaps  [list] -- list of (freq x time) energy maps, one per WDM type,
+                      or list of SparseTFMap objects
+    """
+    wdm_types = _as_WDM_types(wdm_types)
+
+    tfmaps = []
+    for wdm_type in wdm_types:
+        num_layers = int(wdm_type.m_Layer)
+        shape = (num_layers + 1, len(signal) // num_layers)
+        blocks = wdm_blocks(signal, wdm_type, max(1, block_duration // num_layers))
+
+        if energy_fraction is None:
+            tfmap = np.empty(shape)
+            for (start, direct, dual) in blocks:
+                # The block coefficients are overwritten by the next block:
+                # the direct ones are used as work array
+                energy_map(direct, dual, out=tfmap[:, start:start + direct.shape[1]],
+                           work=direct)
+            tfmaps.append(tfmap)
+            continue
+
+        block_map = None
+        keys = []
+        energies = []
+        total = 0.
+        for (start, direct, dual) in blocks:
+            # The first block is the widest one
+            if block_map is None:
+                block_map = np.empty(direct.shape)
+            tfmap = energy_map(direct, dual, out=block_map[:, :direct.shape[1]],
+                               work=direct)
+            total += np.sum(tfmap)
+            candidates = sparse_energy_map(tfmap, energy_fraction)
+            freq_index, time_index = candidates.indices()
+            keys.append(np.ravel_multi_index((freq_index, time_index + start), shape))
+            energies.append(candidates.energies)
+
+        keys = np.concatenate(keys)
+        energies = np.concatenate(energies)
+        if keys.size == 0 or energy_fraction * total <= 0:
+            tfmaps.append(SparseTFMap(shape, np.empty(0, dtype=int), np.empty(0)))
+            continue
+        order = _largest_energies(energies, energy_fraction * total, keys.size)
+        tfmaps.append(SparseTFMap(shape, keys[order], energies[order]))
+
+    return tfmaps
+
 def wilson_basis_func(wdm_type, num_samples, time_index, freq_index, dual_flag):
     """
     Returns the Wilson basis function that correspond to a given time and 
@@ -124,7 +823,8 @@ def wilson_basis_func(wdm_type, num_samples, time_index, freq_index, dual_flag):
     
     Inputs:
     -------
-    wdm_type [WSeries] -- Wseries object
+    wdm_type [WDM/int] -- WDM type, or timescale exponent (the wavelet is
+                          then taken from the atom dictionary)
     num_samples  [int] -- number of samples for the reconstructed wavelet
     time_index   [int] -- time index of the pixel/wavelet to be reconstructed
     freq_index   [int] -- frequency index of the pixel/wavlet to be reconstructed
@@ -134,80 +834,513 @@ def wilson_basis_func(wdm_type, num_samples, time_index, freq_index, dual_flag):
     ------
     out [Numpy Array] -- reconstructed wavelet.
     """
-    # Compute wavelet associated with freq_coord.
-    # time_coord does not matter here. This calls returns
-    # a vector with the wavelet centered.
-    # XXX test if time_coord can effectively be set to zero XXX
-    wavelet = wavearray('double')()
-    wdm_type.getBaseWave(int((wdm_type.m_Layer+1) * time_index + freq_index), \
-                         wavelet, dual_flag)
-    
-    # Create a vector with num_samples samples and
-    # copy the wavelet centered on time_index
-    
-    # First compute the indices where to copy the wavelet
-    # Wrap around (circular mirroring) if part of
-    # the wavelet support exceed vector boundaries
-    wavelet_time = wdm_type.m_Layer * time_index
-    idx_min = int(wavelet_time-(wavelet.size()-1)/2)
-    idx_max = int(wavelet_time+(wavelet.size()-1)/2+1)
-    idx = np.take(range(num_samples), range(idx_min,idx_max), mode='wrap')
+    from ROOT import wavearray
+
+    if isinstance(wdm_type, (int, np.integer)):
+        offset, samples = WILSON_ATOMS.atom(wdm_type, time_index,
+                                            freq_index, dual_flag)
+    else:
+        wavelet = wavearray('double')()
+        wdm_type.getBaseWave(int((wdm_type.m_Layer+1) * time_index + freq_index), \
+                             wavelet, dual_flag)
+        samples = convert_wavearray_to_numpyarray(wavelet)
+        offset = wdm_type.m_Layer * time_index - samples.size // 2
     
     # Create output vector
     out = np.zeros(num_samples)
     
-    # Copy the wavelet into the segment
-    out[idx] = convert_wavearray_to_numpyarray(wavelet)
+    # Copy the wavelet centered on time_index into the segment.
+    # Wrap around (circular mirroring) if part of
+    # the wavelet support exceed vector boundaries
+    out[np.arange(offset, offset + samples.size) % num_samples] = samples
     
     return out
 
+class WilsonAtomDictionary(object):
+    """
+    Dictionary of the Wilson basis functions (atoms) of the WDM transforms.
+
+    The shape of the atom associated to the pixel (time_index, freq_index)
+    of a given scale only depends on freq_index, on the parity of
+    time_index and on the dual flag: moving the pixel by one time step
+    shifts the atom by 2**scale samples, and alternates between the
+    two phases of the Wilson basis. One prototype atom is therefore
+    computed per (scale, freq_index, parity, dual_flag) and cached,
+    and the atoms are returned in the sparse form (offset, samples)
+    where offset is the (unwrapped) index of the first sample of the
+    atom support in the segment.
+
+    Main attributes:
+    ----------------
+    wat_type  -- wavelet type of the WDM types
+    inu       -- WDM filter steepness parameter
+    precision -- WDM filter precision parameter
+    """
+    def __init__(self, wat_type=None, inu=CWB_DEFAULT_INU,
+                 precision=CWB_DEFAULT_PRECISION):
+        """
+        wat_type  [str/None] -- wavelet type
+        inu            [int] -- WDM filter steepness parameter
+        precision      [int] -- WDM filter precision parameter
+        """
+        self.wat_type = wat_type
+        self.inu = inu
+        self.precision = precision
+        self._prototypes = {}
+
+    def prototype(self, scale, freq_index, parity, dual_flag):
+        """
+        Return the samples of the prototype atom of a given scale,
+        frequency index, time index parity and dual flag.
+
+        Inputs:
+        -------
+        scale       [int] -- timescale exponent
+        freq_index  [int] -- frequency index
+        parity      [int] -- parity of the time index (0 or 1)
+        dual_flag  [bool] -- dual basis if True
+
+        Output:
+        -------
+        samples [Numpy Array] -- atom samples (read-only)
+        """
+        from ROOT import wavearray
+
+        key = (int(scale), int(freq_index), int(parity) % 2, bool(dual_flag))
+
+        if key not in self._prototypes:
+            wdm_type = get_WDM_type(key[0], self.wat_type,
+                                    self.inu, self.precision)
+            wavelet = wavearray('double')()
+            wdm_type.getBaseWave(int((wdm_type.m_Layer+1) * key[2] + key[1]), \
+                                 wavelet, key[3])
+            samples = np.array(convert_wavearray_to_numpyarray(wavelet))
+            samples.flags.writeable = False
+            self._prototypes[key] = samples
+
+        return self._prototypes[key]
+
+    def atom(self, scale, time_index, freq_index, dual_flag):
+        """
+        Return the atom of a given pixel as a pair (offset, samples).
+
+        Inputs:
+        -------
+        scale       [int] -- timescale exponent
+        time_index  [int] -- time index of the pixel
+        freq_index  [int] -- frequency index of the pixel
+        dual_flag  [bool] -- dual basis if True
+
+        Outputs:
+        --------
+        offset            [int] -- index of the first sample of the atom
+                                   (may be negative or exceed the segment
+                                   length: wrap it around the segment)
+        samples   [Numpy Array] -- atom samples (read-only)
+        """
+        samples = self.prototype(scale, freq_index, time_index, dual_flag)
+        offset = int(2**scale) * int(time_index) - samples.size // 2
+
+        return offset, samples
+
+    def atoms(self, scale, time_indices, freq_indices, dual_flags):
+        """
+        Return the atoms of a list of pixels as a list of (offset, samples)
+        pairs. See atom().
+        """
+        return [self.atom(scale, n, m, d) \
+                for (n, m, d) in zip(time_indices, freq_indices, dual_flags)]
+
+    def synthesis_matrix(self, num_samples, scale, time_indices, freq_indices,
+                         dual_flags):
+        """
+        Return the sparse synthesis matrix of a list of pixels, i.e. the
+        (num_samples x num_pixels) matrix whose columns are the atoms
+        wrapped around a segment of num_samples samples.
+
+        A signal is synthesized from coefficients c with matrix.dot(c)
+        and the coefficients of a signal x are obtained with
+        matrix.T.dot(x), at a cost proportional to the atom support.
+
+        Inputs:
+        -------
+        num_samples          [int] -- number of samples of the segment
+        scale                [int] -- timescale exponent
+        time_indices [Numpy Array] -- time indices of the pixels
+        freq_indices [Numpy Array] -- frequency indices of the pixels
+        dual_flags   [Numpy Array] -- dual flags of the pixels
+
+        Output:
+        -------
+        matrix [scipy.sparse.csc_matrix] -- synthesis matrix
+        """
+        from scipy import sparse
+
+        atoms = self.atoms(scale, time_indices, freq_indices, dual_flags)
+        
+        if not atoms:
+            return sparse.csc_matrix((num_samples, 0))
+
+        rows = np.concatenate([np.arange(offset, offset + samples.size) % num_samples \
+                               for (offset, samples) in atoms])
+        cols = np.repeat(np.arange(len(atoms)),
+                         [samples.size for (_, samples) in atoms])
+        values = np.concatenate([samples for (_, samples) in atoms])
+
+        # Duplicate entries (atoms longer than the segment) are summed
+        return sparse.csc_matrix((values, (rows, cols)),
+                                 shape=(num_samples, len(atoms)))
+
+# Atom dictionary associated to the default WDM types
+WILSON_ATOMS = WilsonAtomDictionary()
+
+class WDMOperator(object):
+    """
+    Matrix-free linear operator of the WDM transforms on all the planes
+    of a CoherentWaveBurstGrid.
+
+    The operator maps the flat array of coefficients (see
+    tfcluster.CoefficientLayout) of a segment to the signal obtained by
+    summing the inverse WDM transforms of all planes (synthesis). Its
+    adjoint maps a signal to its WDM coefficients on all planes
+    (analysis). The wavearrays, WSeries and output arrays are allocated
+    once and reused by all the calls.
+
+    The dual coefficients are inverted with WSeries.Inverse(-2), which
+    reconstructs the signal from the quadrature component. As an inverse
+    transform leaves the WSeries in the time domain, the synthesis WSeries
+    are reset by assignment (a memory copy) from zero WSeries put in the
+    transformed state once, so that no forward transform is needed.
+
+    Main attributes:
+    ----------------
+    layout    -- CoefficientLayout object
+    wdm_types -- WDM types of the planes
+    shape     -- (number of samples, number of coefficients)
+    """
+    def __init__(self, grid, num_samples, num_parts=2, wat_type=None):
+        """
+        grid [CoherentWaveBurstGrid object] -- cWB grid
+        num_samples                   [int] -- number of samples of the segment
+        num_parts                     [int] -- 2 to include the dual atoms, 1 otherwise
+        wat_type                 [str/None] -- wavelet type
+        """
+        from ROOT import WSeries
+        import wseries
+
+        self.layout = tfcluster.CoefficientLayout(grid, num_samples, num_parts)
+        self.wdm_types = initialize_WDM_types(grid, wat_type)
+        self.wat_type = wat_type
+        self.shape = (self.layout.num_samples, self.layout.size)
+        self.dtype = np.dtype('double')
+
+        self._signal = WavearrayBuffer(num_samples)
+        zeros = WavearrayBuffer(num_samples)
+        zeros.array[:] = 0
+        self._wdms = []
+        self._zero_wdms = []
+        self._synthesis_wdms = []
+        for wdm_type in self.wdm_types:
+            wdm = WSeries('double')()
+            wseries.extend_WSeries(wdm)
+            self._wdms.append(wdm)
+            # Transformed state of the synthesis, with zero coefficients
+            zero_wdm = WSeries('double')()
+            zero_wdm.Forward(zeros.wavearray, wdm_type)
+            self._zero_wdms.append(zero_wdm)
+            wdm = WSeries('double')(zero_wdm)
+            wseries.extend_WSeries(wdm)
+            self._synthesis_wdms.append(wdm)
+
+    def key(self):
+        """ Hashable description of the operator configuration """
+        return (tuple(int(s) for s in self.layout.grid.timescales_exp),
+                self.layout.num_samples, self.layout.num_parts, self.wat_type)
+
+    def analysis(self, signal, out=None):
+        """
+        Return the WDM coefficients of a signal on all planes (adjoint operator).
+
+        Inputs:
+        -------
+        signal [Numpy Array] -- signal, or 2D stack of signals (transformed
+                                one after the other)
+        out    [Numpy Array/None] -- output flat coefficient array(s)
+        """
+        if out is None:
+            out = np.empty(np.shape(signal)[:-1] + (self.layout.size,))
+
+        if np.ndim(signal) > 1:
+            for (row, row_out) in zip(signal, out):
+                self.analysis(row, out=row_out)
+            return out
+
+        signal_wavearray = self._signal.fill(signal)
+        for (wdm, wdm_type, plane) in zip(self._wdms, self.wdm_types,
+                                          self.layout.planes(out)):
+            wdm.Forward(signal_wavearray, wdm_type)
+            for (part, coeffs) in enumerate(wdm.nparray()[:self.layout.num_parts]):
+                plane[part] = coeffs
+
+        return out
+
+    def synthesis(self, coeffs, out=None):
+        """
+        Return the signal synthesized from coefficients on all planes.
+
+        Inputs:
+        -------
+        coeffs [Numpy Array] -- flat coefficient array, or 2D stack of arrays
+                                (synthesized one after the other)
+        out    [Numpy Array/None] -- output signal(s)
+        """
+        if out is None:
+            out = np.zeros(np.shape(coeffs)[:-1] + (self.layout.num_samples,))
+        else:
+            out[...] = 0
+
+        if np.ndim(coeffs) > 1:
+            for (row, row_out) in zip(coeffs, out):
+                self.synthesis(row, out=row_out)
+            return out
+
+        for (wdm, zero_wdm, plane) in zip(self._synthesis_wdms, self._zero_wdms,
+                                          self.layout.planes(coeffs)):
+            for part in range(self.layout.num_parts):
+                if not plane[part].any():
+                    continue
+                # Reset the transformed state (WSeries::operator=), then
+                # write the coefficients and invert
+                wdm.__assign__(zero_wdm)
+                wdm.nparray()[part][...] = plane[part]
+                wdm.Inverse(-1 if part == 0 else -2)
+                out += np.squeeze(wdm.nparray(False))
+
+        return out
+
+    # Linear operator interface: A x and A^T y
+    matvec = synthesis
+    rmatvec = analysis
+
+    def aslinearoperator(self):
+        """ Return the operator as a scipy.sparse.linalg.LinearOperator """
+        from scipy.sparse.linalg import LinearOperator
+        return LinearOperator(self.shape, matvec=self.synthesis,
+                              rmatvec=self.analysis, dtype=self.dtype)
+
 def load_nrms(filename, label=None):
     """  
-    Load nRMS data from a .root or file. 
-    The .txt or .txt.gz file cases are not yet implemented.
+    Load nRMS data from a .root, .txt, .txt.gz, .npy or .hdf5 file
+    (see load_nrms_with_frequencies()).
 
     Inputs:
     ------
-    filename   [str] -- name of the .root, .txt or .txt.gz file to read.
-    label [str/None] -- label of the leaf to read (.root file case).
+    filename   [str] -- name of the nRMS file to read.
+    label [str/None] -- label of the leaf (.root file case) or of the
+                        dataset (.hdf5 file case) to read.
     
     Output:
     -------
     nrms [ROOT.WSeries("double")/Numpy Array] -- nrms read in .root file
+                                                 (for whitening()), or nRMS array
+    """
+    return load_nrms_with_frequencies(filename, label)[0]
+
+def load_nrms_with_frequencies(filename, label=None):
+    """  
+    Load nRMS data and their frequencies from a .root, .txt, .txt.gz,
+    .npy or .hdf5 file.
+
+    Text and Numpy files hold either one column (nRMS of each layer of
+    a WDM transform) or two columns (frequency [Hz], nRMS). HDF5 files
+    hold the nRMS in the dataset given by label ('nrms' by default) and
+    optionally the frequencies in a 'frequency' dataset.
+
+    Inputs:
+    ------
+    filename   [str] -- name of the nRMS file to read.
+    label [str/None] -- label of the leaf (.root file case) or of the
+                        dataset (.hdf5 file case) to read.
+    
+    Outputs:
+    -------
+    nrms [ROOT.WSeries("double")/Numpy Array] -- nrms read in .root file
+                                                 (for whitening()), or nRMS array
+    frequencies [Numpy Array/None] -- frequencies of the nRMS values (None
+                                      for .root files and one-column files)
     """
     if not os.path.isfile(filename):
         raise Exception('File {} not found'.format(filename))
+
+    basename = os.path.basename(filename)
     
-    if os.path.basename(filename).endswith('.root'):
-        return ROOT.TFile(filename).Get(label)
-    elif os.path.basename(filename).endswith(('.txt', '.txt.gz')):
-        raise NotImplementedError
-        #return np.loadtxt(filename)
+    if basename.endswith('.root'):
+        import ROOT
+        return ROOT.TFile(filename).Get(label), None
+    elif basename.endswith(('.txt', '.txt.gz', '.npy')):
+        if basename.endswith('.npy'):
+            data = np.load(filename)
+        else:
+            data = np.loadtxt(filename)
+        if data.ndim == 1:
+            return data, None
+        if data.ndim != 2 or data.shape[1] != 2:
+            raise ValueError('nRMS file {} must have one or two columns'.format(filename))
+        return data[:, 1].copy(), data[:, 0].copy()
+    elif basename.endswith(('.hdf5', '.hdf', '.h5')):
+        import h5py
+        with h5py.File(filename, 'r') as file:
+            nrms = np.array(file[label or 'nrms'], dtype=float)
+            frequencies = np.array(file['frequency'], dtype=float) \
+                          if 'frequency' in file else None
+        return nrms, frequencies
     else:
         raise Exception('Unsupported format for nRMS files')
 
+def nrms_on_grid(nrms, grid, frequencies=None):
+    """
+    Interpolate an nRMS spectrum onto the layers of each scale of a grid.
+
+    Inputs:
+    -------
+    nrms        [Numpy Array] -- nRMS values
+    grid [CoherentWaveBurstGrid object] -- cWB grid
+    frequencies [Numpy Array/None] -- frequencies of the nRMS values [Hz]. If
+                                      None, the values are those of the layers
+                                      of a WDM transform (regularly spaced from
+                                      0 to the Nyquist frequency)
+
+    Output:
+    -------
+    nrms_layers [list] -- list of 1D arrays (one per scale, of length the
+                          number of layers + 1)
+    """
+    nrms = np.asarray(nrms, dtype=float)
+    nyquist = grid.sampling_freq / 2.
+    if frequencies is None:
+        frequencies = np.linspace(0., nyquist, len(nrms))
+
+    return [np.interp(np.linspace(0., nyquist, 2**int(scale) + 1),
+                      frequencies, nrms) for scale in grid.timescales_exp]
+
+# nRMS spectra already interpolated onto grids, indexed by file, file
+# modification time, label and grid
+_GRID_NRMS = {}
+
+def get_grid_nrms(filename, grid, label=None):
+    """
+    Return the nRMS spectrum of a .txt, .txt.gz, .npy or .hdf5 file
+    interpolated onto the layers of each scale of a grid (see
+    nrms_on_grid()). The spectra are loaded and interpolated once per
+    file and grid.
+    """
+    key = (os.path.abspath(filename), os.path.getmtime(filename), label,
+           grid.sampling_freq, tuple(int(s) for s in grid.timescales_exp))
+    if key not in _GRID_NRMS:
+        nrms, frequencies = load_nrms_with_frequencies(filename, label)
+        if not isinstance(nrms, np.ndarray):
+            raise ValueError('nRMS file {} does not hold an nRMS array; ' \
+                             '.root nRMS files can only be used with ' \
+                             'whitening()'.format(filename))
+        _GRID_NRMS[key] = nrms_on_grid(nrms, grid, frequencies)
+    return _GRID_NRMS[key]
+
+@profiling.timed()
+def whitening_batch(signals, noiserms, wdm_type=None):
+    """
+    Whitening of a stack of signals in the time-frequency domain, in place.
+
+    The input wavearray, the WSeries object and the inverse nRMS are set
+    up once for the whole stack, and each signal is divided by the
+    nRMS in the WDM domain without temporary arrays.
+
+    Input:
+    ------
+    signals [Numpy Array] -- 2D array (template x time) of signals,
+                             overwritten by the whitened signals
+    noiserms [Numpy Array] -- nRMS of each layer of the WDM transform
+    wdm_type    [WDM/None] -- type of the WDM transform used for whitening.
+                              If None, the WDM type matching the number of
+                              frequency bins of noiserms is taken from the cache
+
+    Output:
+    ------
+    signals [Numpy Array] -- whitened signals
+    """
+    from ROOT import WSeries
+    import wseries
+
+    signals = np.atleast_2d(signals)
+    num_signals, num_samples = signals.shape
+    profiling.annotate(num_signals=num_signals, num_samples=num_samples)
+    if wdm_type is None:
+        wdm_type = get_WDM_type(int(round(np.log2(len(noiserms) - 1))))
+
+    inverse_nrms = 1. / np.asarray(noiserms, dtype=float)[:, np.newaxis]
+
+    signal_buffer = WavearrayBuffer(num_samples)
+    wdm = WSeries('double')()
+    wseries.extend_WSeries(wdm)
+
+    for signal in signals:
+
+        wdm.Forward(signal_buffer.fill(signal), wdm_type)
+        direct, _ = wdm.nparray()
+
+        # Check consistency between noiserms and wdm_type
+        if direct.shape[0] != len(inverse_nrms):
+            raise ValueError("The number of frequency bins of " \
+                             "noiserms (={}) does not match that of the " \
+                             "WDM transform (={})".format(len(inverse_nrms),
+                                                          direct.shape[0]))
+        direct *= inverse_nrms
+
+        # Invert the WDM transform to get whitened signal
+        wdm.Inverse()
+        signal[:] = np.squeeze(wdm.nparray(False))
+
+    return signals
+
+@profiling.timed()
 def whitening(*args):
     """
     Whitening in the time-frequency domain. 
 
-    ASCII part currently not working.
+    See whitening_batch() for the whitening of many signals with a
+    Numpy nRMS array (e.g. loaded from a text file with load_nrms()).
     
     Input:
     ------
     signal                    [Timeseries object]  -- input signal
     noiserms [ROOT.WSeries("double")/Numpy Array] -- noise power spectral density
-    wdm_type                            [Wseries] -- type of the WDM transform used for whitening
+    wdm_type                     [list, optional] -- type of the WDM transform used for whitening
+                                                     (list of 1 element). If omitted, the WDM type
+                                                     matching the number of frequency bins of
+                                                     noiserms is taken from the cache
 
     Output:
     ------
     whitened signal [Timeseries object] -- whitened signal
     """
-    if len(args) != 3:
-        raise Exception("whitening() requires three input"
+    import ROOT
+    import wseries
+
+    if len(args) not in (2, 3):
+        raise Exception("whitening() requires two or three input"
                         "args, {} given".format(len(args)))
-    
+    profiling.annotate(template=args[0].metadata, num_samples=len(args[0].data))
+
+    if len(args) == 3:
+        wdm_types = args[2]
+    else:
+        if isinstance(args[1], np.ndarray):
+            num_layers = len(args[1]) - 1
+        else:
+            num_layers = args[1].maxLayer()
+        wdm_types = [get_WDM_type(int(round(np.log2(num_layers))))]
+
     # Compute WDM transform
-    wdm, _ = wdm_transform(args[0].data, args[2])
+    wdm, _ = wdm_transform(args[0].data, wdm_types)
     wdm = wdm[-1] # squeeze list of 1 element
 
     wseries.extend_WSeries(wdm)
@@ -233,16 +1366,16 @@ def whitening(*args):
                              "noiserms (={}) does not match that of the " \
                              "WDM transform (={})".format(len(args[1]),wdm.maxLayer()))
     
-        # Whitening: divide by amplitude noise spectrum, copy
-        # the result "in place" (in the same array)
-        np.copyto(direct, np.divide(direct.T, args[1]).T)
+        # Whitening: divide by amplitude noise spectrum in place
+        direct /= np.asarray(args[1], dtype=float)[:, np.newaxis]
         
     # Invert the WDM transform to get whitened signal
     wdm.Inverse()
     
     # Convert from WSeries to Numpy array
-    # and squeeze superfluous dimensions
-    return timeseries.Timeseries(copy.copy(np.squeeze(wdm.nparray(False))),
+    # and squeeze superfluous dimensions. The Timeseries takes its own
+    # copy of the data, which are owned by the WSeries
+    return timeseries.Timeseries(np.squeeze(wdm.nparray(False)),
                          args[0].sampling_freq,
                          0.0,
                          args[0].metadata)